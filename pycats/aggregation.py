@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+from datetime import timedelta
+import math
+import random
+import threading
+import pytz
+from valuecodecs import decode_floats
+from array import array
+from models import TimestampedDataDTO
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+COUNT = 'count'
+SUM = 'sum'
+MEAN = 'mean'
+MIN = 'min'
+MAX = 'max'
+SUPPORTED_AGGREGATES = [COUNT, SUM, MEAN, MIN, MAX]
+DEFAULT_AGGREGATES = (MEAN,)
+
+# Columns per read when paging through an hourly shard
+DEFAULT_PAGE_SIZE = 10000
+# Values sampled per bucket for the approximate percentiles
+RESERVOIR_SIZE = 512
+
+PICOS_PER_SECOND = 10**12
+PICOS_PER_MICRO = 10**6
+
+
+class UnknownAggregateException(Exception):
+    pass
+
+
+def _seconds(a_timedelta):
+    return a_timedelta.days * 86400 + a_timedelta.seconds + a_timedelta.microseconds / 1e6
+
+
+def _naive_utc(timestamp):
+    if timestamp.tzinfo:
+        return timestamp.astimezone(pytz.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _picos_since_start_of_hour(timestamp):
+    return ((timestamp.minute * 60 + timestamp.second) * 10**6 + timestamp.microsecond) * PICOS_PER_MICRO
+
+
+# Count, sum, min and max per time bucket, plus a fixed size random sample of the values for the percentiles.
+#
+# Memory is a few numbers (and at most RESERVOIR_SIZE samples) per bucket, however many points are added.
+# Uses NumPy for the per bucket arithmetic when it is available.
+class BucketAggregates():
+
+    def __init__(self, bucket_count, keep_samples=False, reservoir_size=RESERVOIR_SIZE):
+        self.bucket_count = bucket_count
+        self.reservoir_size = reservoir_size
+        if numpy is not None:
+            self.counts = numpy.zeros(bucket_count, dtype=numpy.int64)
+            self.sums = numpy.zeros(bucket_count, dtype=numpy.float64)
+            self.mins = numpy.empty(bucket_count, dtype=numpy.float64)
+            self.mins.fill(numpy.inf)
+            self.maxs = numpy.empty(bucket_count, dtype=numpy.float64)
+            self.maxs.fill(-numpy.inf)
+        else:
+            self.counts = [0] * bucket_count
+            self.sums = [0.0] * bucket_count
+            self.mins = [None] * bucket_count
+            self.maxs = [None] * bucket_count
+        # bucket -> sampled values, only if percentiles are wanted
+        self.samples = dict() if keep_samples else None
+
+    # Adds the values (numbers, typed values or strings that parse as numbers, others are skipped) to the buckets
+    def add(self, bucket_indices, values):
+        if numpy is not None:
+            self.__add_vectorized(bucket_indices, values)
+        else:
+            self.__add_each(bucket_indices, values)
+
+    def __add_vectorized(self, bucket_indices, values):
+        values = decode_floats(values)
+        bucket_indices = numpy.asarray(bucket_indices, dtype=numpy.int64)
+        valid = ~numpy.isnan(values)
+        values = values[valid]
+        bucket_indices = bucket_indices[valid]
+
+        self.counts += numpy.bincount(bucket_indices, minlength=self.bucket_count)
+        self.sums += numpy.bincount(bucket_indices, weights=values, minlength=self.bucket_count)
+        numpy.minimum.at(self.mins, bucket_indices, values)
+        numpy.maximum.at(self.maxs, bucket_indices, values)
+        if self.samples is not None:
+            self.__sample(bucket_indices.tolist(), values.tolist())
+
+    def __add_each(self, bucket_indices, values):
+        counts = self.counts
+        sums = self.sums
+        mins = self.mins
+        maxs = self.maxs
+        added_indices = list()
+        added_values = list()
+        for (i, value) in zip(bucket_indices, decode_floats(values)):
+            if math.isnan(value):
+                continue
+            counts[i] += 1
+            sums[i] += value
+            if mins[i] is None or value < mins[i]:
+                mins[i] = value
+            if maxs[i] is None or value > maxs[i]:
+                maxs[i] = value
+            added_indices.append(i)
+            added_values.append(value)
+        if self.samples is not None:
+            self.__sample(added_indices, added_values)
+
+    # Reservoir sampling, every value of a bucket has the same chance to be in its sample. Called after the
+    # counts are updated
+    def __sample(self, bucket_indices, values):
+        added = dict()
+        for i in bucket_indices:
+            added[i] = added.get(i, 0) + 1
+        # Number of values of each bucket before this one
+        seen = dict([(i, int(self.counts[i]) - count) for (i, count) in added.items()])
+        for (i, value) in zip(bucket_indices, values):
+            sample = self.samples.setdefault(i, list())
+            seen[i] += 1
+            if len(sample) < self.reservoir_size:
+                sample.append(value)
+            else:
+                j = random.randint(0, seen[i] - 1)
+                if j < self.reservoir_size:
+                    sample[j] = value
+
+    def merge(self, other):
+        if numpy is not None:
+            self.counts += other.counts
+            self.sums += other.sums
+            numpy.minimum(self.mins, other.mins, self.mins)
+            numpy.maximum(self.maxs, other.maxs, self.maxs)
+        else:
+            for i in xrange(0, self.bucket_count):
+                if other.counts[i] == 0:
+                    continue
+                self.counts[i] += other.counts[i]
+                self.sums[i] += other.sums[i]
+                if self.mins[i] is None or other.mins[i] < self.mins[i]:
+                    self.mins[i] = other.mins[i]
+                if self.maxs[i] is None or other.maxs[i] > self.maxs[i]:
+                    self.maxs[i] = other.maxs[i]
+        if self.samples is not None:
+            for (i, other_sample) in other.samples.items():
+                self.samples[i] = self.__merge_samples(self.samples.get(i, []), int(self.counts[i] - other.counts[i]), other_sample, int(other.counts[i]))
+
+    # Keeps the share of each sample that its number of values is of the total
+    def __merge_samples(self, sample, count, other_sample, other_count):
+        if len(sample) + len(other_sample) <= self.reservoir_size:
+            return sample + other_sample
+        from_sample = int(round(self.reservoir_size * float(count) / (count + other_count)))
+        from_sample = min(from_sample, len(sample))
+        from_other = min(self.reservoir_size - from_sample, len(other_sample))
+        return random.sample(sample, from_sample) + random.sample(other_sample, from_other)
+
+    def percentile(self, i, percent):
+        if not self.samples or not self.samples.get(i):
+            return None
+        sample = sorted(self.samples[i])
+        return sample[int(round(percent / 100.0 * (len(sample) - 1)))]
+
+    # Returns a dict per bucket with the requested aggregates, None for buckets without values
+    def results(self, aggregates, percentiles=None):
+        result = list()
+        for i in xrange(0, self.bucket_count):
+            count = int(self.counts[i])
+            values = dict()
+            for aggregate in aggregates:
+                if aggregate == COUNT:
+                    values[COUNT] = count
+                elif count == 0:
+                    values[aggregate] = None
+                elif aggregate == SUM:
+                    values[SUM] = float(self.sums[i])
+                elif aggregate == MEAN:
+                    values[MEAN] = float(self.sums[i]) / count
+                elif aggregate == MIN:
+                    values[MIN] = float(self.mins[i])
+                elif aggregate == MAX:
+                    values[MAX] = float(self.maxs[i])
+            for percent in percentiles or []:
+                values['p%g' % percent] = self.percentile(i, percent)
+            result.append(values)
+        return result
+
+
+# Aggregates several series into time buckets, ie. the mean CPU across all hosts per 5 minutes.
+#
+# series is a list of (source_id, data_name), start and end are UTC. Every series is read shard by shard in
+# pages of page_size columns on the parallel reader of the DAO, and added to the buckets right away. Points
+# are bucketed straight from the column names, no datetimes are created for them. Uses the hour presence
+# index of the DAO, if turned on, to skip empty hours.
+#
+# With a processes.ShardDecoderPool the pages are parsed and bucketed on its worker processes, the threads
+# only read. An aggregator runs one aggregation at a time.
+#
+# Returns [(bucket start, {aggregate: value})] for every bucket, percentiles are keyed 'p95' etc and are
+# approximate (computed on a sample of RESERVOIR_SIZE values per bucket).
+class SeriesAggregator():
+
+    def __init__(self, pycats_dao, page_size=DEFAULT_PAGE_SIZE, decoder_pool=None):
+        self.dao = pycats_dao
+        self.decoder_pool = decoder_pool
+        if decoder_pool is not None:
+            page_size = min(page_size, decoder_pool.slot_capacity)
+        self.page_size = page_size
+        self.__pending = list()
+        self.__total = None
+        self.__lock = threading.Lock()
+
+    def __merge(self, partial):
+        with self.__lock:
+            self.__total.merge(partial)
+
+    def aggregate(self, series, start_datetime, end_datetime, bucket_size, aggregates=DEFAULT_AGGREGATES, percentiles=None):
+        for aggregate in aggregates:
+            if aggregate not in SUPPORTED_AGGREGATES:
+                raise UnknownAggregateException('Unknown aggregate \'%s\'' % aggregate)
+        start_datetime = _naive_utc(start_datetime)
+        end_datetime = _naive_utc(end_datetime)
+        bucket_seconds = _seconds(bucket_size)
+        bucket_count = int(math.floor(_seconds(end_datetime - start_datetime) / bucket_seconds)) + 1
+
+        self.__total = BucketAggregates(bucket_count, keep_samples=bool(percentiles))
+        self.__pending = list()
+
+        def aggregate_one(source_id_and_data_name):
+            # Each series is aggregated on its own and merged in, so readers never wait for each other. With a
+            # decoder pool the pages are merged in as they come back from the workers instead
+            partial = BucketAggregates(bucket_count, keep_samples=bool(percentiles))
+            self.__read_series(partial, source_id_and_data_name[0], source_id_and_data_name[1], start_datetime, end_datetime, bucket_seconds)
+            if self.decoder_pool is None:
+                self.__merge(partial)
+
+        self.dao.parallel_reader.map(aggregate_one, series)
+        for pending in self.__pending:
+            pending.get()
+
+        results = self.__total.results(aggregates, percentiles)
+        return [(start_datetime + timedelta(seconds=i * bucket_seconds), values) for (i, values) in enumerate(results)]
+
+    def __read_series(self, partial, source_id, data_name, start_datetime, end_datetime, bucket_seconds):
+        present_row_keys = None
+        if self.dao.hour_presence_index:
+            present_row_keys = self.dao.get_present_hourly_row_keys(source_id, data_name, start_datetime, end_datetime)
+
+        span = _seconds(end_datetime - start_datetime)
+        hour = self.dao.floor_timestamp_to_hour(start_datetime)
+        last_hour = self.dao.floor_timestamp_to_hour(end_datetime)
+        while hour <= last_hour:
+            row_key = TimestampedDataDTO(source_id, hour, data_name, None).get_row_key_for_hourly()
+            if present_row_keys is None or row_key in present_row_keys:
+                # Only the first and the last shard are read partially
+                column_start = _picos_since_start_of_hour(start_datetime) if hour < start_datetime else None
+                column_finish = _picos_since_start_of_hour(end_datetime) + PICOS_PER_MICRO - 1 if hour == last_hour else None
+                self.__read_shard(partial, source_id, data_name, hour, column_start, column_finish, _seconds(hour - start_datetime), span, bucket_seconds)
+            hour += timedelta(hours=1)
+
+    def __read_shard(self, partial, source_id, data_name, hour, column_start, column_finish, hour_offset, span, bucket_seconds):
+        while True:
+            columns = self.dao.get_hourly_shard_slice(source_id, data_name, hour, column_start, column_finish, self.page_size)
+            if len(columns) == 0:
+                return
+            offsets = columns.keys()
+            if self.decoder_pool is None:
+                add_shard_page(partial, offsets, columns.values(), hour_offset, span, bucket_seconds)
+            else:
+                self.__pending.append(self.decoder_pool.submit(aggregate_shard_page, offsets, columns.values(), (hour_offset, span, bucket_seconds, partial.bucket_count, partial.samples is not None), self.__merge))
+            if len(columns) < self.page_size:
+                return
+            column_start = offsets[-1] + 1
+
+
+# Adds one page of an hourly shard, hour_offset is the number of seconds from the start of the aggregation to
+# the start of the hour, points outside of 0 - span seconds are skipped
+def add_shard_page(partial, offsets, values, hour_offset, span, bucket_seconds):
+    bucket_indices = list()
+    kept_values = list()
+    for (offset, value) in zip(offsets, values):
+        seconds = hour_offset + offset / float(PICOS_PER_SECOND)
+        if 0 <= seconds <= span:
+            bucket_indices.append(int(seconds // bucket_seconds))
+            kept_values.append(value)
+    if kept_values:
+        partial.add(bucket_indices, kept_values)
+
+
+# Same as add_shard_page but returns the page on its own, runs on a processes.ShardDecoderPool
+def aggregate_shard_page(offsets, values, hour_offset, span, bucket_seconds, bucket_count, keep_samples):
+    partial = BucketAggregates(bucket_count, keep_samples)
+    add_shard_page(partial, offsets, values, hour_offset, span, bucket_seconds)
+    return partial
+
+
+# Returns (seconds since the epoch, values) of a page of an hourly shard as two array('d'), values that are
+# not numbers are NaN. Runs on a processes.ShardDecoderPool, see TimeSeriesCassandraDao.get_timetamped_data_range_arrays
+def decode_shard_page(offsets, values, hour_epoch):
+    seconds = array('d', [hour_epoch + offset / PICOS_PER_MICRO / 1e6 for offset in offsets])
+    return (seconds, array('d', decode_floats(values)))
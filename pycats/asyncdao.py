@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+from multiprocessing.pool import ThreadPool
+import Queue
+import sys
+import threading
+import time
+import pycats
+
+DEFAULT_TIMEOUT = 30        # seconds
+DEFAULT_PREFETCH_SIZE = 1000
+
+PENDING = 'pending'
+RUNNING = 'running'
+FINISHED = 'finished'
+CANCELLED = 'cancelled'
+
+
+class AsyncTimeoutException(Exception):
+    pass
+
+
+class AsyncCancelledException(Exception):
+    pass
+
+
+# Handle to a DAO call running on the executor of an AsyncTimeSeriesDao.
+#
+# Works like a future: wait on it with result(timeout), or register a callback with add_done_callback()
+# to hand the result over to whatever event loop is in use. A call can only be cancelled before it
+# starts, a request that is already on the wire to Cassandra can't be taken back.
+class AsyncCall():
+
+    def __init__(self, func, args, kwargs):
+        self.__func = func
+        self.__args = args
+        self.__kwargs = kwargs
+        self.__state = PENDING
+        self.__result = None
+        self.__exc_info = None
+        self.__callbacks = list()
+        self.__condition = threading.Condition()
+
+    def _run(self):
+        with self.__condition:
+            if self.__state != PENDING:
+                return
+            self.__state = RUNNING
+        try:
+            result = self.__func(*self.__args, **self.__kwargs)
+            self.__finish(FINISHED, result, None)
+        except Exception:
+            self.__finish(FINISHED, None, sys.exc_info())
+
+    def __finish(self, state, result, exc_info):
+        with self.__condition:
+            self.__state = state
+            self.__result = result
+            self.__exc_info = exc_info
+            self.__condition.notify_all()
+            callbacks = self.__callbacks
+            self.__callbacks = list()
+        for callback in callbacks:
+            callback(self)
+
+    def cancel(self):
+        with self.__condition:
+            if self.__state == CANCELLED:
+                return True
+            if self.__state != PENDING:
+                return False
+            self.__state = CANCELLED
+            self.__condition.notify_all()
+            callbacks = self.__callbacks
+            self.__callbacks = list()
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def cancelled(self):
+        return self.__state == CANCELLED
+
+    def running(self):
+        return self.__state == RUNNING
+
+    def done(self):
+        return self.__state in (FINISHED, CANCELLED)
+
+    def add_done_callback(self, callback):
+        with self.__condition:
+            if not self.done():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    # Blocks up to timeout seconds (None waits forever). Raises the exception of the call if it failed
+    def result(self, timeout=None):
+        with self.__condition:
+            if timeout is None:
+                while not self.done():
+                    self.__condition.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self.done():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise AsyncTimeoutException('Call did not finish within %s seconds' % timeout)
+                    self.__condition.wait(remaining)
+        if self.__state == CANCELLED:
+            raise AsyncCancelledException('Call was cancelled')
+        if self.__exc_info:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__result
+
+    def exception(self, timeout=None):
+        try:
+            self.result(timeout)
+        except (AsyncTimeoutException, AsyncCancelledException):
+            raise
+        except Exception as e:
+            return e
+        return None
+
+
+# Queue between the producer of an AsyncRangeIterator and the iterator. The producer only references the
+# buffer, never the iterator, so an iterator that is dropped without close() is still garbage collected
+class _RangeBuffer():
+
+    END = object()
+
+    def __init__(self, prefetch_size, timeout):
+        self.queue = Queue.Queue(prefetch_size)
+        self.closed = False
+        self.timed_out = False
+        self.timeout = timeout
+
+    def produce(self, generator):
+        try:
+            for item in generator:
+                if self.closed:
+                    return
+                self.__put(item)
+        finally:
+            self.__put(self.END)
+
+    def __put(self, item):
+        # Don't block forever on a consumer that has gone away, or stopped consuming for longer than the timeout
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                if deadline is not None and time.time() > deadline:
+                    self.timed_out = True
+                    self.closed = True
+
+
+# Iterates (datetime, value) tuples while a worker loads the range ahead of the consumer, at most
+# prefetch_size points ahead. Call close() (or cancel the producer) to stop loading early. The producer also
+# stops when the iterator is garbage collected, or when no point was consumed for timeout seconds.
+class AsyncRangeIterator():
+
+    def __init__(self, prefetch_size=DEFAULT_PREFETCH_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.__buffer = _RangeBuffer(prefetch_size, timeout)
+        self.timeout = timeout
+        self.producer = None
+        # Run by the producer, bound to the buffer rather than to the iterator
+        self._produce = self.__buffer.produce
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.__buffer.timed_out:
+            raise AsyncTimeoutException('Nothing consumed within %s seconds, the producer gave up' % self.timeout)
+        if self.__buffer.closed:
+            raise StopIteration
+        try:
+            item = self.__buffer.queue.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise AsyncTimeoutException('No data within %s seconds' % self.timeout)
+        if item is _RangeBuffer.END:
+            self.__buffer.closed = True
+            # Surface errors from the producer
+            if self.producer is not None:
+                self.producer.result(0)
+            raise StopIteration
+        return item
+
+    def close(self):
+        self.__buffer.closed = True
+        if self.producer is not None:
+            self.producer.cancel()
+
+    def __del__(self):
+        self.close()
+
+
+# Non-blocking front end for the TimeSeriesCassandraDao.
+#
+# Every call is run on an executor with one thread per connection in the DAOs pool (pycassa hands each
+# thread its own connection) and an AsyncCall is returned right away. The calling thread, typically an
+# event loop, never waits on Cassandra unless it asks for the result.
+#
+# pycassa only runs on Python 2, so there is no asyncio here. Bridge the AsyncCalls into the event loop
+# in use through add_done_callback(), ie. IOLoop.add_callback in Tornado or callFromThread in Twisted.
+class AsyncTimeSeriesDao():
+
+    def __init__(self, pycats_dao, max_workers=None, default_timeout=DEFAULT_TIMEOUT):
+        self.dao = pycats_dao
+        self.max_workers = max_workers or pycats_dao.pool_size
+        self.default_timeout = default_timeout
+        self.__executor = ThreadPool(self.max_workers)
+
+    def submit(self, func, *args, **kwargs):
+        call = AsyncCall(func, args, kwargs)
+        self.__executor.apply_async(call._run)
+        return call
+
+    # Waits for the call, cancels it if it has not started within the timeout
+    def wait(self, call, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        try:
+            return call.result(timeout)
+        except AsyncTimeoutException:
+            call.cancel()
+            raise
+
+    def dispose(self, dispose_dao=True):
+        self.__executor.close()
+        self.__executor.join()
+        if dispose_dao:
+            self.dao.dispose()
+
+    ##
+    ## Data insertion
+    ##
+    ######################################################
+
+    def insert_timestamped_data(self, ts_data_dto, ttl=None, set_latest=False):
+        return self.submit(self.dao.insert_timestamped_data, ts_data_dto, ttl, set_latest)
+
+    def batch_insert_timestamped_data(self, list_of_timestamped_data_dtos, ttl=None, set_latest=False):
+        return self.submit(self.dao.batch_insert_timestamped_data, list_of_timestamped_data_dtos, ttl, set_latest)
+
+    def insert_indexable_text_as_blob_data_and_insert_index(self, ts_data_dto, ttl=None):
+        return self.submit(self.dao.insert_indexable_text_as_blob_data_and_insert_index, ts_data_dto, ttl)
+
+    def batch_insert_indexable_text_as_blob_data_and_insert_indexes(self, input_list_of_ts_data_dtos, ttl=None):
+        return self.submit(self.dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes, input_list_of_ts_data_dtos, ttl)
+
+    def batch_insert_indexable_text_as_blob_data_and_insert_indexes_by_ttl(self, dtos_by_ttl):
+        return self.submit(self.dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes_by_ttl, dtos_by_ttl)
+
+    def insert_latest_data(self, dto, verify_timestamp=True):
+        return self.submit(self.dao.insert_latest_data, dto, verify_timestamp)
+
+    ##
+    ## Data loading
+    ##
+    ######################################################
+
+    def get_timetamped_data_range(self, source_id, metric_name, start_datetime, end_datetime, max_count=pycats.MAX_TIME_SERIES_COLUMN_COUNT):
+        return self.submit(self.dao.get_timetamped_data_range, source_id, metric_name, start_datetime, end_datetime, max_count)
+
+    # Returns an AsyncRangeIterator right away, the range is loaded by a worker while it is consumed.
+    # Note that the worker is occupied until the range is loaded or the iterator is closed (or dropped).
+    def get_timetamped_data_range_generator(self, source_id, metric_name, start_datetime, end_datetime, max_count=pycats.MAX_TIME_SERIES_COLUMN_COUNT, prefetch_size=DEFAULT_PREFETCH_SIZE):
+        iterator = AsyncRangeIterator(prefetch_size, self.default_timeout)
+        generator = self.dao.get_timetamped_data_range_generator(source_id, metric_name, start_datetime, end_datetime, max_count)
+        iterator.producer = self.submit(iterator._produce, generator)
+        return iterator
+
+    def load_latest_data(self, source_id, data_name=None):
+        return self.submit(self.dao.load_latest_data, source_id, data_name)
+
+    def multi_load_latest_data(self, source_ids, data_names=None):
+        return self.submit(self.dao.multi_load_latest_data, source_ids, data_names)
+
+    def load_latest_data_snapshot(self, source_ids, data_names=None, use_cache=True):
+        return self.submit(self.dao.load_latest_data_snapshot, source_ids, data_names, use_cache)
+
+    def get_blobs_by_free_text_index(self, source_id, data_name, free_text, start_date=None, end_date=None, to_list_of_tuples=True, column_count=pycats.MAX_INDEX_COLUMN_COUNT):
+        return self.submit(self.dao.get_blobs_by_free_text_index, source_id, data_name, free_text, start_date, end_date, to_list_of_tuples, column_count)
+
+    def get_blobs_multi_data_by_free_text_index(self, source_id, data_names, free_text, start_date=None, end_date=None, to_list_of_tuples=True, column_count=pycats.MAX_INDEX_COLUMN_COUNT):
+        return self.submit(self.dao.get_blobs_multi_data_by_free_text_index, source_id, data_names, free_text, start_date, end_date, to_list_of_tuples, column_count)
+
+    def count_by_free_text_index(self, source_id, data_name, free_text, start_date=None, end_date=None, max_count=None):
+        return self.submit(self.dao.count_by_free_text_index, source_id, data_name, free_text, start_date, end_date, max_count)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+from collections import OrderedDict
+from datetime import timedelta
+import base64
+import re
+import zlib
+
+# Large blobs (multi-MB JSON documents, stack traces etc) are compressed and split over several
+# columns in the BlobData row before they are stored. Each chunk gets a column name one millisecond
+# after the previous one, so the row sorts the chunks in order and a single row-read fetches them all.
+#
+# An encoded blob always starts with a one byte header, followed by the base64 encoded payload:
+#
+#   0x10 | codec_id      codec_id (0-7) tells the reader which codec to use
+#   0x08                 set if the payload was a unicode string, utf-8 encoded before compression
+#
+# BlobData values are validated as utf-8, which compressed bytes hardly ever are, hence the base64. pycassa
+# returns the values as unicode, the whole encoded blob is ascii.
+#
+# Bytes 0x10-0x1F are control characters that hardly ever start a text blob, hence blobs stored before
+# compression was introduced (or small blobs stored as-is) are still returned untouched. The ones that do,
+# ie. ANSI coloured log lines starting with ESC (0x1B), are returned untouched too: their payload is no
+# base64, or does not decode.
+HEADER_MARKER = 0x10
+HEADER_MARKER_MASK = 0xF0
+HEADER_TEXT_FLAG = 0x08
+HEADER_CODEC_ID_MASK = 0x07
+
+DEFAULT_COMPRESSION_THRESHOLD = 4*1024  # 4 kB
+DEFAULT_CHUNK_SIZE = 512*1024           # 512 kB, well below the default thrift frame size
+DEFAULT_MAX_CHUNKS = 100                # Same as MAX_BLOB_COLUMN_COUNT, ie. one row-read fetches the whole blob
+
+BASE64_PAYLOAD = re.compile('^[A-Za-z0-9+/]*={0,2}$')
+
+
+class BlobTooLargeException(Exception):
+    pass
+
+
+class UnknownBlobCodecException(Exception):
+    pass
+
+
+# Stores the payload as-is, used for blobs that must be chunked but would not gain from compression
+class IdentityBlobCodec():
+    codec_id = 0
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+
+class ZlibBlobCodec():
+    codec_id = 1
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+# Codecs a reader knows how to decode, keyed by the codec_id found in the header byte
+registered_blob_codecs = {IdentityBlobCodec.codec_id: IdentityBlobCodec(),
+                          ZlibBlobCodec.codec_id: ZlibBlobCodec(),
+                          }
+
+
+# Plug in your own codec, it needs a codec_id (0-7) and a compress() and decompress() method
+def register_blob_codec(codec):
+    if codec.codec_id < 0 or codec.codec_id > HEADER_CODEC_ID_MASK:
+        raise UnknownBlobCodecException('Codec id must be within 0-%s, got %s' % (HEADER_CODEC_ID_MASK, codec.codec_id))
+    registered_blob_codecs[codec.codec_id] = codec
+
+
+def is_encoded_blob(data):
+    if not isinstance(data, basestring) or len(data) == 0:
+        return False
+    return (ord(data[0]) & HEADER_MARKER_MASK) == HEADER_MARKER
+
+
+# Turns a blob value into the columns to store in a BlobData row, and back again.
+#
+# Blobs smaller than compression_threshold are stored as they are, so the common case of short
+# log lines costs nothing extra. Set codec=None to disable compression, blobs larger than chunk_size
+# are still chunked then.
+class BlobSerializer():
+
+    def __init__(self, codec=ZlibBlobCodec(), compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, chunk_size=DEFAULT_CHUNK_SIZE, max_chunks=DEFAULT_MAX_CHUNKS):
+        self.codec = codec
+        self.compression_threshold = compression_threshold
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+
+    def __encode(self, data_value):
+        is_text = isinstance(data_value, unicode)
+        if is_text:
+            raw = data_value.encode('utf-8')
+        else:
+            raw = data_value
+
+        codec = None
+        payload = None
+        if self.codec and len(raw) >= self.compression_threshold:
+            compressed = base64.b64encode(self.codec.compress(raw))
+            # Don't bother if the codec did not gain us anything (already compressed data, images etc)
+            if len(compressed) < len(raw):
+                codec = self.codec
+                payload = compressed
+
+        if codec is None:
+            if len(raw) <= self.chunk_size and not is_encoded_blob(raw):
+                # Store as-is, readable by any version of pycats
+                return None
+            codec = registered_blob_codecs[IdentityBlobCodec.codec_id]
+            payload = base64.b64encode(raw)
+
+        header = HEADER_MARKER | codec.codec_id
+        if is_text:
+            header |= HEADER_TEXT_FLAG
+        return chr(header) + payload
+
+    # Returns a dict of {column_name : column_value} to insert into the BlobData row
+    def to_columns(self, timestamp, data_value):
+        if not isinstance(data_value, basestring):
+            return {timestamp : data_value}
+
+        encoded = self.__encode(data_value)
+        if encoded is None:
+            return {timestamp : data_value}
+
+        chunk_count = (len(encoded) + self.chunk_size - 1) / self.chunk_size
+        if chunk_count > self.max_chunks:
+            raise BlobTooLargeException('Blob of %s bytes needs %s chunks, maximum is %s' % (len(encoded), chunk_count, self.max_chunks))
+
+        columns = dict()
+        for i in range(0, chunk_count):
+            # The timestamp comparator has millisecond precision, hence one chunk per millisecond
+            columns[timestamp + timedelta(milliseconds=i)] = encoded[i*self.chunk_size:(i+1)*self.chunk_size]
+        return columns
+
+    def decode(self, data):
+        if not is_encoded_blob(data):
+            # Legacy or small blob, stored as-is
+            return data
+        try:
+            return self.__decode(data)
+        except (UnicodeError, TypeError, zlib.error, UnknownBlobCodecException):
+            # Legacy blob that merely starts with a control character
+            return data
+
+    def __decode(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('ascii')
+        payload = data[1:]
+        if len(payload) % 4 != 0 or not BASE64_PAYLOAD.match(payload):
+            # b64decode skips characters that are not base64, check them first
+            raise TypeError('Not a base64 payload')
+
+        header = ord(data[0])
+        codec_id = header & HEADER_CODEC_ID_MASK
+        codec = registered_blob_codecs.get(codec_id, None)
+        if codec is None:
+            raise UnknownBlobCodecException('No codec registered for codec id %s' % codec_id)
+
+        raw = codec.decompress(base64.b64decode(payload))
+        if header & HEADER_TEXT_FLAG:
+            return raw.decode('utf-8')
+        return raw
+
+    # Takes a BlobData row as loaded by pycassa and returns (timestamp, data_value)
+    def from_columns(self, columns):
+        items = columns.items()
+        timestamp = items[0][0]
+        if len(items) == 1:
+            data = items[0][1]
+        else:
+            data = ''.join([value for (column_name, value) in items])
+        return (timestamp, self.decode(data))
+
+    # Same as from_columns, but keeps the row format of a pycassa load
+    def from_columns_as_dict(self, columns):
+        (timestamp, data_value) = self.from_columns(columns)
+        return OrderedDict([(timestamp, data_value)])
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+import itertools
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PICOS_PER_MICRO = 10**6
+# Writers with different node ids never produce the same column name
+MAX_NODE_ID = 998
+COUNTER_PERIOD = 1000
+# Suffixes of a writer without a node id, all of 1-999999
+RANDOM_COUNTER_PERIOD = PICOS_PER_MICRO - 1
+# Below this many timestamps the bulk variant isn't worth the round trip through NumPy
+NUMPY_THRESHOLD = 64
+
+
+# Column names of the time-series CF are the picoseconds since the start of the hour. Python datetimes
+# only go down to microseconds, the sub-microsecond part (1-999999) is free to tell apart data points
+# written within the same microsecond. The loaders floor it away again.
+#
+# With a node_id the sub-microsecond suffix is node_id * 1000 + a per process counter (mod 1000) + 1, so
+# names are unique within a process until more than 1000 points of a series land in the same microsecond,
+# and across processes as long as they run with different node ids. Give every writer process its own
+# node id (0-998) to rule out collisions.
+#
+# Without a node_id the counter runs over all of 1-999999 from a random start, so two processes only
+# overwrite each other when their counters happen to line up within the same microsecond, no more likely
+# than with a random suffix per point.
+class ColumnNameGenerator():
+
+    def __init__(self, node_id=None):
+        if node_id is None:
+            self.__period = RANDOM_COUNTER_PERIOD
+            self.__node_offset = 1
+            # Not the random module state, forked writers share that
+            start = random.SystemRandom().randrange(RANDOM_COUNTER_PERIOD)
+        elif node_id < 0 or node_id > MAX_NODE_ID:
+            raise ValueError('node_id must be within 0-%s, got %s' % (MAX_NODE_ID, node_id))
+        else:
+            self.__period = COUNTER_PERIOD
+            self.__node_offset = node_id * COUNTER_PERIOD + 1
+            start = 0
+        self.node_id = node_id
+        # Taking values from an itertools.count is atomic under the GIL, no lock needed
+        self.__counter = itertools.count(start)
+
+    def next_suffix(self):
+        return self.__node_offset + next(self.__counter) % self.__period
+
+    def column_name(self, timestamp):
+        return micros_since_start_of_hour(timestamp) * PICOS_PER_MICRO + self.next_suffix()
+
+    # Same as [column_name(timestamp) for timestamp in timestamps], in one go
+    def column_names(self, timestamps):
+        # Inlined micros_since_start_of_hour, this is the hot loop of a bulk insert
+        micros = [(timestamp.minute * 60 + timestamp.second) * 10**6 + timestamp.microsecond for timestamp in timestamps]
+        counters = list(itertools.islice(self.__counter, len(micros)))
+        if numpy is not None and len(micros) >= NUMPY_THRESHOLD:
+            suffixes = numpy.array(counters, dtype=numpy.int64) % self.__period + self.__node_offset
+            return (numpy.array(micros, dtype=numpy.int64) * PICOS_PER_MICRO + suffixes).tolist()
+        (node_offset, period) = (self.__node_offset, self.__period)
+        return [m * PICOS_PER_MICRO + node_offset + counter % period for (m, counter) in zip(micros, counters)]
+
+
+def micros_since_start_of_hour(timestamp):
+    return (timestamp.minute * 60 + timestamp.second) * 10**6 + timestamp.microsecond
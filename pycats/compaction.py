@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+from datetime import datetime, timedelta
+import threading
+import time
+
+# Seconds between two rounds
+DEFAULT_INTERVAL = 60.0
+# Windows are packed once they ended this long ago, leaves time for late writes
+DEFAULT_LAG = timedelta(minutes=5)
+DEFAULT_JOB_NAME = 'compaction'
+DEFAULT_MAX_SHARDS_PER_SECOND = 10.0
+
+
+# Packs the closed windows of packed_blocks metrics in the background, see TimeSeriesCassandraDao.pack_hourly_shard.
+#
+# series is a list of (source_id, metric_name), or a function returning one (ie. built from list_series()).
+# Every round packs, per series, the hours since the previous round, up to the windows that ended lag ago.
+# The first round starts at the previous hour. Failed hours are tried again the next round.
+#
+# Give each series a single packer: a BlockCompactor in one process, and no CompactionJob on the series while
+# it runs. Packers that overlap don't lose points (see pack_hourly_shard) but read and rewrite the same shards.
+class BlockCompactor():
+
+    def __init__(self, pycats_dao, series, interval=DEFAULT_INTERVAL, lag=DEFAULT_LAG, clock=datetime.utcnow):
+        self.dao = pycats_dao
+        self.series = series
+        self.interval = interval
+        self.lag = lag
+        self.clock = clock
+        self.packed_columns = 0
+        self.errors = 0
+        self.last_error = None
+        self.__next_hours = dict()
+        self.__stopped = threading.Event()
+        self.__worker = None
+
+    def __series(self):
+        if callable(self.series):
+            return self.series()
+        return self.series
+
+    # Packs what has closed since the previous round, returns the number of columns packed
+    def run_once(self):
+        closed_before = self.clock() - self.lag
+        last_hour = self.dao.floor_timestamp_to_hour(closed_before)
+        packed_columns = 0
+        for (source_id, metric_name) in self.__series():
+            hour = self.__next_hours.get((source_id, metric_name), last_hour - timedelta(hours=1))
+            while hour <= last_hour:
+                try:
+                    packed_columns += self.dao.pack_hourly_shard(source_id, metric_name, hour, closed_before)
+                except Exception as e:
+                    self.errors += 1
+                    self.last_error = e
+                    break
+                # The last hour is packed again next round, its later windows are not closed yet
+                self.__next_hours[(source_id, metric_name)] = hour
+                hour += timedelta(hours=1)
+        self.packed_columns += packed_columns
+        return packed_columns
+
+    def __run(self):
+        while not self.__stopped.wait(self.interval):
+            self.run_once()
+
+    def start(self):
+        self.__stopped.clear()
+        self.__worker = threading.Thread(target=self.__run, name='pycats-block-compactor')
+        self.__worker.daemon = True
+        self.__worker.start()
+
+    def stop(self, timeout=None):
+        self.__stopped.set()
+        if self.__worker is not None:
+            self.__worker.join(timeout)
+            self.__worker = None
+
+
+# Spaces calls to acquire() at least 1 / rate seconds apart
+class RateLimiter():
+
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.interval = 1.0 / rate
+        self.clock = clock
+        self.sleep = sleep
+        self.__next = None
+
+    def acquire(self):
+        now = self.clock()
+        if self.__next is not None and now < self.__next:
+            self.sleep(self.__next - now)
+            now = self.__next
+        self.__next = now + self.interval
+
+
+# Compacts the closed hours of a set of series from start_datetime on (up to end_datetime), see
+# TimeSeriesCassandraDao.compact_hourly_shard.
+# Where the BlockCompactor keeps up with new data, this is for rewriting history, at a pace and time of day
+# that suits the cluster. Only series of packed_blocks metrics are compacted, the others are skipped.
+#
+# Shards are compacted at most max_shards_per_second, and only during allowed_hours (UTC hours of the day,
+# ie. range(1, 6) for the night) if given. After each shard its hour is saved as the checkpoint of the series
+# under the name of the job, a job started again with the same name carries on from there. Compacting a shard
+# again is harmless, so a crash between compacting and saving the checkpoint costs nothing but a re-read.
+#
+# A shard that fails is tried again the next run, the other series carry on.
+#
+# Packed columns keep the TTLs of the columns they replace. Like the BlockCompactor, run a single job per
+# series, and not on the hours a BlockCompactor keeps up with: end_datetime stops the job at the hour a
+# compactor started (only hours before it are compacted).
+class CompactionJob():
+
+    def __init__(self, pycats_dao, series, start_datetime, end_datetime=None, name=DEFAULT_JOB_NAME, max_shards_per_second=DEFAULT_MAX_SHARDS_PER_SECOND, allowed_hours=None, interval=DEFAULT_INTERVAL, clock=datetime.utcnow, sleep=None):
+        self.dao = pycats_dao
+        self.series = series
+        self.start_datetime = pycats_dao.floor_timestamp_to_hour(start_datetime)
+        self.end_datetime = pycats_dao.floor_timestamp_to_hour(end_datetime) if end_datetime is not None else None
+        self.name = name
+        self.allowed_hours = set(allowed_hours) if allowed_hours is not None else None
+        self.interval = interval
+        self.clock = clock
+        self.shards = 0
+        self.columns = 0
+        self.errors = 0
+        self.last_error = None
+        self.__stopped = threading.Event()
+        self.__rate_limiter = RateLimiter(max_shards_per_second, sleep=sleep or self.__stopped.wait)
+        self.__worker = None
+
+    def __series(self):
+        if callable(self.series):
+            return self.series()
+        return self.series
+
+    def __may_run(self):
+        if self.__stopped.is_set():
+            return False
+        return self.allowed_hours is None or self.clock().hour in self.allowed_hours
+
+    # Compacts closed hours until all series are done, the job is stopped or allowed_hours are over, or max_shards
+    # shards are compacted. Returns the number of shards compacted
+    def run(self, max_shards=None):
+        checkpoints = self.dao.load_job_checkpoints(self.name)
+        shards = 0
+        for (source_id, metric_name) in self.__series():
+            if metric_name not in self.dao.packed_blocks:
+                continue
+            checkpoint = checkpoints.get((source_id, metric_name), None)
+            hour = checkpoint + timedelta(hours=1) if checkpoint is not None else self.start_datetime
+            while self.dao.is_closed_hour(hour) and (self.end_datetime is None or hour < self.end_datetime):
+                if not self.__may_run() or (max_shards is not None and shards >= max_shards):
+                    return shards
+                self.__rate_limiter.acquire()
+                try:
+                    self.columns += self.dao.compact_hourly_shard(source_id, metric_name, hour)
+                    self.dao.save_job_checkpoint(self.name, source_id, metric_name, hour)
+                except Exception as e:
+                    self.errors += 1
+                    self.last_error = e
+                    break
+                shards += 1
+                self.shards += 1
+                hour += timedelta(hours=1)
+        return shards
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            self.run()
+            self.__stopped.wait(self.interval)
+
+    def start(self):
+        self.__stopped.clear()
+        self.__worker = threading.Thread(target=self.__run, name='pycats-compaction-job')
+        self.__worker.daemon = True
+        self.__worker.start()
+
+    def stop(self, timeout=None):
+        self.__stopped.set()
+        if self.__worker is not None:
+            self.__worker.join(timeout)
+            self.__worker = None
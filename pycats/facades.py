@@ -1,5 +1,14 @@
 
 from models import TimestampedDataDTO
+import logrecords
+import tail
+from datetime import datetime, timedelta
+import atexit
+import logging
+import Queue
+import threading
+import time
+import weakref
 
 # Thin facade to the pycats dao. Purpose is to show off how to use the TimeSeriesCassandraDao
 # for something useful and make a clean API for a common case PyCats was designed for.
@@ -49,16 +58,19 @@ class CassandraLogger():
         self.ttl_secs_for_source_context    = seconds_per_day * ttl_days_for_source_context
         self.ttl_secs_for_global_context    = seconds_per_day * ttl_days_for_global_context
 
+        self.tail_hub = tail.TailHub(pycats_dao)
+
         if levels_for_source:
             self.levels_for_source_context = levels_for_source
         if levels_for_global:
             self.levels_for_global_context = levels_for_global
 
+    # Messages are stored as binary records, see logrecords. Pipe delimited messages from earlier versions are still read
     def _external_to_internal_message(self, source_context, log_source, level, message):
-        return u'%s|%s|%s|%s' % (source_context, log_source, level, message)
+        return logrecords.encode_log_record(source_context, log_source, level, message)
 
     def _internal_message_to_list(self, message):
-        return message.split('|')
+        return logrecords.decode_log_record(message)
 
     def _build_pycats_source_id(self, source_context, log_source):
         return source_context+'.'+log_source
@@ -78,11 +90,23 @@ class CassandraLogger():
     # source_context offers a higher level of grouping. if you dont need that level
     # just provide a string that all calls shares, such as 'app'. It could be used
     # for concepts such as projects, namespaces, user groups, companys etc
+    #
+    # Returns the DTO stored on the exact source and level (None if the level is not in levels_for_exact), and
+    # so do info, warn, error and debug. NOTE the BufferedCassandraLogger writes later and returns True, or
+    # False if the record was dropped, there is no DTO yet. Code that needs the DTO uses a CassandraLogger
     def log(self, source_context, log_source, timestamp, level, message):
 
         if level not in self.supported_log_levels:
             raise UnsupportedLogLevelException('Unsupported log level \'%s\'' % level)
 
+        (dto_source_and_level, dtos_by_ttl) = self._build_log_dtos(source_context, log_source, timestamp, level, message)
+        self._store(dtos_by_ttl)
+
+        return dto_source_and_level
+
+    # Returns the copy stored on the exact source and level, and all copies grouped by TTL
+    def _build_log_dtos(self, source_context, log_source, timestamp, level, message):
+
         # We do this to keep source_id and level tightly coupled, since we also store on a global-tag
         # and a level-independent tag
         internal_message = self._external_to_internal_message(source_context, log_source, level, message)
@@ -115,28 +139,29 @@ class CassandraLogger():
             # ... load logs globally independent of level
             dto_global_and_any =  TimestampedDataDTO(GLOBAL_CONTEXT, timestamp, ANY_LEVEL, internal_message, message)
 
-        # If same TTL, store with one call
-        if self.ttl_secs_for_exact == self.ttl_secs_for_source_context and self.ttl_secs_for_exact == self.ttl_secs_for_global_context:
-            self.dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes([dto_source_and_level, dto_source_and_any, dto_context_and_level, dto_context_and_any, dto_global_and_level, dto_global_and_any], self.ttl_secs_for_exact)
-        else:
-            # i know.. could check if first pair has same ttl as third, and third as second
-            self.dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes([dto_source_and_level, dto_source_and_any], self.ttl_secs_for_exact)
-            self.dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes([dto_context_and_level, dto_context_and_any], self.ttl_secs_for_source_context)
-            self.dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes([dto_global_and_level, dto_global_and_any], self.ttl_secs_for_global_context)
+        # Copies with the same TTL are stored with one call
+        dtos_by_ttl = self._group_by_ttl([dto_source_and_level, dto_source_and_any], [dto_context_and_level, dto_context_and_any], [dto_global_and_level, dto_global_and_any])
 
-        return dto_source_and_level
+        return (dto_source_and_level, dtos_by_ttl)
+
+    def _group_by_ttl(self, exact_dtos, source_context_dtos, global_context_dtos):
+        dtos_by_ttl = dict()
+        dtos_by_ttl.setdefault(self.ttl_secs_for_exact, list()).extend(exact_dtos)
+        dtos_by_ttl.setdefault(self.ttl_secs_for_source_context, list()).extend(source_context_dtos)
+        dtos_by_ttl.setdefault(self.ttl_secs_for_global_context, list()).extend(global_context_dtos)
+        return dtos_by_ttl
+
+    # Writes the copies of a log message in one go whatever the TTLs are, None-entries are filtered out by the DAO
+    def _store(self, dtos_by_ttl):
+        self.dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes_by_ttl(dtos_by_ttl)
 
     # Note, if log_source is provided a source_context must also be provided
     #
     # start_date and end_date can always be provided
-    def __load(self, free_text=None, source_context=None, log_source=None, level=None, start_date=None, end_date=None, max_count=100):
-
+    def __source_id_and_data_name(self, source_context, log_source, level):
         if log_source and not source_context:
             raise LogLoadingArgumentErrorException('If log source is specified, a source context must also be provided.')
 
-        if not free_text and not start_date and not end_date:
-            raise LogLoadingArgumentErrorException('Neither free text, nor time-span was supplied.')
-
         if level:
             data_name = self.ext_level_to_internal[level]
         else:
@@ -149,11 +174,23 @@ class CassandraLogger():
         else:
             source_id = GLOBAL_CONTEXT
 
+        return (source_id, data_name)
+
+    def __load(self, free_text=None, source_context=None, log_source=None, level=None, start_date=None, end_date=None, max_count=100, newest_first=False):
+
+        if not free_text and not start_date and not end_date:
+            raise LogLoadingArgumentErrorException('Neither free text, nor time-span was supplied.')
+
+        (source_id, data_name) = self.__source_id_and_data_name(source_context, log_source, level)
+
         if free_text:
-            list_of_tuples = self.dao.get_blobs_by_free_text_index(source_id, data_name, free_text, start_date, end_date, True, max_count)
+            list_of_tuples = self.dao.get_blobs_by_free_text_index(source_id, data_name, free_text, start_date, end_date, True, max_count, newest_first)
         else:
             list_of_tuples = self.dao.get_timetamped_data_range(source_id, data_name, start_date, end_date, max_count)
 
+        return self._tuples_to_log_messages(list_of_tuples)
+
+    def _tuples_to_log_messages(self, list_of_tuples):
         result = list()
 
         # Note how we store an internal message string that needs to be split
@@ -163,22 +200,257 @@ class CassandraLogger():
             l = self._internal_message_to_list(message)
             result.append(LogMessageDTO(l[0],l[1],timestamp,l[2],l[3]))
 
-        # Should be ordered by ascending time
+        # Should be ordered by ascending time, or descending for the newest_first searches
         return result
 
-    def free_text_search(self, free_text=None, source_context=None, log_source=None, level=None, start_date=None, end_date=None, max_count=100):
-        return self.__load(free_text, source_context, log_source, level, start_date, end_date, max_count)
+    # With newest_first=True the max_count latest matching messages are returned, newest first, ie. the latest
+    # errors mentioning a timeout. The index is read backwards from end_date and the search stops at max_count hits
+    def free_text_search(self, free_text=None, source_context=None, log_source=None, level=None, start_date=None, end_date=None, max_count=100, newest_first=False):
+        return self.__load(free_text, source_context, log_source, level, start_date, end_date, max_count, newest_first)
 
     def load_by_date_range(self, source_context=None, log_source=None, level=None, start_date=None, end_date=None, max_count=100):
         return self.__load(free_text=None, source_context=source_context, log_source=log_source, level=level, start_date=start_date, end_date=end_date, max_count=max_count)
 
+    # Only (timestamp, level) of each message, ie. for plotting the activity. The messages are not decoded
+    def load_levels_by_date_range(self, source_context=None, log_source=None, level=None, start_date=None, end_date=None, max_count=100):
+        (source_id, data_name) = self.__source_id_and_data_name(source_context, log_source, level)
+        list_of_tuples = self.dao.get_timetamped_data_range(source_id, data_name, start_date, end_date, max_count)
+        return [(timestamp, logrecords.peek_level(message)) for (timestamp, message) in list_of_tuples]
+
+    # Number of messages matching the free text, only the index is read
+    def free_text_count(self, free_text, source_context=None, log_source=None, level=None, start_date=None, end_date=None, max_count=None):
+        (source_id, data_name) = self.__source_id_and_data_name(source_context, log_source, level)
+        return self.dao.count_by_free_text_index(source_id, data_name, free_text, start_date, end_date, max_count)
+
+    # Number of messages matching the free text per bucket_size, [(bucket start, count)], ie. for a hits per hour
+    # chart next to the search result. Only the index (or the hit counters) is read, see
+    # TimeSeriesCassandraDao.histogram_by_free_text_index
+    def free_text_histogram(self, free_text, source_context=None, log_source=None, level=None, start_date=None, end_date=None, bucket_size=timedelta(hours=1)):
+        if not start_date:
+            raise LogLoadingArgumentErrorException('A histogram needs a start date.')
+        (source_id, data_name) = self.__source_id_and_data_name(source_context, log_source, level)
+        return self.dao.histogram_by_free_text_index(source_id, data_name, free_text, start_date, end_date, bucket_size)
+
+    # Same as free_text_search but only the requested page of LogMessageDTOs is loaded, pages are numbered from 0
+    def free_text_search_page(self, free_text, page_number=0, page_size=20, source_context=None, log_source=None, level=None, start_date=None, end_date=None, max_count=100, newest_first=False):
+        (source_id, data_name) = self.__source_id_and_data_name(source_context, log_source, level)
+        lazy_result = self.dao.search_blobs_by_free_text_index(source_id, data_name, free_text, start_date, end_date, True, max_count, newest_first=newest_first)
+        return self._tuples_to_log_messages(lazy_result.page(page_number, page_size))
+
+    # Live tail of the log, returns a follower whose poll() returns the LogMessageDTOs written since the last
+    # poll. Only the columns written since the last read are fetched, and followers of the same context and
+    # level share the reads. Give start_date (UTC) to start in the past instead of from now on.
+    #
+    # Call close() on the follower when done.
+    def follow(self, source_context=None, log_source=None, level=None, start_date=None):
+        (source_id, data_name) = self.__source_id_and_data_name(source_context, log_source, level)
+        return self.tail_hub.follow(source_id, data_name, start_date, self._tuples_to_log_messages)
+
+# Buffer overflow policies for the BufferedCassandraLogger
+BLOCK = 'block'
+DROP = 'drop'
+
+# BufferedCassandraLoggers to close at interpreter exit, weak so a closed logger can be collected
+_loggers_to_close = weakref.WeakSet()
+
+
+def _close_loggers():
+    for logger in list(_loggers_to_close):
+        logger.close()
+
+atexit.register(_close_loggers)
+
+# A CassandraLogger that never writes on the callers thread.
+#
+# Log records are put on a bounded queue and written by a background worker, the caller only checks
+# the level. The worker takes whatever has queued up (up to max_batch_size records), builds the copies
+# of each record, groups the copies of all records by TTL and writes each group with one DAO call.
+# Hence, the more that is logged, the larger the batches get. The worker lingers (seconds) after the
+# first record of a batch to let more records queue up.
+#
+# When the queue is full the record is either dropped (overflow_policy=DROP) or the caller waits for
+# room (overflow_policy=BLOCK, for at most block_timeout seconds if given, then it is dropped).
+#
+# Call flush() to wait for everything logged so far to be written and close() to stop the worker. close()
+# is called at interpreter exit unless flush_on_exit=False. The worker keeps the logger alive until closed.
+class BufferedCassandraLogger(CassandraLogger):
+
+    __STOP = object()
+
+    def __init__(self, pycats_dao, max_queue_size=10000, max_batch_size=1000, linger=0.05, overflow_policy=BLOCK, block_timeout=None, flush_on_exit=True, **kwargs):
+        CassandraLogger.__init__(self, pycats_dao, **kwargs)
+        if overflow_policy not in (BLOCK, DROP):
+            raise ValueError('Unsupported overflow policy \'%s\'' % overflow_policy)
+
+        self.max_batch_size = max_batch_size
+        self.linger = linger
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.dropped_records = 0
+        self.failed_records = 0
+        self.written_records = 0
+        self.last_error = None
+
+        self.__queue = Queue.Queue(max_queue_size)
+        self.__closed = False
+        self.__close_lock = threading.Lock()
+        self.__worker = threading.Thread(target=self.__run, name='pycats-log-writer')
+        self.__worker.daemon = True
+        self.__worker.start()
+
+        if flush_on_exit:
+            _loggers_to_close.add(self)
+
+    # Returns right away, the message is written later by the worker. Returns True instead of the DTO of
+    # CassandraLogger.log, or False if the record was dropped
+    def log(self, source_context, log_source, timestamp, level, message):
+        if level not in self.supported_log_levels:
+            raise UnsupportedLogLevelException('Unsupported log level \'%s\'' % level)
+
+        record = (source_context, log_source, timestamp, level, message)
+        # Under the close lock, so nothing is queued behind the stop of the worker. A blocked put holds up
+        # close() until the worker made room
+        with self.__close_lock:
+            if self.__closed:
+                raise LoggerClosedException('Logger is closed')
+            try:
+                if self.overflow_policy == DROP:
+                    self.__queue.put_nowait(record)
+                else:
+                    self.__queue.put(record, True, self.block_timeout)
+            except Queue.Full:
+                self.dropped_records += 1
+                return False
+        return True
+
+    def __run(self):
+        while True:
+            records = [self.__queue.get()]
+            if self.linger and records[0] is not self.__STOP and self.__queue.qsize() < self.max_batch_size:
+                # Give the batch a moment to fill up, fewer and larger writes
+                time.sleep(self.linger)
+            while len(records) < self.max_batch_size and records[-1] is not self.__STOP:
+                try:
+                    records.append(self.__queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            stop = records[-1] is self.__STOP
+            if stop:
+                records.pop()
+            self.__write(records)
+
+            for i in range(0, len(records) + (1 if stop else 0)):
+                self.__queue.task_done()
+            if stop:
+                return
+
+    def __write(self, records):
+        try:
+            dtos_by_ttl = dict()
+            for record in records:
+                (dto_source_and_level, record_dtos_by_ttl) = self._build_log_dtos(*record)
+                for (ttl, dtos) in record_dtos_by_ttl.items():
+                    dtos_by_ttl.setdefault(ttl, list()).extend(dtos)
+
+            self._store(dtos_by_ttl)
+            self.written_records += len(records)
+        except Exception as e:
+            # Logging must never take the application down, keep track and go on
+            self.failed_records += len(records)
+            self.last_error = e
+
+    # Blocks until all records logged so far are written (or have failed)
+    def flush(self):
+        self.__queue.join()
+
+    def close(self, timeout=None):
+        with self.__close_lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__queue.put(self.__STOP)
+        _loggers_to_close.discard(self)
+        self.__worker.join(timeout)
+
+    def queued_records(self):
+        return self.__queue.qsize()
+
+# Bridge from the standard logging module into a CassandraLogger, ie:
+#
+#   logging.getLogger('billing').addHandler(CassandraLogHandler(BufferedCassandraLogger(dao)))
+#
+# Logger names are mapped onto source_context and log_source by splitting on the first dot, 'billing.invoices'
+# logs to source context 'billing' with log source 'invoices'. Give source_context to log everything within
+# one context using the full logger name as log source, or name_mapping (a callable taking the logger name
+# and returning (source_context, log_source)) for anything else. CRITICAL is stored as 'error' and
+# WARNING as 'warn'.
+#
+# Use it with a BufferedCassandraLogger, emit() then only formats the record and puts it on the queue,
+# and the records are batched by the workers write cycles. Prefer overflow_policy=DROP for that logger,
+# the logging module serializes emit() calls per handler so one blocked emit() holds up every thread.
+class CassandraLogHandler(logging.Handler):
+
+    def __init__(self, cassandra_logger, source_context=None, name_mapping=None, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.cassandra_logger = cassandra_logger
+        self.source_context = source_context
+        self.name_mapping = name_mapping
+        self.__mapped_names = dict()
+
+    def map_name(self, logger_name):
+        mapped = self.__mapped_names.get(logger_name, None)
+        if mapped is None:
+            if self.name_mapping:
+                mapped = self.name_mapping(logger_name)
+            elif self.source_context:
+                mapped = (self.source_context, logger_name)
+            else:
+                parts = logger_name.split('.', 1)
+                mapped = (parts[0], parts[-1])
+            # Logger names are few, map each of them once
+            self.__mapped_names[logger_name] = mapped
+        return mapped
+
+    def map_level(self, levelno):
+        if levelno >= logging.ERROR:
+            return 'error'
+        elif levelno >= logging.WARNING:
+            return 'warn'
+        elif levelno >= logging.INFO:
+            return 'info'
+        return 'debug'
+
+    def emit(self, record):
+        try:
+            (source_context, log_source) = self.map_name(record.name)
+            timestamp = datetime.utcfromtimestamp(record.created)
+            if self.formatter is None and not record.exc_info:
+                # Fast path, the default formatter would only return the message anyway
+                message = record.getMessage()
+            else:
+                message = self.format(record)
+            self.cassandra_logger.log(source_context, log_source, timestamp, self.map_level(record.levelno), message)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        flush = getattr(self.cassandra_logger, 'flush', None)
+        if flush:
+            flush()
+
 class UnsupportedLogLevelException(Exception):
     pass
 
 class LogLoadingArgumentErrorException(Exception):
     pass
 
-class LogMessageDTO():
+class LoggerClosedException(Exception):
+    pass
+
+class LogMessageDTO(object):
+    __slots__ = ('source_context', 'log_source', 'timestamp', 'level', 'message')
+
     def __init__(self, source_context, log_source, timestamp, level, message):
         self.source_context = source_context
         self.log_source = log_source
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 __author__ = 'hans'
 
-from models import BlobIndexDTO
+from models import BlobIndexDTO, TimestampedBatch, BlobIndexBatch
 import string
 import re
 import pytz
@@ -42,15 +42,22 @@ class StringIndexer():
                 result.add(' '.join(current_words))
         return result
 
+    def __substrings_for(self, data_value, str_for_index):
+        if str_for_index:
+            indexable_string = self.strip_and_lower(str_for_index)
+        else:
+            indexable_string = self.strip_and_lower(data_value)
+        return self._build_substrings(indexable_string, self.index_depth)
+
     # idea: could add flag to run the loop again but with ommited source_id and/or dataname to
     # return double and tripple amount of keys to make a global search available
+    #
+    # Given a TimestampedBatch (and a list of row keys, or None) the indexes are returned as a BlobIndexBatch
     def build_indexes_from_timstamped_dto(self, dto, blob_data_row_key):
-        if dto.str_for_index:
-            indexable_string = self.strip_and_lower(dto.str_for_index)
-        else:
-            indexable_string = self.strip_and_lower(dto.data_value)
+        if isinstance(dto, TimestampedBatch):
+            return self.build_index_batch(dto, blob_data_row_key)
 
-        substrings = self._build_substrings(indexable_string, self.index_depth)
+        substrings = self.__substrings_for(dto.data_value, dto.str_for_index)
 
         index_dtos = []
         for substring in substrings:
@@ -59,6 +66,22 @@ class StringIndexer():
 
         return index_dtos
 
+    # Same as build_indexes_from_timstamped_dto for every entry of a TimestampedBatch, without creating any DTOs.
+    # The blob row keys default to where the DAO stores the blobs of the batch
+    def build_index_batch(self, timestamped_batch, blob_data_row_keys=None):
+        if blob_data_row_keys is None:
+            blob_data_row_keys = timestamped_batch.row_keys_for_blob_data()
+
+        index_batch = BlobIndexBatch()
+        for i in xrange(0, len(timestamped_batch)):
+            source_id = timestamped_batch.source_ids[i]
+            data_name = timestamped_batch.data_names[i]
+            timestamp = timestamped_batch.timestamps[i]
+            blob_data_row_key = blob_data_row_keys[i]
+            for substring in self.__substrings_for(timestamped_batch.data_values[i], timestamped_batch.strs_for_index[i]):
+                index_batch.append(source_id, data_name, substring, timestamp, blob_data_row_key)
+        return index_batch
+
     def __datetime_to_utc(self, a_datetime):
         if a_datetime.tzinfo:
             # Convert to UTC if timezone info
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+import threading
+import time
+
+# Seconds a LatestData row is served from the cache
+DEFAULT_TTL = 5.0
+# Sources cached, the expired ones are dropped (and all of them if that is not enough) when there are more
+DEFAULT_MAX_SOURCES = 100000
+TIMESTAMP_SUFFIX = '-ts'
+
+
+# Names of the latest data columns of data_names, the value and its timestamp
+def latest_data_column_names(data_names):
+    column_names = list()
+    for data_name in data_names:
+        column_names.append(data_name)
+        column_names.append(data_name + TIMESTAMP_SUFFIX)
+    return column_names
+
+
+# Short lived in-process cache of LatestData rows, see TimeSeriesCassandraDao(latest_data_cache_ttl=...).
+#
+# A row may be cached partially, only the data_names that were read (or written) through the cache. A read of
+# other data_names is a miss. Sources without data are cached as well, as empty rows.
+#
+# Writes of the process update the cached rows right away, without extending their TTL. Writes of other
+# processes show once the rows expire, after at most ttl seconds.
+#
+# Every update() and invalidate() takes the next write version. Readers take version() before they read and
+# pass it to put(), rows of sources written since are not cached, they may be older than the write.
+class LatestDataCache():
+
+    def __init__(self, ttl=DEFAULT_TTL, max_sources=DEFAULT_MAX_SOURCES, clock=time.time):
+        self.ttl = ttl
+        self.max_sources = max_sources
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        # source_id -> [expires, columns, data_names read or None for the whole row]
+        self.__entries = dict()
+        # source_id -> write version of its last write, sources forgotten were written at the floor at most
+        self.__written = dict()
+        self.__written_floor = 0
+        self.__version = 0
+        self.__lock = threading.Lock()
+
+    # The write version to pass to put() for rows read from now on
+    def version(self):
+        with self.__lock:
+            return self.__version
+
+    # Returns the cached columns of data_names (the whole row for None), or None if they are not all cached
+    def get(self, source_id, data_names=None):
+        with self.__lock:
+            entry = self.__entries.get(source_id, None)
+            if entry is None or entry[0] <= self.clock() or not self.__covers(entry[2], data_names):
+                self.misses += 1
+                return None
+            self.hits += 1
+            columns = entry[1]
+            if data_names is None:
+                return dict(columns)
+            return dict([(column_name, columns[column_name]) for column_name in latest_data_column_names(data_names) if column_name in columns])
+
+    def __covers(self, cached_data_names, data_names):
+        if cached_data_names is None:
+            return True
+        if data_names is None:
+            return False
+        return cached_data_names.issuperset(data_names)
+
+    # Caches the columns of data_names (the whole row for None) as read from Cassandra, unless the source was
+    # written after the version() taken before the read. Returns False if the columns were not cached
+    def put(self, source_id, columns, data_names=None, version=None):
+        with self.__lock:
+            if version is not None and self.__written.get(source_id, self.__written_floor) > version:
+                return False
+            now = self.clock()
+            entry = self.__entries.get(source_id, None)
+            if data_names is None or entry is None or entry[0] <= now:
+                self.__make_room()
+                self.__entries[source_id] = [now + self.ttl, dict(columns), set(data_names) if data_names is not None else None]
+                return True
+            for column_name in latest_data_column_names(data_names):
+                entry[1].pop(column_name, None)
+            entry[1].update(columns)
+            if entry[2] is not None:
+                entry[2].update(data_names)
+            return True
+
+    # Write-through of columns written to the row of source_id, ie. create_insert_dict_for_latest_data()
+    def update(self, source_id, columns):
+        data_names = [column_name for column_name in columns.keys() if not column_name.endswith(TIMESTAMP_SUFFIX)]
+        with self.__lock:
+            self.__written_by(source_id)
+            entry = self.__entries.get(source_id, None)
+            if entry is None or entry[0] <= self.clock():
+                self.__make_room()
+                self.__entries[source_id] = [self.clock() + self.ttl, dict(columns), set(data_names)]
+                return
+            entry[1].update(columns)
+            if entry[2] is not None:
+                entry[2].update(data_names)
+
+    # Forgets source_id, or everything
+    def invalidate(self, source_id=None):
+        with self.__lock:
+            if source_id is None:
+                self.__entries = dict()
+                self.__version += 1
+                self.__written = dict()
+                self.__written_floor = self.__version
+            else:
+                self.__written_by(source_id)
+                self.__entries.pop(source_id, None)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    # Called with the lock held
+    def __written_by(self, source_id):
+        self.__version += 1
+        if len(self.__written) >= self.max_sources:
+            self.__written = dict()
+            self.__written_floor = self.__version - 1
+        self.__written[source_id] = self.__version
+
+    # Called with the lock held
+    def __make_room(self):
+        if len(self.__entries) < self.max_sources:
+            return
+        now = self.clock()
+        for (source_id, entry) in self.__entries.items():
+            if entry[0] <= now:
+                del self.__entries[source_id]
+        if len(self.__entries) >= self.max_sources:
+            self.__entries = dict()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+import struct
+
+# Encoding of the log messages stored by the CassandraLogger.
+#
+# A record is a short header followed by the utf-8 encoded fields:
+#
+#   marker (0x00) | version | level code | len(source_context),len(log_source),len(message): | fields...
+#       1 byte       1 byte     1 byte        decimal byte lengths, comma separated, ended by a colon
+#
+# The level sits at a fixed offset and the header gives the offset of every field, so a single field can be
+# read without decoding the rest of the record. The timestamp is not part of the record, it is the column
+# name the record is stored under.
+#
+# The columns the records are stored in are validated as utf-8, hence the lengths are text. Version 1 records
+# had them as big-endian binary, which Cassandra only accepted for some lengths, the ones it did accept are
+# still decoded. pycassa returns the records as unicode, they are utf-8 encoded again to apply the lengths.
+#
+# Records written before this encoding are pipe delimited strings, they never start with the marker and
+# are still decoded.
+
+MARKER = '\x00'
+VERSION = 2
+
+# Version 1 header
+BINARY_HEADER = struct.Struct('>cBBHHI')
+LEVEL_OFFSET = 2
+LENGTHS_OFFSET = 3
+
+LEVEL_CODES = {'info': 1,
+               'warn': 2,
+               'error': 3,
+               'debug': 4,
+               }
+LEVELS_BY_CODE = dict([(code, level) for (level, code) in LEVEL_CODES.items()])
+
+
+class UnknownLogRecordVersionException(Exception):
+    pass
+
+
+def _to_utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, str):
+        return value
+    return unicode(value).encode('utf-8')
+
+
+def is_log_record(data):
+    return len(data) > 0 and data[0] == MARKER
+
+
+def encode_log_record(source_context, log_source, level, message):
+    source_context = _to_utf8(source_context)
+    log_source = _to_utf8(log_source)
+    message = _to_utf8(message)
+    header = '%s%s%s%d,%d,%d:' % (MARKER, chr(VERSION), chr(LEVEL_CODES[level]), len(source_context), len(log_source), len(message))
+    return ''.join((header, source_context, log_source, message))
+
+
+# Reads only the level, falls back on decoding legacy records
+def peek_level(data):
+    if is_log_record(data):
+        return LEVELS_BY_CODE[ord(data[LEVEL_OFFSET])]
+    return decode_log_record(data)[2]
+
+
+# Returns [source_context, log_source, level, message]
+def decode_log_record(data):
+    if not is_log_record(data):
+        # Legacy pipe delimited record, a message may well contain pipes itself
+        return data.split('|', 3)
+
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    version = ord(data[1])
+    if version == VERSION:
+        lengths_end = data.index(':', LENGTHS_OFFSET)
+        (source_context_length, log_source_length, message_length) = [int(length) for length in data[LENGTHS_OFFSET:lengths_end].split(',')]
+        offset = lengths_end + 1
+    elif version == 1:
+        (source_context_length, log_source_length, message_length) = BINARY_HEADER.unpack_from(data)[3:]
+        offset = BINARY_HEADER.size
+    else:
+        raise UnknownLogRecordVersionException('Unknown log record version %s' % version)
+    level_code = ord(data[LEVEL_OFFSET])
+
+    source_context = data[offset:offset+source_context_length].decode('utf-8')
+    offset += source_context_length
+    log_source = data[offset:offset+log_source_length].decode('utf-8')
+    offset += log_source_length
+    message = data[offset:offset+message_length].decode('utf-8')
+    return [source_context, log_source, LEVELS_BY_CODE[level_code], message]
@@ -1,16 +1,79 @@
 import pytz
 from datetime import datetime, timedelta
-import random
 import calendar
 
-class TimestampedDataDTO():
+# Thousands of data points land in the same hour, the hour part of the row keys and the epoch of the
+# hour are computed once per hour and shared by every DTO and batch
+HOUR_CACHE_SIZE = 10000
+_hour_cache = dict()
+
+# Returns (time part of the hourly row key, epoch seconds of the hour) for a UTC datetime
+def _hour_bucket(utc_timestamp):
+    key = (utc_timestamp.year, utc_timestamp.month, utc_timestamp.day, utc_timestamp.hour)
+    bucket = _hour_cache.get(key, None)
+    if bucket is None:
+        if len(_hour_cache) >= HOUR_CACHE_SIZE:
+            _hour_cache.clear()
+        bucket = ('%04d%02d%02d%02d' % key, calendar.timegm(key + (0, 0)))
+        _hour_cache[key] = bucket
+    return bucket
+
+def _as_utc(timestamp):
+    if timestamp.tzinfo:
+        return timestamp.astimezone(pytz.utc)
+    else:
+        return timestamp
+
+def _unix_time_millis(utc_timestamp):
+    return long(_hour_bucket(utc_timestamp)[1] * 1000 + (utc_timestamp.minute * 60 + utc_timestamp.second) * 1000 + utc_timestamp.microsecond / 1000)
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+# The UTC timestamp, epoch millis and row keys are computed once per DTO, changing the source_id,
+# data_name or timestamp clears them
+class TimestampedDataDTO(object):
+    __slots__ = ('_source_id', '_timestamp', '_data_name', 'data_value', 'str_for_index', '_utc', '_millis', '_row_key_prefix')
+
     # In case data_value cant be indexed, it will force the indexer to use str_for_index as base for index
     def __init__(self, source_id, timestamp, data_name, data_value, str_for_index=None):
-        self.source_id = source_id
-        self.timestamp = timestamp
-        self.data_name = data_name
+        self._source_id = source_id
+        self._timestamp = timestamp
+        self._data_name = data_name
         self.data_value = data_value            # Will be put as data payload
         self.str_for_index = str_for_index      # Will be used as base for index if set
+        self._utc = None
+        self._millis = None
+        self._row_key_prefix = None
+
+    def __get_source_id(self):
+        return self._source_id
+
+    def __set_source_id(self, source_id):
+        self._source_id = source_id
+        self._row_key_prefix = None
+
+    def __get_data_name(self):
+        return self._data_name
+
+    def __set_data_name(self, data_name):
+        self._data_name = data_name
+        self._row_key_prefix = None
+
+    def __get_timestamp(self):
+        return self._timestamp
+
+    def __set_timestamp(self, timestamp):
+        self._timestamp = timestamp
+        self._utc = None
+        self._millis = None
+
+    source_id = property(__get_source_id, __set_source_id)
+    data_name = property(__get_data_name, __set_data_name)
+    timestamp = property(__get_timestamp, __set_timestamp)
 
     @staticmethod
     def generate_source_id(namespace, uid):
@@ -19,46 +82,181 @@ class TimestampedDataDTO():
     def get_row_key_for_latest(self):
         return self.source_id
 
+    def __get_row_key_prefix(self):
+        if self._row_key_prefix is None:
+            self._row_key_prefix = str(self._source_id+'-'+self._data_name+'-')
+        return self._row_key_prefix
+
     def get_row_key_for_hourly(self):
-        time_part = self.timestamp_as_utc().strftime('%Y%m%d%H')
-        return str(self.source_id+'-'+self.data_name+'-'+time_part)
+        return self.__get_row_key_prefix() + _hour_bucket(self.timestamp_as_utc())[0]
 
     # A nice hash for the data would be better
     def get_row_key_for_blob_data(self):
-        time_part = str(self.timestamp_as_unix_time_millis())
-        return str(self.source_id+'-'+self.data_name+'-'+time_part)
+        return self.__get_row_key_prefix() + str(self.timestamp_as_unix_time_millis())
 
     def timestamp_as_utc(self):
-        if self.timestamp.tzinfo:
-            return self.timestamp.astimezone(pytz.utc)
-        else:
-            return self.timestamp
+        if self._utc is None:
+            self._utc = _as_utc(self._timestamp)
+        return self._utc
 
     def timestamp_as_unix_time_millis(self):
-        dt = self.timestamp_as_utc()
-        return long(calendar.timegm(dt.utctimetuple())*1e3 + dt.microsecond/1e3)
-        #return long(time.mktime(dt.timetuple())*1e3 + dt.microsecond/1e3)
+        if self._millis is None:
+            self._millis = _unix_time_millis(self.timestamp_as_utc())
+        return self._millis
 
     def __unicode__(self):
         return u'%s from %s : %s=%s' % (self.timestamp, self.source_id, self.data_name, self.data_value)
 
-class BlobIndexDTO():
+# There is one of these per n-gram of an indexed text, keep them light. The row key is computed once, so
+# don't change the fields once it has been used
+class BlobIndexDTO(object):
+    __slots__ = ('source_id', 'data_name', 'free_text', 'timestamp', 'blob_data_row_key', '_row_key')
+
     def __init__(self, source_id, data_name, free_text, timestamp, blob_data_row_key):
         self.source_id = source_id
         self.data_name = data_name
         self.free_text = free_text
         self.timestamp = timestamp
         self.blob_data_row_key = blob_data_row_key
+        self._row_key = None
 
     def get_row_key(self):
-        u = u'%s-%s-%s' % (self.source_id, self.data_name, self.free_text.decode('utf-8'))
-        return u.encode('utf-8')
+        if self._row_key is None:
+            self._row_key = _utf8(self.source_id) + '-' + _utf8(self.data_name) + '-' + _utf8(self.free_text)
+        return self._row_key
 
     def timestamp_as_utc(self):
-        if self.timestamp.tzinfo:
-            return self.timestamp.astimezone (pytz.utc)
-        else:
-            return self.timestamp
+        return _as_utc(self.timestamp)
 
     def __unicode__(self):
         return u'%s => %s' % (self.get_row_key(), self.blob_data_row_key)
+
+# A hit in the BlobDataIndex, ie. where to find the blob without loading it
+class BlobIndexHitDTO(object):
+    __slots__ = ('timestamp', 'blob_data_row_key')
+
+    def __init__(self, timestamp, blob_data_row_key):
+        self.timestamp = timestamp
+        self.blob_data_row_key = blob_data_row_key
+
+    def __unicode__(self):
+        return u'%s => %s' % (self.timestamp, self.blob_data_row_key)
+
+
+# A series in the SeriesCatalog, first_seen and last_seen are the (UTC) hours of the first and last data point
+class SeriesInfoDTO(object):
+    __slots__ = ('source_id', 'data_name', 'first_seen', 'last_seen', 'point_count')
+
+    def __init__(self, source_id, data_name, first_seen, last_seen, point_count):
+        self.source_id = source_id
+        self.data_name = data_name
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.point_count = point_count
+
+    def __unicode__(self):
+        return u'%s %s: %s points from %s to %s' % (self.source_id, self.data_name, self.point_count, self.first_seen, self.last_seen)
+
+# Many TimestampedDataDTOs stored column-wise, one list per field instead of one object per data point.
+#
+# Accepted by the batch insert methods of the TimeSeriesCassandraDao and by StringIndexer, which then never
+# create any per data point objects. Indexing and iterating still hand out TimestampedDataDTOs, created on
+# demand, for code that expects them.
+class TimestampedBatch(object):
+    __slots__ = ('source_ids', 'timestamps', 'data_names', 'data_values', 'strs_for_index', '_utc')
+
+    def __init__(self, dtos=None):
+        self.source_ids = list()
+        self.timestamps = list()
+        self.data_names = list()
+        self.data_values = list()
+        self.strs_for_index = list()
+        self._utc = None
+        if dtos:
+            for dto in dtos:
+                if dto is not None:
+                    self.append(dto.source_id, dto.timestamp, dto.data_name, dto.data_value, dto.str_for_index)
+
+    def append(self, source_id, timestamp, data_name, data_value, str_for_index=None):
+        self.source_ids.append(source_id)
+        self.timestamps.append(timestamp)
+        self.data_names.append(data_name)
+        self.data_values.append(data_value)
+        self.strs_for_index.append(str_for_index)
+        self._utc = None
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, i):
+        return TimestampedDataDTO(self.source_ids[i], self.timestamps[i], self.data_names[i], self.data_values[i], self.strs_for_index[i])
+
+    def __iter__(self):
+        for i in xrange(0, len(self.timestamps)):
+            yield self[i]
+
+    def timestamps_as_utc(self):
+        if self._utc is None:
+            self._utc = [_as_utc(timestamp) for timestamp in self.timestamps]
+        return self._utc
+
+    # Row key prefixes are built once per series in the batch
+    def __row_key_prefixes(self):
+        prefixes = dict()
+        result = list()
+        for (source_id, data_name) in zip(self.source_ids, self.data_names):
+            prefix = prefixes.get((source_id, data_name), None)
+            if prefix is None:
+                prefix = str(source_id+'-'+data_name+'-')
+                prefixes[(source_id, data_name)] = prefix
+            result.append(prefix)
+        return result
+
+    def row_keys_for_hourly(self):
+        return [prefix + _hour_bucket(timestamp)[0] for (prefix, timestamp) in zip(self.__row_key_prefixes(), self.timestamps_as_utc())]
+
+    def row_keys_for_blob_data(self):
+        return [prefix + str(_unix_time_millis(timestamp)) for (prefix, timestamp) in zip(self.__row_key_prefixes(), self.timestamps_as_utc())]
+
+
+# The BlobIndexDTOs of a TimestampedBatch stored column-wise, see StringIndexer.build_index_batch
+class BlobIndexBatch(object):
+    __slots__ = ('source_ids', 'data_names', 'free_texts', 'timestamps', 'blob_data_row_keys')
+
+    def __init__(self):
+        self.source_ids = list()
+        self.data_names = list()
+        self.free_texts = list()
+        self.timestamps = list()
+        self.blob_data_row_keys = list()
+
+    def append(self, source_id, data_name, free_text, timestamp, blob_data_row_key):
+        self.source_ids.append(source_id)
+        self.data_names.append(data_name)
+        self.free_texts.append(free_text)
+        self.timestamps.append(timestamp)
+        self.blob_data_row_keys.append(blob_data_row_key)
+
+    def __len__(self):
+        return len(self.free_texts)
+
+    def __getitem__(self, i):
+        return BlobIndexDTO(self.source_ids[i], self.data_names[i], self.free_texts[i], self.timestamps[i], self.blob_data_row_keys[i])
+
+    def __iter__(self):
+        for i in xrange(0, len(self.free_texts)):
+            yield self[i]
+
+    def row_keys(self):
+        prefixes = dict()
+        result = list()
+        for (source_id, data_name, free_text) in zip(self.source_ids, self.data_names, self.free_texts):
+            prefix = prefixes.get((source_id, data_name), None)
+            if prefix is None:
+                prefix = _utf8(source_id) + '-' + _utf8(data_name) + '-'
+                prefixes[(source_id, data_name)] = prefix
+            result.append(prefix + _utf8(free_text))
+        return result
+
+    def timestamps_as_utc(self):
+        return [_as_utc(timestamp) for timestamp in self.timestamps]
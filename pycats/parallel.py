@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+from multiprocessing.pool import ThreadPool
+import threading
+
+# Issues independent reads (one per index row, shard etc) in parallel on a small thread pool.
+#
+# pycassa's ConnectionPool is thread safe and hands each thread its own connection, so there is
+# no point in having more workers than connections in the pool, they would only queue up on it.
+#
+# Don't call map() from within a function that is itself running on the reader, it would deadlock
+# once all workers wait for each other.
+class ParallelReader():
+
+    def __init__(self, max_workers=5):
+        self.max_workers = max_workers
+        self.__thread_pool = None
+        self.__lock = threading.Lock()
+
+    def __get_thread_pool(self):
+        # Created on first use, a DAO that never fans out never starts any threads
+        with self.__lock:
+            if self.__thread_pool is None:
+                self.__thread_pool = ThreadPool(self.max_workers)
+            return self.__thread_pool
+
+    # Returns [func(item) for item in items], in the order of the items
+    def map(self, func, items):
+        items = list(items)
+        if len(items) <= 1 or self.max_workers <= 1:
+            return [func(item) for item in items]
+        return self.__get_thread_pool().map(func, items)
+
+    def close(self):
+        with self.__lock:
+            if self.__thread_pool is not None:
+                self.__thread_pool.close()
+                self.__thread_pool.join()
+                self.__thread_pool = None
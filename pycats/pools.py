@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+import pycassa
+from pycassa.pool import PoolListener
+import random
+import threading
+import time
+
+# Weight of the latest sample in the per host moving average
+LATENCY_SMOOTHING = 0.2
+# A failed request counts as a request this slow (seconds) for the host
+FAILURE_LATENCY_PENALTY = 1.0
+# Share of new connections that are routed round-robin, so slow hosts get a chance to prove they got better
+DEFAULT_EXPLORATION = 0.1
+# Getting a connection slower than this (seconds) counts as a wait on the pool
+DEFAULT_WAIT_THRESHOLD = 0.001
+
+
+# Collects statistics for a ConnectionPool: checkouts, waits, overflow, failures and the latency of each host.
+#
+# The latency of a host is the time a connection to it is checked out, which for pycassa is the time of
+# one request since ColumnFamily checks out a connection per call.
+class PoolStats(PoolListener):
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.overflow_checkouts = 0
+        self.peak_overflow = 0
+        self.failures = 0
+        self.pool_at_max_count = 0
+        self.host_latencies = dict()
+        self.host_failures = dict()
+        self.__checkout_times = dict()
+
+    def __record_latency(self, server, latency):
+        last = self.host_latencies.get(server, None)
+        if last is None:
+            self.host_latencies[server] = latency
+        else:
+            self.host_latencies[server] = (1 - LATENCY_SMOOTHING) * last + LATENCY_SMOOTHING * latency
+
+    def record_wait(self, waited):
+        with self.__lock:
+            self.waits += 1
+            self.wait_time += waited
+
+    def connection_checked_out(self, dic):
+        pool = dic['connection']._pool
+        overflow = pool.overflow()
+        with self.__lock:
+            self.checkouts += 1
+            if overflow > 0:
+                self.overflow_checkouts += 1
+                self.peak_overflow = max(self.peak_overflow, overflow)
+            self.__checkout_times[id(dic['connection'])] = time.time()
+
+    def connection_checked_in(self, dic):
+        connection = dic['connection']
+        with self.__lock:
+            self.checkins += 1
+            checkout_time = self.__checkout_times.pop(id(connection), None)
+            if checkout_time is not None:
+                self.__record_latency(connection.server, time.time() - checkout_time)
+
+    # Connections that are closed or replaced while checked out never come back, forget them
+    def connection_disposed(self, dic):
+        with self.__lock:
+            self.__checkout_times.pop(id(dic['connection']), None)
+
+    def connection_recycled(self, dic):
+        with self.__lock:
+            self.__checkout_times.pop(id(dic['old_conn']), None)
+
+    def connection_failed(self, dic):
+        server = dic['server']
+        with self.__lock:
+            self.failures += 1
+            self.host_failures[server] = self.host_failures.get(server, 0) + 1
+            self.__record_latency(server, FAILURE_LATENCY_PENALTY)
+
+    # A listener method, the counter is pool_at_max_count
+    def pool_at_max(self, dic):
+        with self.__lock:
+            self.pool_at_max_count += 1
+
+    # Hosts without samples come first, so every host gets measured
+    def fastest_server(self, server_list):
+        with self.__lock:
+            latencies = [(self.host_latencies.get(server, -1), server) for server in server_list]
+        if len(latencies) == 0:
+            return None
+        return min(latencies)[1]
+
+    def as_dict(self):
+        with self.__lock:
+            return {'checkouts': self.checkouts,
+                    'checkins': self.checkins,
+                    'waits': self.waits,
+                    'wait_time': self.wait_time,
+                    'overflow_checkouts': self.overflow_checkouts,
+                    'peak_overflow': self.peak_overflow,
+                    'failures': self.failures,
+                    'pool_at_max_count': self.pool_at_max_count,
+                    'host_latencies': dict(self.host_latencies),
+                    'host_failures': dict(self.host_failures),
+                    }
+
+
+# A pycassa ConnectionPool that keeps PoolStats, grows with demand and prefers the fastest hosts.
+#
+# Sizing: pool_size connections are kept open, under concurrent demand up to max_overflow more are opened
+# and closed again when returned, ie. the pool follows the demand. max_overflow defaults to pool_size.
+#
+# Routing: new connections go to the host with the lowest latency, except for a share (exploration) that
+# is routed round-robin. Connections are replaced every `recycle` operations, so lower recycle to re-route
+# existing connections more often.
+class ManagedConnectionPool(pycassa.ConnectionPool):
+
+    def __init__(self, keyspace, server_list, pool_size=5, max_overflow=None, prefill=True, latency_routing=True, exploration=DEFAULT_EXPLORATION, wait_threshold=DEFAULT_WAIT_THRESHOLD, **kwargs):
+        # Must be set before the base class starts to create connections
+        self.stats = PoolStats()
+        self.latency_routing = latency_routing
+        self.exploration = exploration
+        self.wait_threshold = wait_threshold
+
+        if max_overflow is None:
+            max_overflow = pool_size
+        listeners = list(kwargs.pop('listeners', []))
+        listeners.append(self.stats)
+        pycassa.ConnectionPool.__init__(self, keyspace, server_list, pool_size=pool_size, prefill=prefill, max_overflow=max_overflow, listeners=listeners, **kwargs)
+
+    def get(self):
+        start = time.time()
+        connection = pycassa.ConnectionPool.get(self)
+        waited = time.time() - start
+        if waited > self.wait_threshold:
+            self.stats.record_wait(waited)
+        return connection
+
+    def _get_next_server(self):
+        if self.latency_routing and len(self.server_list) > 1 and random.random() >= self.exploration:
+            server = self.stats.fastest_server(self.server_list)
+            if server is not None:
+                return server
+        return pycassa.ConnectionPool._get_next_server(self)
+
+    def get_stats(self):
+        stats = self.stats.as_dict()
+        stats['size'] = self.size()
+        stats['max_overflow'] = self.max_overflow
+        stats['checked_in'] = self.checkedin()
+        stats['checked_out'] = self.checkedout()
+        stats['overflow'] = self.overflow()
+        return stats
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+import ctypes
+import threading
+import traceback
+import Queue
+
+# Columns per slot, pages of a shard are at most this long
+DEFAULT_SLOT_CAPACITY = 10000
+# Bytes of values per slot, pages with longer values are pickled to the worker instead
+DEFAULT_SLOT_BYTES = 32 * DEFAULT_SLOT_CAPACITY
+
+
+class ShardDecodeException(Exception):
+    pass
+
+
+# The slots as seen by a worker process, set by _init_worker
+_slots = None
+
+
+def _init_worker(slots):
+    global _slots
+    _slots = slots
+
+
+def _run_in_slot(function, slot_id, count, data_length, values, text, args):
+    try:
+        (offsets_buffer, lengths_buffer, data_buffer) = _slots[slot_id]
+        offsets = offsets_buffer[:count]
+        if values is None:
+            data = ctypes.string_at(ctypes.addressof(data_buffer), data_length)
+            if text:
+                # The lengths are in characters
+                data = data.decode('utf-8')
+            values = list()
+            position = 0
+            for length in lengths_buffer[:count]:
+                values.append(data[position:position + length])
+                position += length
+        return (slot_id, function(offsets, values, *args), None)
+    except Exception:
+        return (slot_id, None, traceback.format_exc())
+
+
+# The result of a page handed to a ShardDecoderPool
+class PendingShard():
+
+    def __init__(self, callback, release):
+        self.__callback = callback
+        self.__release = release
+        self.__done = threading.Event()
+        self.result = None
+        self.error = None
+
+    # Called on the result thread of the process pool
+    def _set(self, slot_id_result_and_error):
+        (slot_id, result, self.error) = slot_id_result_and_error
+        self.__release(slot_id)
+        if self.error is None and self.__callback is not None:
+            try:
+                self.__callback(result)
+            except Exception:
+                self.error = traceback.format_exc()
+        elif self.__callback is None:
+            self.result = result
+        self.__done.set()
+
+    # Waits for the result, raises ShardDecodeException if the function (or the callback) failed
+    def get(self, timeout=None):
+        if not self.__done.wait(timeout):
+            raise ShardDecodeException('No result within %s seconds' % timeout)
+        if self.error is not None:
+            raise ShardDecodeException(self.error)
+        return self.result
+
+
+# Decodes and aggregates shard pages on a pool of processes, so the CPU bound part of a large read is not
+# held up by the GIL. See aggregation.SeriesAggregator and TimeSeriesCassandraDao.get_timetamped_data_range_arrays.
+#
+# The pages are not pickled to the workers. Each slot is a set of shared memory buffers, column names, value
+# lengths and the values back to back, that a page is copied into before a worker picks it up. Only the slot
+# id travels through the pipe, and the (compact) result on the way back. Pages of unicode values, as pycassa
+# returns them, are copied utf-8 encoded and decoded again by the worker. Pages with values that are neither
+# all str nor all unicode, or that don't fit the slot, are pickled instead, see inline_pages.
+#
+# There are two slots per process by default, submit() blocks while all of them are in use, which keeps
+# the readers from running far ahead of the workers.
+class ShardDecoderPool():
+
+    def __init__(self, processes=None, slots=None, slot_capacity=DEFAULT_SLOT_CAPACITY, slot_bytes=DEFAULT_SLOT_BYTES):
+        self.processes = processes or cpu_count()
+        self.slot_capacity = slot_capacity
+        self.slot_bytes = slot_bytes
+        self.inline_pages = 0
+        # The buffers are created before the pool, the workers inherit them
+        self.__slots = [(RawArray(ctypes.c_longlong, slot_capacity), RawArray(ctypes.c_int, slot_capacity), RawArray(ctypes.c_char, slot_bytes)) for i in range(slots or 2 * self.processes)]
+        self.__free_slots = Queue.Queue()
+        for slot_id in range(len(self.__slots)):
+            self.__free_slots.put(slot_id)
+        self.__pool = Pool(self.processes, _init_worker, (self.__slots,))
+
+    def __release(self, slot_id):
+        self.__free_slots.put(slot_id)
+
+    # Runs function(offsets, values, *args) on a worker, function has to be a module level function. Without
+    # a callback the result is kept on the PendingShard, with one the result is only handed to the callback,
+    # which is called on the result thread of the pool
+    def submit(self, function, offsets, values, args=(), callback=None):
+        count = len(offsets)
+        if count > self.slot_capacity:
+            raise ValueError('A page holds at most %s columns, got %s' % (self.slot_capacity, count))
+
+        data = None
+        text = count > 0 and isinstance(values[0], unicode)
+        try:
+            data = ''.join(values)
+            if text:
+                data = data.encode('utf-8')
+        except (TypeError, UnicodeError):
+            pass
+        if not isinstance(data, str) or len(data) > self.slot_bytes:
+            data = None
+            values = list(values)
+            self.inline_pages += 1
+        else:
+            values = map(len, values)
+
+        slot_id = self.__free_slots.get()
+        (offsets_buffer, lengths_buffer, data_buffer) = self.__slots[slot_id]
+        offsets_buffer[:count] = offsets
+        if data is not None:
+            lengths_buffer[:count] = values
+            values = None
+            ctypes.memmove(data_buffer, data, len(data))
+
+        pending = PendingShard(callback, self.__release)
+        self.__pool.apply_async(_run_in_slot, (function, slot_id, count, len(data or ''), values, text, args), callback=pending._set)
+        return pending
+
+    def close(self):
+        self.__pool.close()
+        self.__pool.join()
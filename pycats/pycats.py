@@ -1,16 +1,52 @@
 # -*- coding: utf-8 -*-
 import pycassa
+import pycassa.batch
 from pycassa.cassandra.ttypes import NotFoundException
 from datetime import datetime, timedelta
-from models import TimestampedDataDTO, BlobIndexDTO
-import random
+from models import TimestampedDataDTO, BlobIndexDTO, BlobIndexHitDTO, TimestampedBatch, BlobIndexBatch, SeriesInfoDTO
+from collections import OrderedDict
+from array import array
+import calendar
+import math
 import pytz
 import indexers
+import blobs
+import search
+import parallel
+import pools
+import columnnames
+import aggregation
+import valuecodecs
+import latest
 import time
 
 MAX_TIME_SERIES_COLUMN_COUNT = 10000
 MAX_INDEX_COLUMN_COUNT = 100
 MAX_BLOB_COLUMN_COUNT = 100
+# Rows per batch_mutate when several column families are written in one go
+MAX_MUTATION_ROWS = 1000
+# Hours known to be marked in the HourPresence CF (or the SeriesCatalog), forgotten (and marked again) when there are more
+MAX_MARKED_HOURS = 100000
+MAX_CATALOG_COLUMN_COUNT = 10000
+# Sources per LatestData multiget, the chunks are read in parallel
+LATEST_DATA_MULTIGET_SIZE = 200
+MAX_LATEST_DATA_COLUMN_COUNT = 10000
+# Index buckets searched back from the end of a search without a start date, see index_bucket
+DEFAULT_INDEX_BUCKET_LOOKBACK = 53
+# Index buckets read per multiget, a search stops reading buckets once it has enough hits
+INDEX_BUCKETS_PER_READ = 8
+
+PICOS_PER_SECOND = 10**12
+HOUR_PICOS = 3600 * PICOS_PER_SECOND
+
+# Row of the SeriesCatalog listing every source_id
+CATALOG_SOURCES_ROW = '__sources__'
+FIRST_SEEN_SUFFIX = '\x00first'
+LAST_SEEN_SUFFIX = '\x00last'
+# First seen is written with a write timestamp that is lower the later the hour, so Cassandra keeps the
+# earliest hour. Kept below current write timestamps (micros since epoch), see SERIES_CATALOG_COLUMN_FAMILY_NAME
+# for what that means for removals
+FIRST_SEEN_TIMESTAMP_BASE = 10**15
 
 CACHE_TTL = 8*60*60 # 8 hours
 # Sorry we are not Y10K compatible, just need something surely beyond anything reasonable
@@ -35,6 +71,10 @@ MAX_TIME = datetime.strptime('2900-01-01T01:59:59', '%Y-%m-%dT%H:%M:%S')
 class TimeSeriesCassandraDao():
 
     #  CREATE COLUMNFAMILY HourlyTimestampedData (KEY ascii PRIMARY KEY) WITH comparator=timestamp;
+    #
+    #  Metrics with a value codec store raw binary values, which needs the values validated as blob:
+    #  ALTER COLUMNFAMILY HourlyTimestampedData WITH default_validation=blob;
+    #  String values are written utf-8 encoded and read back as unicode either way.
     HOURLY_DATA_COLUMN_FAMILY_NAME = 'HourlyTimestampedData'
 
     #  CREATE COLUMNFAMILY LatestData (KEY ascii PRIMARY KEY) WITH comparator=ascii;
@@ -46,49 +86,179 @@ class TimeSeriesCassandraDao():
     # CREATE COLUMNFAMILY BlobDataIndex (KEY text PRIMARY KEY) WITH comparator=timestamp AND default_validation=text;
     BLOB_DATA_INDEX_COLUMN_FAMILY_NAME = 'BlobDataIndex'
 
+    # CREATE COLUMNFAMILY HourPresence (KEY ascii PRIMARY KEY) WITH comparator=ascii;
+    HOUR_PRESENCE_COLUMN_FAMILY_NAME = 'HourPresence'
+
+    # CREATE COLUMNFAMILY SeriesCatalog (KEY ascii PRIMARY KEY) WITH comparator=text;
+    #
+    # WARNING, do not remove SeriesCatalog rows or columns with an ordinary remove() (cqlsh DELETE, pycassa
+    # ColumnFamily.remove, ...). The first and last seen columns are written with made up write timestamps,
+    # first seen 10**15 minus the epoch seconds of the hour and last seen the epoch micros of the hour, all
+    # below the current time. A remove at the current time leaves a tombstone newer than any of them, and
+    # Cassandra drops every later write of those columns, the series is never cataloged again. That lasts
+    # until the tombstone is purged, gc_grace_seconds after the remove and once a compaction has run.
+    #
+    # To take a series out of the catalog remove its two columns with the timestamps they were written with
+    # (get them with include_timestamp=True), and only for a series that is not written any more: a removal
+    # of last seen still drops the writes of hours up to the one removed, of first seen those of hours from
+    # the one removed on. Processes running keep the cataloged hours in memory as well, restart them
+    SERIES_CATALOG_COLUMN_FAMILY_NAME = 'SeriesCatalog'
+
+    # CREATE COLUMNFAMILY SeriesPointCount (KEY ascii PRIMARY KEY) WITH comparator=text AND default_validation=counter;
+    SERIES_POINT_COUNT_COLUMN_FAMILY_NAME = 'SeriesPointCount'
+
+    # CREATE COLUMNFAMILY JobCheckpoints (KEY ascii PRIMARY KEY) WITH comparator=text;
+    JOB_CHECKPOINTS_COLUMN_FAMILY_NAME = 'JobCheckpoints'
+
+    # CREATE COLUMNFAMILY IndexHitCounts (KEY text PRIMARY KEY) WITH comparator=ascii AND default_validation=counter;
+    INDEX_HIT_COUNTS_COLUMN_FAMILY_NAME = 'IndexHitCounts'
+
     # Maybe the dao should be un-aware of the indexer, break out and make it cleaner?
     blob_indexer = None
 
-    # Important: keep the randomizer on in production environments to avoid collisions (overwrites) in the time-series CF to a minimum
-    def __init__(self, cassandra_hosts, key_space, cache=None, warm_up_cache_shards=0, disable_high_res_column_name_randomization=False, index_depth=5, pool_size=5, prefill=True, managed=False):
+    # Important: keep the randomizer on in production environments to avoid collisions (overwrites) in the time-series CF to a minimum.
+    # Give each writing process its own node_id (0-998) to rule them out, without one the suffixes start at a
+    # random point, see columnnames.ColumnNameGenerator
+    #
+    # Large blobs are compressed and chunked by the blob_serializer, pass blobs.BlobSerializer(codec=None) to disable compression
+    #
+    # Reads that fan out (ie. searches over several data_names) use up to max_parallel_reads threads, defaults to pool_size
+    #
+    # Give write_pool_size to get a separate pool for writes, so bulk inserts can't starve the reads. Both pools
+    # may open up to max_overflow (defaults to pool size) extra connections under load and route new connections
+    # to the fastest hosts, see pools.ManagedConnectionPool
+    #
+    # With hour_presence_index=True every hour with time-series data is marked in the HourPresence CF, and range
+    # loads only read the hourly shards that are marked. Only turn it on for series written with it on from the
+    # start, or run backfill_hour_presence() first, otherwise existing data is skipped by the loads.
+    #
+    # With series_catalog=True the time-series writes also keep the SeriesCatalog up to date, see list_sources()
+    # and list_series()
+    #
+    # value_codecs maps data_names to a valuecodecs codec (or its name, 'int64' or 'float64'), the values of
+    # those metrics are stored typed and read back as int or float. Other metrics are stored as passed. The
+    # HourlyTimestampedData CF must be validated as blob, see HOURLY_DATA_COLUMN_FAMILY_NAME
+    #
+    # packed_blocks maps data_names of high frequency metrics to a window (a timedelta that divides an hour).
+    # pack_hourly_shard() (see compaction.BlockCompactor) packs the columns of each closed window into a single
+    # column, the readers unpack them again. Numeric metrics only, packed with their int64 codec or as float64.
+    # Give them a value codec too, so the columns not packed (yet) are read back as numbers as well
+    #
+    # index_bucket (a timedelta of whole hours, ie. a day or a week) splits the BlobDataIndex rows of a word into
+    # one row per bucket of time, 'source_id-data_name-free_text-YYYYMMDDHH' for the bucket starting at that hour
+    # (buckets are aligned on the unix epoch). Rows of common words then stop growing, searches only read the
+    # buckets within their date range, and entries written with a TTL leave whole rows behind to expire. Searches
+    # without a start date read index_bucket_lookback buckets back from the end date (or now), unless
+    # index_bucket_since is given.
+    #
+    # index_bucket_since is the time index buckets were turned on (once all writers have them on, the writers
+    # are expected to be rolled over within a bucket). Searches without a start date then read every bucket
+    # from the one before it on, and searches starting before it also read the rows without a bucket written
+    # until then, as the oldest bucket. Those entries are merged in time order, at the cost of one more row read.
+    # Give it for indexes written without buckets before, or searches miss the older entries
+    #
+    # With index_hit_counts=True the index writes also count the hits of every index row per hour in the
+    # IndexHitCounts CF, see histogram_by_free_text_index()
+    #
+    # latest_data_cache_ttl (seconds) turns on an in-process cache of LatestData rows for load_latest_data_snapshot(),
+    # kept up to date by the latest data writes of this process, see latest.LatestDataCache
+    def __init__(self, cassandra_hosts, key_space, cache=None, warm_up_cache_shards=0, disable_high_res_column_name_randomization=False, index_depth=5, pool_size=5, prefill=True, managed=False, blob_serializer=None, max_parallel_reads=None, write_pool_size=None, max_overflow=None, latency_routing=True, node_id=None, hour_presence_index=False, series_catalog=False, value_codecs=None, packed_blocks=None, index_bucket=None, index_bucket_lookback=DEFAULT_INDEX_BUCKET_LOOKBACK, index_bucket_since=None, index_hit_counts=False, latest_data_cache_ttl=None):
         self.__cassandra_hosts = cassandra_hosts
         self.__key_space = key_space
-        self.__pool = pycassa.ConnectionPool(self.__key_space, self.__cassandra_hosts, pool_size=pool_size, prefill=prefill)
+        self.__pool = pools.ManagedConnectionPool(self.__key_space, self.__cassandra_hosts, pool_size=pool_size, max_overflow=max_overflow, prefill=prefill, latency_routing=latency_routing)
+        if write_pool_size:
+            self.__write_pool = pools.ManagedConnectionPool(self.__key_space, self.__cassandra_hosts, pool_size=write_pool_size, max_overflow=max_overflow, prefill=prefill, latency_routing=latency_routing)
+        else:
+            self.__write_pool = self.__pool
+        self.__column_families = dict()
+        self.pool_size = pool_size
         self.cache = cache
         self.cache_hits = 0
         self.daily_gets = 0
         self.millis = 0
         self.__warm_up_cache_shards = warm_up_cache_shards
         self.blob_indexer = indexers.StringIndexer(index_depth)
+        if blob_serializer is None:
+            blob_serializer = blobs.BlobSerializer()
+        self.blob_serializer = blob_serializer
+        self.parallel_reader = parallel.ParallelReader(max_parallel_reads or pool_size)
         self.disable_high_res_column_name_randomization = disable_high_res_column_name_randomization
+        self.column_name_generator = columnnames.ColumnNameGenerator(node_id)
+        self.hour_presence_index = hour_presence_index
+        self.__marked_hours = set()
+        self.series_catalog = series_catalog
+        self.__cataloged_hours = set()
+        self.__cataloged_sources = set()
+        self.value_codecs = dict([(data_name, valuecodecs.get_value_codec(codec)) for (data_name, codec) in (value_codecs or dict()).items()])
+        self.packed_blocks = dict()
+        for (data_name, window) in (packed_blocks or dict()).items():
+            window_picos = int(window.total_seconds() * PICOS_PER_SECOND)
+            if window_picos <= 0 or HOUR_PICOS % window_picos != 0:
+                raise ValueError('The packed block window of %s must divide an hour, got %s' % (data_name, window))
+            self.packed_blocks[data_name] = window_picos
+        self.index_bucket_seconds = None
+        if index_bucket is not None:
+            self.index_bucket_seconds = int(index_bucket.total_seconds())
+            if self.index_bucket_seconds <= 0 or self.index_bucket_seconds % 3600 != 0:
+                raise ValueError('The index bucket must be a whole number of hours, got %s' % index_bucket)
+        self.index_bucket_lookback = index_bucket_lookback
+        self.index_bucket_since = self.__naive_utc(index_bucket_since) if index_bucket_since is not None else None
+        self.index_hit_counts = index_hit_counts
+        self.latest_data_cache = latest.LatestDataCache(latest_data_cache_ttl) if latest_data_cache_ttl else None
         self.managed = managed
 
     def dispose(self):
+        self.parallel_reader.close()
         self.__pool.dispose()
+        if self.__write_pool is not self.__pool:
+            self.__write_pool.dispose()
+
+    # Checkouts, waits, overflow, failures and per host latencies of the connection pools
+    def get_pool_stats(self):
+        return {'read': self.__pool.get_stats(),
+                'write': self.__write_pool.get_stats(),
+                }
+
+    # Column families are created once per pool, writes go through the write pool
+    def __get_column_family(self, column_family_name, for_write=False):
+        if for_write and self.__write_pool is not self.__pool:
+            key = (column_family_name, True)
+            pool = self.__write_pool
+        else:
+            key = (column_family_name, False)
+            pool = self.__pool
+        column_family = self.__column_families.get(key, None)
+        if column_family is None:
+            column_family = pycassa.ColumnFamily(pool, column_family_name)
+            self.__column_families[key] = column_family
+        return column_family
+
+    def __get_hourly_data_cf(self, for_write=False):
+        return self.__get_column_family(self.HOURLY_DATA_COLUMN_FAMILY_NAME, for_write)
+
+    def __get_latest_data_cf(self, for_write=False):
+        return self.__get_column_family(self.LATEST_DATA_COLUMN_FAMILY_NAME, for_write)
+
+    def __get_blob_data_cf(self, for_write=False):
+        return self.__get_column_family(self.BLOB_DATA_COLUMN_FAMILY_NAME, for_write)
+
+    def __get_blob_data_index_cf(self, for_write=False):
+        return self.__get_column_family(self.BLOB_DATA_INDEX_COLUMN_FAMILY_NAME, for_write)
+
+    def __get_hour_presence_cf(self, for_write=False):
+        return self.__get_column_family(self.HOUR_PRESENCE_COLUMN_FAMILY_NAME, for_write)
 
-    hourly_data_cf = None
-    def __get_hourly_data_cf(self):
-        if self.hourly_data_cf is None:
-            self.hourly_data_cf = pycassa.ColumnFamily(self.__pool, self.HOURLY_DATA_COLUMN_FAMILY_NAME)
-        return self.hourly_data_cf
-
-    latest_data_cf = None
-    def __get_latest_data_cf(self):
-        if self.latest_data_cf is None:
-            self.latest_data_cf = pycassa.ColumnFamily(self.__pool, self.LATEST_DATA_COLUMN_FAMILY_NAME)
-        return self.latest_data_cf
-
-    blob_data_cf = None
-    def __get_blob_data_cf(self):
-        if self.blob_data_cf is None:
-            self.blob_data_cf = pycassa.ColumnFamily(self.__pool, self.BLOB_DATA_COLUMN_FAMILY_NAME)
-        return self.blob_data_cf
-
-    blob_data_index_cf = None
-    def __get_blob_data_index_cf(self):
-        if self.blob_data_index_cf is None:
-            self.blob_data_index_cf = pycassa.ColumnFamily(self.__pool, self.BLOB_DATA_INDEX_COLUMN_FAMILY_NAME)
-        return self.blob_data_index_cf
+    def __get_series_catalog_cf(self, for_write=False):
+        return self.__get_column_family(self.SERIES_CATALOG_COLUMN_FAMILY_NAME, for_write)
+
+    def __get_series_point_count_cf(self, for_write=False):
+        return self.__get_column_family(self.SERIES_POINT_COUNT_COLUMN_FAMILY_NAME, for_write)
+
+    def __get_job_checkpoints_cf(self, for_write=False):
+        return self.__get_column_family(self.JOB_CHECKPOINTS_COLUMN_FAMILY_NAME, for_write)
+
+    def __get_index_hit_counts_cf(self, for_write=False):
+        return self.__get_column_family(self.INDEX_HIT_COUNTS_COLUMN_FAMILY_NAME, for_write)
 
     # Convert datetime object to millisecond precision unix epoch
 #    def __unix_time_millis(self, dt):
@@ -123,18 +293,23 @@ class TimeSeriesCassandraDao():
 
     def __get_picoseconds_since_start_of_hour(self, timestamp):
         # This is as accurate as a python datetime object can be
-        micros_since_start_of_hour = ((timestamp.minute * 60 * 10**6) + (timestamp.second * 10**6) + (timestamp.microsecond))
-        picos_since_start_of_hour = (micros_since_start_of_hour * 10**6)
-        return picos_since_start_of_hour
+        return columnnames.micros_since_start_of_hour(timestamp) * columnnames.PICOS_PER_MICRO
 
     # Call with exact=True from load-part of code
     def get_high_res_column_name(self, timestamp, exact=False):
         if self.disable_high_res_column_name_randomization:
             return self.__get_picoseconds_since_start_of_hour(timestamp)
         else:
-            # Note that the randomization is beyond micro-second precision, so it wont affect the timetamp upon load of data
+            # Note that the suffix is beyond micro-second precision, so it wont affect the timetamp upon load of data
             # Only the value used as column name
-            return self.__get_picoseconds_since_start_of_hour(timestamp) + random.randint(1, 10**6)
+            return self.column_name_generator.column_name(timestamp)
+
+    # Same as get_high_res_column_name for a list of timestamps
+    def get_high_res_column_names(self, timestamps):
+        if self.disable_high_res_column_name_randomization:
+            return [self.__get_picoseconds_since_start_of_hour(timestamp) for timestamp in timestamps]
+        else:
+            return self.column_name_generator.column_names(timestamps)
 
     def highres_to_utc_datetime(self, timestamp_for_start_of_hour, picos_since_start_of_hour):
         micros = (picos_since_start_of_hour / 10**6)
@@ -164,31 +339,57 @@ class TimeSeriesCassandraDao():
         self.batch_insert_indexes(list_of_blob_index_dtos, ttl)
 
     def batch_insert_indexable_text_as_blob_data_and_insert_indexes(self, input_list_of_ts_data_dtos, ttl=None):
-        list_of_ts_data_dtos = list()
-        # 0 filter out unsupported types
-        for obj in input_list_of_ts_data_dtos:
-            if obj is None:
-                continue
-            else:
-               list_of_ts_data_dtos.append(obj)
-        if len(list_of_ts_data_dtos) == 0:
-            # Nothing to do
-            return
-
-        # 1 Batch hit DB
-        self.batch_insert_timestamped_data(list_of_ts_data_dtos, ttl)
-
-        # 2
-        self.batch_insert_blob_data(list_of_ts_data_dtos, ttl)
+        self.batch_insert_indexable_text_as_blob_data_and_insert_indexes_by_ttl({ttl: input_list_of_ts_data_dtos})
 
-        # 3 No DB-hit here, only local work
-        list_of_blob_index_dtos = list()
-        for dto in list_of_ts_data_dtos:
-            # TODO: Hmm.. why pass object and a value that can be fetched from the object.. must be legacy design, rethink?
-            list_of_blob_index_dtos.extend(self.blob_indexer.build_indexes_from_timstamped_dto(dto, dto.get_row_key_for_blob_data()))
+    # Takes a dict of ttl -> list of TimestampedDataDTOs (or a TimestampedBatch), ie. copies of the same text that should live for
+    # different times.
+    #
+    # The time-series, blob and index rows of all TTLs are sent as one batch_mutate, with the TTL set per
+    # row, so the number of round trips doesn't depend on how many TTLs there are. Very large batches are
+    # split every MAX_MUTATION_ROWS rows to keep the thrift frames at a reasonable size.
+    def batch_insert_indexable_text_as_blob_data_and_insert_indexes_by_ttl(self, dtos_by_ttl):
+        mutator = pycassa.batch.Mutator(self.__write_pool, queue_size=MAX_MUTATION_ROWS)
+        hourly_data_cf = self.__get_hourly_data_cf(for_write=True)
+        blob_data_cf = self.__get_blob_data_cf(for_write=True)
+        blob_data_index_cf = self.__get_blob_data_index_cf(for_write=True)
+        series_hours = list()
+        hit_counts = dict() if self.index_hit_counts else None
+
+        for (ttl, input_list_of_ts_data_dtos) in dtos_by_ttl.items():
+            if isinstance(input_list_of_ts_data_dtos, TimestampedBatch):
+                list_of_ts_data_dtos = input_list_of_ts_data_dtos
+            else:
+                # 0 filter out unsupported types
+                list_of_ts_data_dtos = [dto for dto in input_list_of_ts_data_dtos if dto is not None]
+            if len(list_of_ts_data_dtos) == 0:
+                continue
 
-        # 4 batch insert the indexes
-        self.batch_insert_indexes(list_of_blob_index_dtos, ttl)
+            # 1 No DB-hit here, only local work
+            if isinstance(list_of_ts_data_dtos, TimestampedBatch):
+                list_of_blob_index_dtos = self.blob_indexer.build_index_batch(list_of_ts_data_dtos)
+            else:
+                list_of_blob_index_dtos = list()
+                for dto in list_of_ts_data_dtos:
+                    # TODO: Hmm.. why pass object and a value that can be fetched from the object.. must be legacy design, rethink?
+                    list_of_blob_index_dtos.extend(self.blob_indexer.build_indexes_from_timstamped_dto(dto, dto.get_row_key_for_blob_data()))
+
+            # 2 queue up the rows of all three column families
+            series_hours.extend(self.__series_hours(list_of_ts_data_dtos))
+            for (column_family, rows) in ((hourly_data_cf, self.__build_hourly_rows(list_of_ts_data_dtos)),
+                                          (blob_data_cf, self.__build_blob_rows(list_of_ts_data_dtos)),
+                                          (blob_data_index_cf, self.__build_index_rows(list_of_blob_index_dtos, hit_counts))):
+                for (row_key, columns) in rows.iteritems():
+                    mutator.insert(column_family, row_key, columns, ttl=ttl)
+
+        self.__queue_series_bookkeeping(mutator, series_hours)
+        if hit_counts:
+            index_hit_counts_cf = self.__get_index_hit_counts_cf(for_write=True)
+            for (row_key, columns) in hit_counts.iteritems():
+                mutator.insert(index_hit_counts_cf, row_key, columns)
+
+        # 3 One batch hit DB
+        mutator.send()
+        self.__remember_series_bookkeeping(series_hours)
 
     def create_insert_dict_for_latest_data(self, data_name, data_value, timestamp):
         return  {data_name : data_value, data_name+'-ts' : str(timestamp)}
@@ -205,7 +406,7 @@ class TimeSeriesCassandraDao():
         # NOTE: very costly operation
         if verify_timestamp:
             try:
-                last_latest_data = self.load_latest_data(dto.source_id)
+                last_latest_data = self.load_latest_data(dto.source_id, dto.data_name)
                 last_ts = int(last_latest_data[dto.data_name+'-ts'])
             except NotFoundException:
                 # Source did not store any data before
@@ -217,10 +418,15 @@ class TimeSeriesCassandraDao():
                 # could not parse the timestamp, format may have change?
                 last_ts = 0
         if this_ts > last_ts:
-            if batch_dict:
-                batch_dict[dto.source_id] = self.create_insert_dict_for_latest_data(dto.data_name, dto.data_value, this_ts)
+            if batch_dict is not None:
+                # Several data_names of a source, or several values of a data_name, may be in the same batch
+                columns = batch_dict.setdefault(dto.source_id, dict())
+                if int(columns.get(dto.data_name+'-ts', 0)) < this_ts:
+                    columns.update(self.create_insert_dict_for_latest_data(dto.data_name, dto.data_value, this_ts))
             else:
-                self.__get_latest_data_cf().insert(dto.source_id, self.create_insert_dict_for_latest_data(dto.data_name, dto.data_value, this_ts))
+                columns = self.create_insert_dict_for_latest_data(dto.data_name, dto.data_value, this_ts)
+                self.__get_latest_data_cf(for_write=True).insert(dto.source_id, columns)
+                self.__cache_latest_data(dto.source_id, columns)
 
 
     # Will force insert a dictionary of data using UTC now as timestamp
@@ -230,63 +436,340 @@ class TimeSeriesCassandraDao():
         i_dict = dict()
         for data_name in data_dict.keys():
             i_dict.update(self.create_insert_dict_for_latest_data(data_name, data_dict[data_name], timestamp))
-        self.__get_latest_data_cf().insert(source_id, i_dict)
+        self.__get_latest_data_cf(for_write=True).insert(source_id, i_dict)
+        self.__cache_latest_data(source_id, i_dict)
+
+    # Write-through of the latest data written
+    def __cache_latest_data(self, source_id, columns):
+        if self.latest_data_cache is not None:
+            self.latest_data_cache.update(source_id, columns)
 
     def insert_timestamped_data(self, ts_data_dto, ttl=None, set_latest=False):
         # UTF-8 encode?
         column_name = self.get_high_res_column_name(ts_data_dto.timestamp_as_utc())
-        result = self.__get_hourly_data_cf().insert(ts_data_dto.get_row_key_for_hourly(), {column_name : ts_data_dto.data_value}, ttl=ttl)
+        data_value = self.encode_value(ts_data_dto.data_name, ts_data_dto.data_value)
+        result = self.__get_hourly_data_cf(for_write=True).insert(ts_data_dto.get_row_key_for_hourly(), {column_name : data_value}, ttl=ttl)
+        self.__write_series_bookkeeping(self.__series_hours([ts_data_dto]))
         if set_latest:
             self.insert_latest_data(ts_data_dto)
         return result
 
     # Will only insert into the shards
+    #
+    # The batch_insert methods take a list of DTOs or, cheaper for large batches, a TimestampedBatch (and
+    # a BlobIndexBatch for the indexes)
     def batch_insert_timestamped_data(self, list_of_timestamped_data_dtos, ttl=None, set_latest=False):
-        hourly_batch_dict = dict()
-
-        for dto in list_of_timestamped_data_dtos:
-            hourly_shard_row_key = dto.get_row_key_for_hourly()
-            col_name_value_pairs = hourly_batch_dict.get(hourly_shard_row_key, None)
-            if not col_name_value_pairs:
-                col_name_value_pairs = dict()
-            column_name = self.get_high_res_column_name(dto.timestamp_as_utc())
-            col_name_value_pairs[column_name] = dto.data_value
-            hourly_batch_dict[hourly_shard_row_key] = col_name_value_pairs
+        hourly_batch_dict = self.__build_hourly_rows(list_of_timestamped_data_dtos)
 
         latest_batch_dict = dict()
         if set_latest:
             for dto in list_of_timestamped_data_dtos:
                 self.insert_latest_data(dto, verify_timestamp=False, batch_dict=latest_batch_dict)
 
-        self.__get_latest_data_cf().batch_insert(latest_batch_dict)
-        self.__get_hourly_data_cf().batch_insert(hourly_batch_dict, ttl=ttl)
+        if latest_batch_dict:
+            self.__get_latest_data_cf(for_write=True).batch_insert(latest_batch_dict)
+            for (source_id, columns) in latest_batch_dict.items():
+                self.__cache_latest_data(source_id, columns)
+        self.__get_hourly_data_cf(for_write=True).batch_insert(hourly_batch_dict, ttl=ttl)
+        self.__write_series_bookkeeping(self.__series_hours(list_of_timestamped_data_dtos))
 
     def insert_blob_data(self, blob_data_dto, ttl=None):
         row_key = blob_data_dto.get_row_key_for_blob_data()
-        self.__get_blob_data_cf().insert(row_key, {blob_data_dto.timestamp_as_utc() : blob_data_dto.data_value}, ttl=ttl)
+        columns = self.blob_serializer.to_columns(blob_data_dto.timestamp_as_utc(), blob_data_dto.data_value)
+        self.__get_blob_data_cf(for_write=True).insert(row_key, columns, ttl=ttl)
         return row_key
 
     def batch_insert_blob_data(self, list_of_blobs, ttl=None):
-        insert_tuples = dict()
+        self.__get_blob_data_cf(for_write=True).batch_insert(self.__build_blob_rows(list_of_blobs), ttl=ttl)
 
-        for dto in list_of_blobs:
-            blob_data_row_key = dto.get_row_key_for_blob_data()
-            col_name_value_pairs = insert_tuples.get(blob_data_row_key, None)
-            if not col_name_value_pairs:
-                col_name_value_pairs = dict()
-            col_name_value_pairs[dto.timestamp_as_utc()] = dto.data_value
-            insert_tuples[blob_data_row_key] = col_name_value_pairs
+    # Counters have no TTL, the hit counts outlive the index entries they count
+    def batch_insert_indexes(self, index_dtos, ttl=None):
+        hit_counts = dict() if self.index_hit_counts else None
+        self.__get_blob_data_index_cf(for_write=True).batch_insert(self.__build_index_rows(index_dtos, hit_counts), ttl=ttl)
+        if hit_counts:
+            self.__get_index_hit_counts_cf(for_write=True).batch_insert(hit_counts)
+
+    # The value as stored in the time-series CF, encoded by the codec of the metric if it has one, see valuecodecs.
+    # Strings are stored utf-8 encoded, the CF may validate its values as blob
+    def encode_value(self, data_name, data_value):
+        codec = self.value_codecs.get(data_name, None)
+        if codec is None:
+            if isinstance(data_value, unicode):
+                return data_value.encode('utf-8')
+            return data_value
+        return codec.encode(data_value)
+
+    # The __build_*_rows methods turn DTOs, or the column-wise TimestampedBatch and BlobIndexBatch, into
+    # {row_key: {column_name: value}} for batch inserts
+    def __build_hourly_rows(self, list_of_timestamped_data_dtos):
+        if isinstance(list_of_timestamped_data_dtos, TimestampedBatch):
+            batch = list_of_timestamped_data_dtos
+            entries = zip(batch.row_keys_for_hourly(), batch.timestamps_as_utc(), batch.data_values)
+            data_names = batch.data_names
+        else:
+            entries = [(dto.get_row_key_for_hourly(), dto.timestamp_as_utc(), dto.data_value) for dto in list_of_timestamped_data_dtos]
+            data_names = [dto.data_name for dto in list_of_timestamped_data_dtos]
+        if self.value_codecs:
+            entries = [(hourly_shard_row_key, timestamp, self.encode_value(data_name, data_value)) for ((hourly_shard_row_key, timestamp, data_value), data_name) in zip(entries, data_names)]
 
-        self.__get_blob_data_cf().batch_insert(insert_tuples, ttl=ttl)
+        column_names = self.get_high_res_column_names([timestamp for (hourly_shard_row_key, timestamp, data_value) in entries])
+        hourly_batch_dict = dict()
+        for ((hourly_shard_row_key, timestamp, data_value), column_name) in zip(entries, column_names):
+            if isinstance(data_value, unicode):
+                data_value = data_value.encode('utf-8')
+            hourly_batch_dict.setdefault(hourly_shard_row_key, dict())[column_name] = data_value
+        return hourly_batch_dict
+
+    def __build_blob_rows(self, list_of_blobs):
+        if isinstance(list_of_blobs, TimestampedBatch):
+            entries = zip(list_of_blobs.row_keys_for_blob_data(), list_of_blobs.timestamps_as_utc(), list_of_blobs.data_values)
+        else:
+            entries = [(dto.get_row_key_for_blob_data(), dto.timestamp_as_utc(), dto.data_value) for dto in list_of_blobs]
 
-    def batch_insert_indexes(self, index_dtos, ttl=None):
         insert_tuples = dict()
+        for (blob_data_row_key, timestamp, data_value) in entries:
+            # A large blob may be chunked over several columns
+            insert_tuples.setdefault(blob_data_row_key, dict()).update(self.blob_serializer.to_columns(timestamp, data_value))
+        return insert_tuples
+
+    ##
+    ## Series bookkeeping, the HourPresence and SeriesCatalog CFs kept up to date by the time-series writes
+    ##
+    ######################################################
+
+    # Returns (source_id, data_name, hourly_row_key) for every data point, if there is any bookkeeping to do
+    def __series_hours(self, list_of_timestamped_data_dtos):
+        if not self.hour_presence_index and not self.series_catalog:
+            return []
+        if isinstance(list_of_timestamped_data_dtos, TimestampedBatch):
+            batch = list_of_timestamped_data_dtos
+            return zip(batch.source_ids, batch.data_names, batch.row_keys_for_hourly())
+        return [(dto.source_id, dto.data_name, dto.get_row_key_for_hourly()) for dto in list_of_timestamped_data_dtos]
+
+    def __queue_series_bookkeeping(self, mutator, series_hours):
+        if self.hour_presence_index:
+            hour_presence_cf = self.__get_hour_presence_cf(for_write=True)
+            for (row_key, columns) in self.__build_hour_presence_rows(series_hours).iteritems():
+                mutator.insert(hour_presence_cf, row_key, columns)
+        if self.series_catalog:
+            self.__queue_series_catalog(mutator, series_hours)
+
+    # Only once the bookkeeping is written, it is not written again
+    def __remember_series_bookkeeping(self, series_hours):
+        if self.hour_presence_index:
+            if len(self.__marked_hours) > MAX_MARKED_HOURS:
+                self.__marked_hours = set()
+            self.__marked_hours.update([hourly_row_key for (source_id, data_name, hourly_row_key) in series_hours])
+        if self.series_catalog:
+            if len(self.__cataloged_hours) > MAX_MARKED_HOURS:
+                self.__cataloged_hours = set()
+                self.__cataloged_sources = set()
+            self.__cataloged_hours.update([(source_id, data_name, hourly_row_key[-10:]) for (source_id, data_name, hourly_row_key) in series_hours])
+            self.__cataloged_sources.update([source_id for (source_id, data_name, hourly_row_key) in series_hours])
+
+    def __write_series_bookkeeping(self, series_hours):
+        if len(series_hours) == 0:
+            return
+        mutator = pycassa.batch.Mutator(self.__write_pool, queue_size=MAX_MUTATION_ROWS)
+        self.__queue_series_bookkeeping(mutator, series_hours)
+        mutator.send()
+        self.__remember_series_bookkeeping(series_hours)
 
-        for dto in index_dtos:
-            insert_tuples[dto.get_row_key()] = {dto.timestamp_as_utc() : dto.blob_data_row_key}
+    # The hourly row key 'source_id-data_name-YYYYMMDDHH' is marked as column 'YYYYMMDDHH' in the row
+    # 'source_id-data_name-YYYYMM' of HourPresence, one row per series and month.
+    #
+    # Marks are written without TTL, the data of an hour may be written with several TTLs. A mark that
+    # outlives its data costs a read that comes back empty.
+    def __build_hour_presence_rows(self, series_hours):
+        rows = dict()
+        for (source_id, data_name, hourly_row_key) in series_hours:
+            if hourly_row_key not in self.__marked_hours:
+                rows.setdefault(hourly_row_key[:-4], dict())[hourly_row_key[-10:]] = ''
+        return rows
+
+    # Returns (row key, column name) of the HourPresence mark of an hour
+    def get_hour_presence_key(self, source_id, metric_name, hour_datetime):
+        hourly_row_key = TimestampedDataDTO(source_id, hour_datetime, metric_name, None).get_row_key_for_hourly()
+        return (hourly_row_key[:-4], hourly_row_key[-10:])
+
+    # The SeriesCatalog has a row listing all source_ids, and a row per source_id with the first and last seen
+    # hour of each data_name (columns 'data_name\x00first' and 'data_name\x00last'). The write timestamps make
+    # Cassandra keep the earliest first seen and the latest last seen hour, whatever order they are written in.
+    # The number of points of each series is counted in SeriesPointCount.
+    def __queue_series_catalog(self, mutator, series_hours):
+        series_catalog_cf = self.__get_series_catalog_cf(for_write=True)
+        series_point_count_cf = self.__get_series_point_count_cf(for_write=True)
+
+        point_counts = dict()
+        new_hours = set()
+        for (source_id, data_name, hourly_row_key) in series_hours:
+            point_counts[(source_id, data_name)] = point_counts.get((source_id, data_name), 0) + 1
+            if (source_id, data_name, hourly_row_key[-10:]) not in self.__cataloged_hours:
+                new_hours.add((source_id, data_name, hourly_row_key[-10:]))
+
+        for source_id in set([source_id for (source_id, data_name) in point_counts.keys()]):
+            if source_id not in self.__cataloged_sources:
+                mutator.insert(series_catalog_cf, CATALOG_SOURCES_ROW, {source_id: ''})
+        for (source_id, data_name, hour) in new_hours:
+            hour_epoch = calendar.timegm(datetime.strptime(hour, '%Y%m%d%H').utctimetuple())
+            mutator.insert(series_catalog_cf, source_id, {data_name + FIRST_SEEN_SUFFIX: hour}, timestamp=FIRST_SEEN_TIMESTAMP_BASE - hour_epoch)
+            mutator.insert(series_catalog_cf, source_id, {data_name + LAST_SEEN_SUFFIX: hour}, timestamp=hour_epoch * 10**6)
+        for ((source_id, data_name), point_count) in point_counts.items():
+            mutator.insert(series_point_count_cf, source_id, {data_name: point_count})
+
+    # Columns starting with prefix, for a text comparator
+    def __prefix_range(self, prefix):
+        if prefix:
+            return (prefix, prefix + u'\uffff')
+        return ('', '')
+
+    # Returns the source_ids in the SeriesCatalog, in order, optionally only those starting with prefix
+    def list_sources(self, prefix=None, max_count=MAX_CATALOG_COLUMN_COUNT):
+        (column_start, column_finish) = self.__prefix_range(prefix)
+        try:
+            return self.__get_series_catalog_cf().get(CATALOG_SOURCES_ROW, column_start=column_start, column_finish=column_finish, column_count=max_count).keys()
+        except NotFoundException:
+            return []
+
+    # Returns a SeriesInfoDTO for each data_name of the source, in order, optionally only those starting with prefix
+    def list_series(self, source_id, prefix=None, max_count=MAX_CATALOG_COLUMN_COUNT):
+        (column_start, column_finish) = self.__prefix_range(prefix)
+        try:
+            columns = self.__get_series_catalog_cf().get(source_id, column_start=column_start, column_finish=column_finish, column_count=2*max_count)
+        except NotFoundException:
+            return []
 
-        # And perform the insertion
-        self.__get_blob_data_index_cf().batch_insert(insert_tuples, ttl=ttl)
+        seen_hours = OrderedDict()
+        for (column_name, hour) in columns.items():
+            (data_name, kind) = column_name.rsplit(u'\x00', 1)
+            seen_hours.setdefault(data_name, dict())[kind] = datetime.strptime(hour, '%Y%m%d%H')
+
+        try:
+            point_counts = self.__get_series_point_count_cf().get(source_id, columns=seen_hours.keys())
+        except NotFoundException:
+            point_counts = dict()
+
+        return [SeriesInfoDTO(source_id, data_name, hours.get('first', None), hours.get('last', None), point_counts.get(data_name, 0)) for (data_name, hours) in seen_hours.items()]
+
+    # Returns the hourly row keys of the hours between start and end that have data, according to HourPresence
+    def get_present_hourly_row_keys(self, source_id, metric_name, start_datetime, end_datetime):
+        first_row_key = TimestampedDataDTO(source_id, start_datetime, metric_name, None).get_row_key_for_hourly()
+        last_row_key = TimestampedDataDTO(source_id, end_datetime, metric_name, None).get_row_key_for_hourly()
+        prefix = first_row_key[:-10]
+        (year, month) = (int(first_row_key[-10:-6]), int(first_row_key[-6:-4]))
+        (last_year, last_month) = (int(last_row_key[-10:-6]), int(last_row_key[-6:-4]))
+
+        month_row_keys = list()
+        while (year, month) <= (last_year, last_month):
+            month_row_keys.append('%s%04d%02d' % (prefix, year, month))
+            (year, month) = (year + month / 12, month % 12 + 1)
+
+        rows = self.__get_hour_presence_cf().multiget(month_row_keys, column_start=first_row_key[-10:], column_finish=last_row_key[-10:], column_count=MAX_TIME_SERIES_COLUMN_COUNT)
+        return set([prefix + hour for columns in rows.values() for hour in columns.keys()])
+
+    # Marks the hours between start and end that have data, for series written before hour_presence_index was
+    # turned on. Reads one column of every hourly shard in the range. Returns the number of hours marked
+    def backfill_hour_presence(self, source_id, metric_name, start_datetime, end_datetime):
+        hourly_row_keys = list()
+        curr = self.floor_timestamp_to_hour(start_datetime)
+        while curr <= end_datetime:
+            row_key = TimestampedDataDTO(source_id, curr, metric_name, None).get_row_key_for_hourly()
+            if self.__get_hourly_data_cf().get_count(row_key, max_count=1) > 0:
+                hourly_row_keys.append(row_key)
+            curr += timedelta(hours=1)
+
+        rows = dict()
+        for hourly_row_key in hourly_row_keys:
+            rows.setdefault(hourly_row_key[:-4], dict())[hourly_row_key[-10:]] = ''
+        if rows:
+            self.__get_hour_presence_cf(for_write=True).batch_insert(rows)
+        return len(hourly_row_keys)
+
+    # Given a dict as hit_counts, the hits per index row and hour are added to it as IndexHitCounts rows
+    def __build_index_rows(self, index_dtos, hit_counts=None):
+        if isinstance(index_dtos, BlobIndexBatch):
+            entries = zip(index_dtos.row_keys(), index_dtos.timestamps_as_utc(), index_dtos.blob_data_row_keys)
+        else:
+            entries = [(dto.get_row_key(), dto.timestamp_as_utc(), dto.blob_data_row_key) for dto in index_dtos]
+        if hit_counts is not None:
+            self.__count_index_hits(entries, hit_counts)
+
+        insert_tuples = dict()
+        if self.index_bucket_seconds:
+            # The entries of a text share their timestamp
+            bucket_suffixes = dict()
+            for (row_key, timestamp, blob_data_row_key) in entries:
+                suffix = bucket_suffixes.get(timestamp, None)
+                if suffix is None:
+                    suffix = bucket_suffixes[timestamp] = self.__index_bucket_suffix(timestamp)
+                insert_tuples.setdefault(row_key + suffix, dict())[timestamp] = blob_data_row_key
+            return insert_tuples
+        for (row_key, timestamp, blob_data_row_key) in entries:
+            # Several hits may land on the same index row, ie. the same word in a batch of log messages
+            insert_tuples.setdefault(row_key, dict())[timestamp] = blob_data_row_key
+        return insert_tuples
+
+    def __count_index_hits(self, entries, hit_counts):
+        hours = dict()
+        for (row_key, timestamp, blob_data_row_key) in entries:
+            hour = hours.get(timestamp, None)
+            if hour is None:
+                hour = hours[timestamp] = self.__naive_utc(timestamp).strftime('%Y%m%d%H')
+            columns = hit_counts.setdefault(row_key + '-' + hour[:6], dict())
+            columns[hour] = columns.get(hour, 0) + 1
+
+    # The IndexHitCounts row key and column of the hour of timestamp, the hits of an index row (its key without
+    # bucket, see BlobIndexDTO.get_row_key) are counted per hour in one row per month
+    def get_index_hit_count_key(self, index_row_key, timestamp):
+        hour = self.__naive_utc(timestamp).strftime('%Y%m%d%H')
+        return (index_row_key + '-' + hour[:6], hour)
+
+    def __naive_utc(self, timestamp):
+        if timestamp.tzinfo:
+            return timestamp.astimezone(pytz.utc).replace(tzinfo=None)
+        return timestamp
+
+    # The start of the index bucket of a timestamp, as a naive UTC datetime
+    def __index_bucket_start(self, timestamp):
+        epoch = calendar.timegm(timestamp.utctimetuple())
+        return datetime.utcfromtimestamp(epoch - epoch % self.index_bucket_seconds)
+
+    def __index_bucket_suffix(self, timestamp):
+        return '-' + self.__index_bucket_start(timestamp).strftime('%Y%m%d%H')
+
+    # The BlobDataIndex row key of an index entry, index_row_key is the key without bucket, see BlobIndexDTO.get_row_key
+    def get_index_bucket_row_key(self, index_row_key, timestamp):
+        if not self.index_bucket_seconds:
+            return index_row_key
+        return index_row_key + self.__index_bucket_suffix(timestamp)
+
+    # The BlobDataIndex row keys that may hold an index entry written at timestamp, its bucket and, with an
+    # index_bucket_since after it, the row without a bucket
+    def get_index_entry_row_keys(self, index_row_key, timestamp):
+        row_keys = [self.get_index_bucket_row_key(index_row_key, timestamp)]
+        if self.index_bucket_seconds and self.index_bucket_since is not None and self.__naive_utc(timestamp) < self.index_bucket_since:
+            row_keys.append(index_row_key)
+        return row_keys
+
+    # The BlobDataIndex row keys of the buckets between start and end, oldest first. Just index_row_key without
+    # index buckets. With index_bucket_since the row without a bucket comes first for searches starting before it
+    def get_index_bucket_row_keys(self, index_row_key, start_date=None, end_date=None):
+        if not self.index_bucket_seconds:
+            return [index_row_key]
+        last_bucket = self.__index_bucket_start(end_date or datetime.utcnow())
+        if start_date:
+            bucket = self.__index_bucket_start(start_date)
+        elif self.index_bucket_since is not None:
+            bucket = self.__index_bucket_start(self.index_bucket_since) - timedelta(seconds=self.index_bucket_seconds)
+        else:
+            bucket = last_bucket - timedelta(seconds=self.index_bucket_seconds * (self.index_bucket_lookback - 1))
+        row_keys = list()
+        if self.index_bucket_since is not None and (not start_date or self.__naive_utc(start_date) < self.index_bucket_since):
+            row_keys.append(index_row_key)
+        while bucket <= last_bucket:
+            row_keys.append(index_row_key + '-' + bucket.strftime('%Y%m%d%H'))
+            bucket += timedelta(seconds=self.index_bucket_seconds)
+        return row_keys
 
     ##
     ## Data loading
@@ -294,37 +777,159 @@ class TimeSeriesCassandraDao():
     ######################################################
 
     # Given a list of data_names search for same string in them
-    def get_blobs_multi_data_by_free_text_index(self, source_id, data_names, free_text, start_date=None, end_date=None, to_list_of_tuples=True, column_count=MAX_INDEX_COLUMN_COUNT):
-        blob_index_rows = list()
+    #
+    # The index rows are read in parallel and merged on timestamp, only the column_count first
+    # hits of the merged result are loaded from BlobData
+    def get_blobs_multi_data_by_free_text_index(self, source_id, data_names, free_text, start_date=None, end_date=None, to_list_of_tuples=True, column_count=MAX_INDEX_COLUMN_COUNT, newest_first=False):
+        blob_index_rows = self.parallel_reader.map(lambda data_name: self.get_blob_index_row(source_id, data_name, free_text, start_date, end_date, column_count, newest_first), data_names)
+
+        merged_blob_index_row = search.merge_index_rows(blob_index_rows, column_count, newest_first)
+
+        return self.get_blobs_by_keys([merged_blob_index_row], to_list_of_tuples)
 
-        for data_name in data_names:
-            blob_index_rows.append(self.get_blob_index_row(source_id, data_name, free_text, start_date, end_date, column_count))
+    # Lazy version of get_blobs_multi_data_by_free_text_index, see search_blobs_by_free_text_index
+    def search_blobs_multi_data_by_free_text_index(self, source_id, data_names, free_text, start_date=None, end_date=None, to_list_of_tuples=True, column_count=MAX_INDEX_COLUMN_COUNT, prefetch_window=search.DEFAULT_PREFETCH_WINDOW, newest_first=False):
+        blob_index_rows = self.parallel_reader.map(lambda data_name: self.get_blob_index_row(source_id, data_name, free_text, start_date, end_date, column_count, newest_first), data_names)
 
-        return self.get_blobs_by_keys(blob_index_rows, to_list_of_tuples)
+        hits = [BlobIndexHitDTO(timestamp, blob_data_row_key) for (timestamp, blob_data_row_key) in search.merge_index_rows(blob_index_rows, column_count, newest_first)]
+        return search.LazyBlobSearchResult(self.load_blobs_for_hits, hits, prefetch_window, to_list_of_tuples)
 
-    def get_blob_index_row(self, source_id, data_name, free_text, start_date="", end_date="", column_count=MAX_INDEX_COLUMN_COUNT):
+    def __get_blob_index_row_key(self, source_id, data_name, free_text):
         scrubbed_free_text = self.blob_indexer.strip_and_lower(free_text)
         # We don't need the DTO, Just create one for key generation
-        index_row_key = BlobIndexDTO(source_id, data_name, scrubbed_free_text, None, None).get_row_key()
+        return BlobIndexDTO(source_id, data_name, scrubbed_free_text, None, None).get_row_key()
+
+    # With newest_first=True the index is read backwards from end_date, the column_count newest hits come first
+    def get_blob_index_row(self, source_id, data_name, free_text, start_date="", end_date="", column_count=MAX_INDEX_COLUMN_COUNT, newest_first=False):
+        index_row_key = self.__get_blob_index_row_key(source_id, data_name, free_text)
+        if self.index_bucket_seconds:
+            return self.__get_bucketed_blob_index_row(index_row_key, start_date, end_date, column_count, newest_first)
+        (column_start, column_finish) = (end_date, start_date) if newest_first else (start_date, end_date)
         try:
-            # Note, a row contains many keys
-            if start_date and end_date:
-                blob_index_row = self.__get_blob_data_index_cf().get(index_row_key, column_reversed=False, column_count=column_count, column_start=start_date, column_finish=end_date).items()
-            elif start_date and not end_date:
-                blob_index_row = self.__get_blob_data_index_cf().get(index_row_key, column_reversed=False, column_count=column_count, column_start=start_date, column_finish="").items()
-            elif end_date and not start_date:
-                blob_index_row = self.__get_blob_data_index_cf().get(index_row_key, column_reversed=False, column_count=column_count, column_start="", column_finish=end_date).items()
-            else:
-                blob_index_row = self.__get_blob_data_index_cf().get(index_row_key, column_reversed=False, column_count=column_count, column_start="", column_finish="").items()
-
+            # Note, a row contains many keys. An empty start or finish means open ended
+            blob_index_row = self.__get_blob_data_index_cf().get(index_row_key, column_reversed=newest_first, column_count=column_count, column_start=column_start or "", column_finish=column_finish or "").items()
         except NotFoundException as e:
             # Differ between not found in Index and not found in Blob-CF (the load done in get_blobs_by_kyes()) which would be a serious error.
             return []
 
         return blob_index_row
 
-    def get_blobs_by_free_text_index(self, source_id, data_name, free_text, start_date=None, end_date=None, to_list_of_tuples=True, column_count=MAX_INDEX_COLUMN_COUNT):
-        blob_index_row = self.get_blob_index_row(source_id, data_name, free_text, start_date, end_date, column_count)
+    # The buckets are read in time order (backwards for newest_first), until column_count hits are found. The
+    # first multiget reads a single bucket, each next one twice as many up to INDEX_BUCKETS_PER_READ, so a search
+    # with its hits in the first bucket costs one read of one row. The row without a bucket (see index_bucket_since)
+    # is read on its own and merged in
+    def __get_bucketed_blob_index_row(self, index_row_key, start_date, end_date, column_count, newest_first=False):
+        row_keys = self.get_index_bucket_row_keys(index_row_key, start_date, end_date)
+        (column_start, column_finish) = (start_date, end_date)
+        if newest_first:
+            row_keys.reverse()
+            (column_start, column_finish) = (end_date, start_date)
+        if index_row_key in row_keys:
+            row_keys.remove(index_row_key)
+            try:
+                legacy_index_row = self.__get_blob_data_index_cf().get(index_row_key, column_reversed=newest_first, column_count=column_count, column_start=column_start or "", column_finish=column_finish or "").items()
+            except NotFoundException:
+                legacy_index_row = []
+            return search.merge_index_rows([self.__read_index_buckets(row_keys, column_start, column_finish, column_count, newest_first), legacy_index_row], column_count, newest_first)
+        return self.__read_index_buckets(row_keys, column_start, column_finish, column_count, newest_first)
+
+    def __read_index_buckets(self, row_keys, column_start, column_finish, column_count, newest_first):
+        blob_index_row = list()
+        (i, buckets_per_read) = (0, 1)
+        while i < len(row_keys) and len(blob_index_row) < column_count:
+            bucket_row_keys = row_keys[i:i+buckets_per_read]
+            rows = self.__get_blob_data_index_cf().multiget(bucket_row_keys, column_count=column_count - len(blob_index_row), column_start=column_start or "", column_finish=column_finish or "", column_reversed=newest_first)
+            for row_key in bucket_row_keys:
+                blob_index_row.extend(rows.get(row_key, dict()).items())
+            i += buckets_per_read
+            buckets_per_read = min(2 * buckets_per_read, INDEX_BUCKETS_PER_READ)
+        return blob_index_row[:column_count]
+
+    # Only reads the index, returns a list of BlobIndexHitDTOs in time order (newest first for newest_first=True)
+    def get_blob_hits_by_free_text_index(self, source_id, data_name, free_text, start_date=None, end_date=None, column_count=MAX_INDEX_COLUMN_COUNT, newest_first=False):
+        blob_index_row = self.get_blob_index_row(source_id, data_name, free_text, start_date, end_date, column_count, newest_first)
+        return [BlobIndexHitDTO(timestamp, blob_data_row_key) for (timestamp, blob_data_row_key) in blob_index_row]
+
+    # Counts the hits in the index only, BlobData is never touched
+    def count_by_free_text_index(self, source_id, data_name, free_text, start_date=None, end_date=None, max_count=None):
+        index_row_key = self.__get_blob_index_row_key(source_id, data_name, free_text)
+        if self.index_bucket_seconds:
+            counts = self.__get_blob_data_index_cf().multiget_count(self.get_index_bucket_row_keys(index_row_key, start_date, end_date), column_start=start_date or "", column_finish=end_date or "", max_count=max_count)
+            count = sum(counts.values())
+            return min(count, max_count) if max_count is not None else count
+        return self.__get_blob_data_index_cf().get_count(index_row_key, column_start=start_date or "", column_finish=end_date or "", max_count=max_count)
+
+    # The hits from start_date up to end_date (defaults to now) per bucket_size, as [(bucket start, count)] for
+    # every bucket from start_date on. BlobData is never touched.
+    #
+    # Only the timestamps of the index entries are read. With index_hit_counts=True and a bucket_size of whole
+    # hours the hourly counters are read instead, a few columns per bucket whatever the number of hits. The
+    # counts are then by whole hours (start_date and end_date are taken to their hour), count the hits of index
+    # entries that have expired since, and count a retried write twice
+    def histogram_by_free_text_index(self, source_id, data_name, free_text, start_date, end_date=None, bucket_size=timedelta(hours=1), use_hit_counts=True):
+        index_row_key = self.__get_blob_index_row_key(source_id, data_name, free_text)
+        start_date = self.__naive_utc(start_date)
+        end_date = self.__naive_utc(end_date or datetime.utcnow())
+        bucket_seconds = bucket_size.total_seconds()
+        if bucket_seconds <= 0:
+            raise ValueError('The bucket size must be positive, got %s' % bucket_size)
+        if self.index_hit_counts and use_hit_counts and bucket_seconds % 3600 == 0:
+            start_date = self.floor_timestamp_to_hour(start_date)
+            hour_counts = self.__get_index_hit_counts(index_row_key, start_date, end_date)
+        else:
+            hour_counts = self.__get_index_timestamp_counts(index_row_key, start_date, end_date)
+
+        counts = [0] * int(math.ceil((end_date - start_date).total_seconds() / bucket_seconds))
+        for (timestamp, count) in hour_counts:
+            i = int((timestamp - start_date).total_seconds() // bucket_seconds)
+            if 0 <= i < len(counts):
+                counts[i] += count
+        return [(start_date + timedelta(seconds=i * bucket_seconds), count) for (i, count) in enumerate(counts)]
+
+    # Returns [(timestamp, 1)] for every index entry between start and end, the index is read in pages
+    def __get_index_timestamp_counts(self, index_row_key, start_date, end_date):
+        timestamp_counts = list()
+        for row_key in self.get_index_bucket_row_keys(index_row_key, start_date, end_date):
+            column_start = start_date
+            first_column = 0
+            while True:
+                try:
+                    columns = self.__get_blob_data_index_cf().get(row_key, column_start=column_start, column_finish=end_date, column_count=MAX_TIME_SERIES_COLUMN_COUNT)
+                except NotFoundException:
+                    break
+                timestamp_counts.extend([(timestamp, 1) for timestamp in columns.keys()[first_column:]])
+                if len(columns) < MAX_TIME_SERIES_COLUMN_COUNT:
+                    break
+                # The next page starts with the last column of this one
+                column_start = columns.keys()[-1]
+                first_column = 1
+        return timestamp_counts
+
+    # Returns [(hour, count)] of the IndexHitCounts between start and end
+    def __get_index_hit_counts(self, index_row_key, start_date, end_date):
+        (first_row_key, first_hour) = self.get_index_hit_count_key(index_row_key, start_date)
+        (last_row_key, last_hour) = self.get_index_hit_count_key(index_row_key, end_date)
+        (year, month) = (int(first_hour[:4]), int(first_hour[4:6]))
+        month_row_keys = list()
+        while '%04d%02d' % (year, month) <= last_hour[:6]:
+            month_row_keys.append('%s-%04d%02d' % (index_row_key, year, month))
+            (year, month) = (year + month / 12, month % 12 + 1)
+        rows = self.__get_index_hit_counts_cf().multiget(month_row_keys, column_start=first_hour, column_finish=last_hour, column_count=MAX_TIME_SERIES_COLUMN_COUNT)
+        return [(datetime.strptime(hour, '%Y%m%d%H'), count) for columns in rows.values() for (hour, count) in columns.items()]
+
+    # Same search as get_blobs_by_free_text_index but the blobs are not loaded until the result is iterated
+    # or paged, prefetch_window blobs per multiget. See search.LazyBlobSearchResult
+    def search_blobs_by_free_text_index(self, source_id, data_name, free_text, start_date=None, end_date=None, to_list_of_tuples=True, column_count=MAX_INDEX_COLUMN_COUNT, prefetch_window=search.DEFAULT_PREFETCH_WINDOW, newest_first=False):
+        hits = self.get_blob_hits_by_free_text_index(source_id, data_name, free_text, start_date, end_date, column_count, newest_first)
+        return search.LazyBlobSearchResult(self.load_blobs_for_hits, hits, prefetch_window, to_list_of_tuples)
+
+    def load_blobs_for_hits(self, hits, to_list_of_tuples=True):
+        return self.get_blobs_by_keys([[(hit.timestamp, hit.blob_data_row_key) for hit in hits]], to_list_of_tuples)
+
+    # The column_count first (or with newest_first=True, the column_count latest) blobs matching free_text. Only
+    # those blobs are read
+    def get_blobs_by_free_text_index(self, source_id, data_name, free_text, start_date=None, end_date=None, to_list_of_tuples=True, column_count=MAX_INDEX_COLUMN_COUNT, newest_first=False):
+        blob_index_row = self.get_blob_index_row(source_id, data_name, free_text, start_date, end_date, column_count, newest_first)
         return self.get_blobs_by_keys([blob_index_row], to_list_of_tuples, column_count)
 
     def get_blobs_by_keys(self, blob_index_rows, to_list_of_tuples=True, column_count=MAX_BLOB_COLUMN_COUNT):
@@ -335,36 +940,73 @@ class TimeSeriesCassandraDao():
                 ts_data_row_key = blob_index[1]
                 ts_data_row_keys_to_multi_fetch.append(ts_data_row_key)
 
+        # Make sure all chunks of a chunked blob are loaded, a partial blob can not be decoded
+        column_count = max(column_count, self.blob_serializer.max_chunks)
+
         # Drop the key from the result
         list_of_ordered_dicts = self.__get_blob_data_cf().multiget(ts_data_row_keys_to_multi_fetch, column_count=column_count).values()
 
         if to_list_of_tuples:
             list_of_tuples = list()
             for ordered_dict in list_of_ordered_dicts:
-                item = ordered_dict.items()[0]
-                list_of_tuples.append((item[0], item[1]))
+                list_of_tuples.append(self.blob_serializer.from_columns(ordered_dict))
             return list_of_tuples
         else:
-            return list_of_ordered_dicts
+            return [self.blob_serializer.from_columns_as_dict(ordered_dict) for ordered_dict in list_of_ordered_dicts]
 
     def remove_latest_data(self, source_id):
-        self.__get_latest_data_cf().remove(source_id)
+        self.__get_latest_data_cf(for_write=True).remove(source_id)
+        if self.latest_data_cache is not None:
+            self.latest_data_cache.invalidate(source_id)
 
+    # The whole LatestData row of the source, or only the data_name and data_name-ts columns if data_name is given
     def load_latest_data(self, source_id, data_name=None):
         try:
-            latest_data = self.__get_latest_data_cf().get(source_id, super_column=data_name)
+            if data_name is not None:
+                latest_data = self.__get_latest_data_cf().get(source_id, columns=latest.latest_data_column_names([data_name]))
+            else:
+                latest_data = self.__get_latest_data_cf().get(source_id, column_count=MAX_LATEST_DATA_COLUMN_COUNT)
         except NotFoundException:
             return {}
         return latest_data
 
-    def multi_load_latest_data(self, source_ids):
-        try:
-            latest_data = self.__get_latest_data_cf().multiget(source_ids)
-        except NotFoundException:
-            return []
-        return latest_data
+    def multi_load_latest_data(self, source_ids, data_names=None):
+        return self.load_latest_data_snapshot(source_ids, data_names)
+
+    # The latest data of many sources, {source_id: {data_name: value, data_name-ts: millis}} in the order of
+    # source_ids, only the data_names given if any. Sources without (any of the) data are left out.
+    #
+    # The sources are read LATEST_DATA_MULTIGET_SIZE per multiget, the multigets in parallel. With a
+    # latest_data_cache_ttl the rows read are cached, and sources read again within the TTL are served from
+    # the cache, unless use_cache=False
+    def load_latest_data_snapshot(self, source_ids, data_names=None, use_cache=True):
+        cache = self.latest_data_cache if use_cache else None
+        # Taken before the reads, rows of sources written through the cache while they were read are not cached
+        version = self.latest_data_cache.version() if self.latest_data_cache is not None else None
+        rows = dict()
+        missing_source_ids = list()
+        for source_id in OrderedDict.fromkeys(source_ids):
+            columns = cache.get(source_id, data_names) if cache is not None else None
+            if columns is None:
+                missing_source_ids.append(source_id)
+            else:
+                rows[source_id] = columns
+
+        chunks = [missing_source_ids[i:i+LATEST_DATA_MULTIGET_SIZE] for i in range(0, len(missing_source_ids), LATEST_DATA_MULTIGET_SIZE)]
+        for loaded_rows in self.parallel_reader.map(lambda chunk: self.__multiget_latest_data(chunk, data_names), chunks):
+            rows.update(loaded_rows)
+        if self.latest_data_cache is not None:
+            for source_id in missing_source_ids:
+                self.latest_data_cache.put(source_id, rows.get(source_id, dict()), data_names, version)
+
+        return OrderedDict([(source_id, rows[source_id]) for source_id in OrderedDict.fromkeys(source_ids) if rows.get(source_id)])
+
+    def __multiget_latest_data(self, source_ids, data_names):
+        if data_names is not None:
+            return self.__get_latest_data_cf().multiget(source_ids, columns=latest.latest_data_column_names(data_names))
+        return self.__get_latest_data_cf().multiget(source_ids, column_count=MAX_LATEST_DATA_COLUMN_COUNT)
 
-    def __load_shard(self, row_key, from_datetime=None, to_datetime=None, column_count=MAX_TIME_SERIES_COLUMN_COUNT, allow_cached_loads=False):
+    def __load_shard(self, row_key, from_datetime=None, to_datetime=None, column_count=MAX_TIME_SERIES_COLUMN_COUNT, allow_cached_loads=False, window_picos=None):
         # Special case, we say we want data from a shard but range is 0, return empty then
         if from_datetime and to_datetime:
             if from_datetime == to_datetime:
@@ -379,9 +1021,182 @@ class TimeSeriesCassandraDao():
             column_finish = ""
         try:
             result = self.__get_hourly_data_cf().get(row_key, column_reversed=False, column_count=column_count, column_start=column_start, column_finish=column_finish)
-            return (row_key, result)
         except NotFoundException:
-            return (row_key, {})
+            result = OrderedDict()
+        if window_picos:
+            result = self.__unpack_columns(row_key, result, column_start, column_finish, column_count, window_picos)
+        return (row_key, result)
+
+    # Replaces the packed columns among the columns read from a shard of a packed_blocks metric by the columns
+    # they hold, between column_start and column_finish (None or "" for open ends). The packed column of the
+    # window that column_start falls in sorts before column_start, it is read on its own.
+    #
+    # If the read was cut off at column_count columns, nothing beyond the last column read is returned, so a
+    # next read starting right after the last column returned misses nothing. At most column_count columns
+    # are returned, the windows may well hold more
+    def __unpack_columns(self, row_key, columns, column_start, column_finish, column_count, window_picos):
+        packed_columns = [(column_name, value) for (column_name, value) in columns.items() if column_name % window_picos == 0 and valuecodecs.is_packed_columns(value)]
+        if column_start not in (None, "") and column_start % window_picos != 0:
+            try:
+                first_window = self.__get_hourly_data_cf().get(row_key, columns=[column_start - column_start % window_picos])
+                packed_columns.extend([(column_name, value) for (column_name, value) in first_window.items() if valuecodecs.is_packed_columns(value)])
+            except NotFoundException:
+                pass
+        if not packed_columns:
+            return columns
+        if len(columns) >= column_count:
+            column_finish = columns.keys()[-1]
+
+        unpacked = dict(columns)
+        for (column_name, value) in packed_columns:
+            unpacked.pop(column_name, None)
+        for (column_name, value) in packed_columns:
+            for (packed_column_name, packed_value) in zip(*valuecodecs.decode_packed_columns(value)):
+                if column_start not in (None, "") and packed_column_name < column_start:
+                    continue
+                if column_finish not in (None, "") and packed_column_name > column_finish:
+                    continue
+                # A column not yet removed by an interrupted pack_hourly_shard() is in both
+                unpacked.setdefault(packed_column_name, packed_value)
+        return OrderedDict(sorted(unpacked.items())[:column_count])
+
+    # Every column of an hourly shard as stored, read in slices of MAX_TIME_SERIES_COLUMN_COUNT
+    def __get_whole_shard(self, row_key, include_timestamp_and_ttl=False):
+        result = OrderedDict()
+        column_start = ""
+        while True:
+            try:
+                columns = self.__get_hourly_data_cf().get(row_key, column_start=column_start, column_count=MAX_TIME_SERIES_COLUMN_COUNT, include_timestamp=include_timestamp_and_ttl, include_ttl=include_timestamp_and_ttl)
+            except NotFoundException:
+                break
+            result.update(columns)
+            if len(columns) < MAX_TIME_SERIES_COLUMN_COUNT:
+                break
+            column_start = columns.keys()[-1] + 1
+        return result
+
+    # An hour is closed once it is over, no more data is written to its shard (apart from late writes)
+    def is_closed_hour(self, hour_datetime):
+        return self.floor_timestamp_to_hour(hour_datetime) < datetime.utcnow() and not self.__datetime_is_in_now_hour(hour_datetime)
+
+    # Rewrites a closed hourly shard of a packed_blocks metric, see pack_hourly_shard(), raises ValueError for
+    # other metrics. Can be repeated safely. Returns the number of columns packed
+    #
+    # Shards of other metrics are left as they are: columns of the same microsecond are distinct points, told
+    # apart by their sub-microsecond suffix, and a retried write reuses its column name.
+    def compact_hourly_shard(self, source_id, metric_name, hour_datetime):
+        hour = self.floor_timestamp_to_hour(hour_datetime)
+        if not self.is_closed_hour(hour):
+            raise ValueError('Hour %s is not closed yet' % hour)
+        return self.pack_hourly_shard(source_id, metric_name, hour, hour + timedelta(hours=1))
+
+    # The last hour done per (source_id, metric_name) by the background job job_name, see compaction.CompactionJob
+    # and retention.RetentionManager
+    def load_job_checkpoints(self, job_name):
+        try:
+            columns = self.__get_job_checkpoints_cf().get(job_name, column_count=MAX_CATALOG_COLUMN_COUNT)
+        except NotFoundException:
+            return dict()
+        return dict([(tuple(series.split('\x00', 1)), datetime.strptime(hour, '%Y%m%d%H')) for (series, hour) in columns.items()])
+
+    def save_job_checkpoint(self, job_name, source_id, metric_name, hour_datetime):
+        self.__get_job_checkpoints_cf(for_write=True).insert(job_name, {source_id + '\x00' + metric_name: hour_datetime.strftime('%Y%m%d%H')})
+
+    # Every column of the hourly shard of an hour as stored, packed windows are not unpacked. The values are
+    # (value, write timestamp, ttl) with include_timestamp_and_ttl
+    def get_whole_hourly_shard(self, source_id, metric_name, hour_datetime, include_timestamp_and_ttl=False):
+        return self.__get_whole_shard(TimestampedDataDTO(source_id, hour_datetime, metric_name, None).get_row_key_for_hourly(), include_timestamp_and_ttl)
+
+    def count_hourly_shard_columns(self, source_id, metric_name, hour_datetime):
+        return self.__get_hourly_data_cf().get_count(TimestampedDataDTO(source_id, hour_datetime, metric_name, None).get_row_key_for_hourly())
+
+    # Takes a list of (column family name, row_key, list of column names or None for the whole row), ie.
+    # (TimeSeriesCassandraDao.BLOB_DATA_COLUMN_FAMILY_NAME, blob_data_row_key, None), and removes them in a
+    # single batch_mutate. See retention.RetentionManager
+    def batch_remove(self, removals):
+        mutator = pycassa.batch.Mutator(self.__write_pool, queue_size=MAX_MUTATION_ROWS)
+        for (column_family_name, row_key, columns) in removals:
+            mutator.remove(self.__get_column_family(column_family_name, for_write=True), row_key, columns=columns)
+        mutator.send()
+        if self.latest_data_cache is not None:
+            for (column_family_name, row_key, columns) in removals:
+                if column_family_name == self.LATEST_DATA_COLUMN_FAMILY_NAME:
+                    self.latest_data_cache.invalidate(row_key)
+        # Removed marks are written again by the next write to their hour
+        for (column_family_name, row_key, columns) in removals:
+            if column_family_name == self.HOUR_PRESENCE_COLUMN_FAMILY_NAME:
+                self.__marked_hours.difference_update([row_key[:-6] + hour for hour in columns or []])
+
+    # Packs the columns of the closed windows of an hourly shard of a packed_blocks metric into one column per
+    # window, stored under the column name of the start of the window. Windows packed before are packed again
+    # together with the columns written since. Windows with values the codec can't take are left as they are.
+    # A window is closed once it ended before closed_before (defaults to now).
+    #
+    # Each window is written in a single batch_mutate on the row, the packed column and the removal of the
+    # columns it replaces, which Cassandra applies atomically. Packing is a read-modify-write, the write
+    # timestamps keep packers that run at the same time on a shard (ie. a BlockCompactor in every process)
+    # from losing points:
+    #   - the columns packed are removed at their own write timestamp, a column written again since the
+    #     read is kept
+    #   - the packed column is written at the newest write timestamp read in its window plus the number of
+    #     points it holds, so a packer that read less of the window can't overwrite the packed column of
+    #     one that read more
+    #
+    # The packed column expires with the last of the columns it replaces, or never if any of them has no TTL.
+    # Cassandra counts its TTL from when it is written, so packed points can outlive their own TTL by up to the
+    # time between their write and the packing. Returns the number of columns packed
+    def pack_hourly_shard(self, source_id, metric_name, hour_datetime, closed_before=None):
+        window_picos = self.packed_blocks.get(metric_name, None)
+        if window_picos is None:
+            raise ValueError('%s is not a packed_blocks metric' % metric_name)
+        codec = self.value_codecs.get(metric_name, None)
+        if not hasattr(codec, 'encode_block'):
+            codec = valuecodecs.get_value_codec('float64')
+        hour = self.floor_timestamp_to_hour(hour_datetime)
+        if closed_before is None:
+            closed_before = datetime.utcnow()
+        row_key = TimestampedDataDTO(source_id, hour, metric_name, None).get_row_key_for_hourly()
+
+        # window start -> ({column_name: value} of the packed column, {column_name: (value, timestamp)} of the other
+        # columns, [(timestamp, ttl)] of all columns)
+        windows = dict()
+        for (column_name, (value, timestamp, ttl)) in self.get_whole_hourly_shard(source_id, metric_name, hour, include_timestamp_and_ttl=True).items():
+            window_start = column_name - column_name % window_picos
+            (packed, unpacked, writes) = windows.setdefault(window_start, (dict(), dict(), list()))
+            writes.append((timestamp, ttl))
+            if column_name == window_start and valuecodecs.is_packed_columns(value):
+                packed.update(zip(*valuecodecs.decode_packed_columns(value)))
+            else:
+                unpacked[column_name] = (valuecodecs.decode_value(value), timestamp)
+
+        packed_count = 0
+        for (window_start, (packed, unpacked, writes)) in sorted(windows.items()):
+            window_end = hour + timedelta(microseconds=(window_start + window_picos) / 10**6)
+            if not unpacked or window_end > closed_before:
+                continue
+            packed.update([(column_name, value) for (column_name, (value, timestamp)) in unpacked.items()])
+            column_names = sorted(packed.keys())
+            try:
+                packed_value = valuecodecs.encode_packed_columns(column_names, [packed[column_name] for column_name in column_names], codec)
+            except (TypeError, ValueError):
+                continue
+            packed_timestamp = max([timestamp for (timestamp, ttl) in writes]) + len(column_names)
+            packed_ttl = None
+            if None not in [ttl for (timestamp, ttl) in writes]:
+                expires = max([timestamp / 10.0**6 + ttl for (timestamp, ttl) in writes])
+                packed_ttl = max(1, int(math.ceil(expires - packed_timestamp / 10.0**6)))
+            mutator = pycassa.batch.Mutator(self.__write_pool, queue_size=MAX_MUTATION_ROWS)
+            mutator.insert(self.__get_hourly_data_cf(for_write=True), row_key, {window_start: packed_value}, timestamp=packed_timestamp, ttl=packed_ttl)
+            # A column written at the very start of the window has just been overwritten by the packed column
+            removed = dict()
+            for (column_name, (value, timestamp)) in unpacked.items():
+                if column_name != window_start:
+                    removed.setdefault(timestamp, list()).append(column_name)
+            for (timestamp, column_names) in removed.items():
+                mutator.remove(self.__get_hourly_data_cf(for_write=True), row_key, columns=column_names, timestamp=timestamp)
+            mutator.send()
+            packed_count += len(unpacked)
+        return packed_count
 
     def data_generator(self, source_id, metric_name, start_datetime, end_datetime, max_count=MAX_TIME_SERIES_COLUMN_COUNT, allow_cached_loads=False):
 
@@ -403,24 +1218,36 @@ class TimeSeriesCassandraDao():
         #shards = list()
         #key_to_last_shard = None
 
+        window_picos = self.packed_blocks.get(metric_name, None)
+
+        # Sparse series, only read the shards of the hours that are known to have data
+        present_row_keys = None
+        if self.hour_presence_index and len(datetimes) > 0:
+            present_row_keys = self.get_present_hourly_row_keys(source_id, metric_name, start_datetime, end_datetime)
+
         if len(datetimes) == 0:
             yield []
         if len(datetimes) == 1:
             row_key = TimestampedDataDTO( source_id, datetimes[0], metric_name, None).get_row_key_for_hourly()
-            shard = self.__load_shard(row_key, start_datetime, end_datetime)
-            yield shard
+            if present_row_keys is not None and row_key not in present_row_keys:
+                yield (row_key, {})
+            else:
+                shard = self.__load_shard(row_key, start_datetime, end_datetime, maximum_allowed, allow_cached_loads, window_picos)
+                yield shard
         if len(datetimes) > 1:
             for i in range(0, len(datetimes)):
                 if maximum_allowed <= 0 :
                     # Cant go on, would be good to explicitly not this upwards?
                     break
                 row_key = TimestampedDataDTO( source_id, datetimes[i], metric_name, None).get_row_key_for_hourly()
+                if present_row_keys is not None and row_key not in present_row_keys:
+                    continue
                 if i==0:
-                    a_shard = self.__load_shard(row_key, start_datetime, datetimes[i+1]-timedelta(microseconds=1), maximum_allowed, allow_cached_loads)
+                    a_shard = self.__load_shard(row_key, start_datetime, datetimes[i+1]-timedelta(microseconds=1), maximum_allowed, allow_cached_loads, window_picos)
                 elif i > 0 and i < len(datetimes) -1:
-                    a_shard =  self.__load_shard(row_key, column_count=maximum_allowed, allow_cached_loads=allow_cached_loads)
+                    a_shard =  self.__load_shard(row_key, column_count=maximum_allowed, allow_cached_loads=allow_cached_loads, window_picos=window_picos)
                 else:
-                    a_shard = self.__load_shard(row_key, datetimes[len(datetimes)-1], end_datetime+timedelta(microseconds=1), maximum_allowed, allow_cached_loads)
+                    a_shard = self.__load_shard(row_key, datetimes[len(datetimes)-1], end_datetime+timedelta(microseconds=1), maximum_allowed, allow_cached_loads, window_picos)
                 maximum_allowed -= len(a_shard[1])
                 yield a_shard
 
@@ -449,7 +1276,7 @@ class TimeSeriesCassandraDao():
             # Restore date from rowkey and column name (which is pico-time offset).. this is wierd... but it works
             floored_datetime_from_key = row_key.split('-')[-1]
             floored_datetime = datetime.strptime(floored_datetime_from_key, '%Y%m%d%H')
-            for (offset, value) in shard[1].items():
+            for (offset, value) in zip(shard[1].keys(), valuecodecs.decode_values(shard[1].values())):
                 the_datetime = self.highres_to_utc_datetime(floored_datetime, offset)
                 result.append((the_datetime, value))
 
@@ -465,6 +1292,68 @@ class TimeSeriesCassandraDao():
             # Restore date from rowkey and column name (which is pico-time offset).. this is wierd... but it works
             floored_datetime_from_key = row_key.split('-')[-1]
             floored_datetime = datetime.strptime(floored_datetime_from_key, '%Y%m%d%H')
-            for (offset, value) in shard[1].items():
+            for (offset, value) in zip(shard[1].keys(), valuecodecs.decode_values(shard[1].values())):
                 the_datetime = self.highres_to_utc_datetime(floored_datetime, offset)
                 yield (the_datetime, value)
+
+    # Same as get_timetamped_data_range but returns (seconds since the epoch, values) as two array('d'), values
+    # that are not numbers are NaN. With a processes.ShardDecoderPool the shards are decoded on its worker
+    # processes while the next ones are read, which pays off for ranges of millions of points
+    def get_timetamped_data_range_arrays(self, source_id, metric_name, start_datetime, end_datetime, max_count=MAX_TIME_SERIES_COLUMN_COUNT, allow_cached_loads=False, decoder_pool=None):
+        pages = list()
+        for shard in self.data_generator(source_id, metric_name, start_datetime, end_datetime, max_count, allow_cached_loads):
+            if not shard or not shard[1]:
+                continue
+            hour_epoch = calendar.timegm(datetime.strptime(shard[0].split('-')[-1], '%Y%m%d%H').timetuple())
+            offsets = shard[1].keys()
+            values = shard[1].values()
+            page_size = decoder_pool.slot_capacity if decoder_pool else len(offsets)
+            for i in range(0, len(offsets), page_size):
+                if decoder_pool is None:
+                    pages.append(aggregation.decode_shard_page(offsets[i:i+page_size], values[i:i+page_size], hour_epoch))
+                else:
+                    pages.append(decoder_pool.submit(aggregation.decode_shard_page, offsets[i:i+page_size], values[i:i+page_size], (hour_epoch,)))
+
+        result = (array('d'), array('d'))
+        for page in pages:
+            if decoder_pool is not None:
+                page = page.get()
+            result[0].extend(page[0])
+            result[1].extend(page[1])
+        return result
+
+    # Reads the hourly shard that start_datetime falls in, from column_start (a column name as returned
+    # by this method) or from start_datetime itself if no column_start is given. Returns a list of
+    # (column_name, datetime, value) ordered on column name.
+    #
+    # Used to read a series forward incrementally, see tail.ShardCursor
+    def get_hourly_shard_columns(self, source_id, metric_name, start_datetime, column_start=None, max_count=MAX_TIME_SERIES_COLUMN_COUNT):
+        floored_datetime = self.floor_timestamp_to_hour(start_datetime)
+        if column_start is None:
+            column_start = self.__get_picoseconds_since_start_of_hour(start_datetime)
+        columns = self.get_hourly_shard_slice(source_id, metric_name, floored_datetime, column_start, None, max_count)
+        return [(offset, self.highres_to_utc_datetime(floored_datetime, offset), value) for (offset, value) in zip(columns.keys(), valuecodecs.decode_values(columns.values()))]
+
+    # The raw columns (picoseconds since the start of the hour -> value as stored) of the hourly shard that hour_datetime
+    # falls in, between column_start and column_finish (both included, None for open ends). Packed columns are unpacked,
+    # their values are ints or floats
+    def get_hourly_shard_slice(self, source_id, metric_name, hour_datetime, column_start=None, column_finish=None, max_count=MAX_TIME_SERIES_COLUMN_COUNT):
+        row_key = TimestampedDataDTO(source_id, hour_datetime, metric_name, None).get_row_key_for_hourly()
+        if column_start is None:
+            column_start = ""
+        if column_finish is None:
+            column_finish = ""
+        try:
+            columns = self.__get_hourly_data_cf().get(row_key, column_start=column_start, column_finish=column_finish, column_count=max_count)
+        except NotFoundException:
+            columns = OrderedDict()
+        if metric_name in self.packed_blocks:
+            columns = self.__unpack_columns(row_key, columns, column_start, column_finish, max_count, self.packed_blocks[metric_name])
+        return columns
+
+    # Aggregates the (numeric) values of several series into time buckets, ie. the mean CPU load of all hosts
+    # per 5 minutes. series is a list of (source_id, metric_name). See aggregation.SeriesAggregator, pass a
+    # processes.ShardDecoderPool to parse and bucket on several cores
+    def aggregate_series(self, series, start_datetime, end_datetime, bucket_size, aggregates=aggregation.DEFAULT_AGGREGATES, percentiles=None, page_size=aggregation.DEFAULT_PAGE_SIZE, decoder_pool=None):
+        aggregator = aggregation.SeriesAggregator(self, page_size, decoder_pool)
+        return aggregator.aggregate(series, start_datetime, end_datetime, bucket_size, aggregates, percentiles)
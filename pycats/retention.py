@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+from datetime import datetime, timedelta
+from models import TimestampedDataDTO
+from compaction import RateLimiter
+import logrecords
+import valuecodecs
+import threading
+
+DEFAULT_JOB_NAME = 'retention'
+# Rows or columns removed per batch_mutate
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_MAX_BATCHES_PER_SECOND = 10.0
+DEFAULT_MAX_READS_PER_SECOND = 50.0
+# Seconds between two rounds
+DEFAULT_INTERVAL = 3600.0
+
+# Per column bookkeeping of Cassandra on top of the name and the value (name and value lengths, flags, timestamp)
+COLUMN_OVERHEAD = 15
+# Shards of series that are not indexable text are counted rather than read, a column is a bigint name and
+# (usually) a typed value
+ESTIMATED_HOURLY_COLUMN_SIZE = 8 + valuecodecs.TYPED_VALUE_SIZE + COLUMN_OVERHEAD
+HOURLY_COLUMN_NAME_SIZE = 8
+INDEX_COLUMN_NAME_SIZE = 8
+HIT_COUNT_SIZE = 8
+
+
+# The text the CassandraLogger indexed a log record by, for RetentionPolicy(index_text=...)
+def log_record_index_text(value):
+    return logrecords.decode_log_record(value)[3]
+
+
+# How long the data of a source_id and/or data_name is kept, None matches any. The most specific policy
+# matching a series applies, see RetentionManager.
+#
+# Series written with insert_indexable_text_as_blob_data_and_insert_index() (and the CassandraLogger) should have
+# indexable_text=True, their blobs and index entries are then removed together with their hourly shards.
+# index_text turns a stored value into the text that was indexed, if it was indexed by a str_for_index, ie.
+# log_record_index_text for the CassandraLogger. Index entries of a str_for_index that can't be derived from the
+# stored value are left to their TTL.
+#
+# since is where the removal starts for series that have no checkpoint yet and are not in the SeriesCatalog
+class RetentionPolicy():
+
+    def __init__(self, max_age, source_id=None, data_name=None, indexable_text=False, index_text=None, since=None):
+        self.max_age = max_age
+        self.source_id = source_id
+        self.data_name = data_name
+        self.indexable_text = indexable_text
+        self.index_text = index_text
+        self.since = since
+
+    def matches(self, source_id, data_name):
+        return self.source_id in (None, source_id) and self.data_name in (None, data_name)
+
+    # Exact series first, then source_id, then data_name, then catch-all policies
+    def specificity(self):
+        return (self.source_id is not None, self.data_name is not None)
+
+
+# What a round of the RetentionManager removed (or would have removed, on a dry run), per column family
+class RetentionReport():
+
+    def __init__(self):
+        self.series = 0
+        self.hours = 0
+        self.rows = dict()
+        self.columns = dict()
+        self.bytes = dict()
+
+    def add(self, column_family_name, rows, columns, size):
+        self.rows[column_family_name] = self.rows.get(column_family_name, 0) + rows
+        self.columns[column_family_name] = self.columns.get(column_family_name, 0) + columns
+        self.bytes[column_family_name] = self.bytes.get(column_family_name, 0) + size
+
+    # Estimated, exact for what was read, the sizes of the blobs are those of their uncompressed text
+    def total_bytes(self):
+        return sum(self.bytes.values())
+
+    def __unicode__(self):
+        return u'%s series, %s hours, %s bytes: %s' % (self.series, self.hours, self.total_bytes(), ', '.join([u'%s %s rows %s columns' % (name, self.rows[name], self.columns[name]) for name in sorted(self.rows.keys())]))
+
+
+# Removes the data older than the max_age of its RetentionPolicy, for data written without a TTL or with a
+# TTL that turned out too long.
+#
+# Nothing is scanned, the expired row keys are computed from the hourly row keys 'source_id-data_name-YYYYMMDDHH':
+# every hour from the checkpoint of the series (or its first seen hour in the SeriesCatalog, or the since of
+# its policy) up to the last hour that ended max_age ago. With a dao that keeps the hour_presence_index only the
+# marked hours are read, one HourPresence read per series tells them, otherwise every hour is. Reads are made
+# at most max_reads_per_second, so a first round over a long history does not hammer the cluster either. The
+# rows go in batches of batch_size removals, at most max_batches_per_second, from all the column families:
+#
+#   - HourlyTimestampedData, the whole hourly row, and its HourPresence mark if the dao keeps them
+#   - BlobData and BlobDataIndex, for indexable_text series only: the shard is read first, the blob row keys
+#     follow from the timestamps of its columns and the index entries from indexing its values again
+#   - LatestData, the data_name and data_name-ts columns if the latest value is older than max_age as well
+#
+# and the IndexHitCounts of the expired hours of indexable_text series, if the dao keeps them.
+#
+# After each batch the last hour done is saved as the checkpoint of the series under the name of the job (see
+# TimeSeriesCassandraDao.save_job_checkpoint), the next round starts from there. The blobs and index entries of
+# an hour go before its hourly row, an interrupted round redoes the hour from its shard.
+#
+# Series with a policy for both source_id and data_name are known up front, the others are listed from the
+# SeriesCatalog, so they need a dao with series_catalog=True.
+class RetentionManager():
+
+    def __init__(self, pycats_dao, policies, name=DEFAULT_JOB_NAME, batch_size=DEFAULT_BATCH_SIZE, max_batches_per_second=DEFAULT_MAX_BATCHES_PER_SECOND, max_reads_per_second=DEFAULT_MAX_READS_PER_SECOND, interval=DEFAULT_INTERVAL, clock=datetime.utcnow, sleep=None):
+        self.dao = pycats_dao
+        self.policies = sorted(policies, key=lambda policy: policy.specificity(), reverse=True)
+        self.name = name
+        self.batch_size = batch_size
+        self.interval = interval
+        self.clock = clock
+        self.errors = 0
+        self.last_error = None
+        self.last_report = None
+        self.__stopped = threading.Event()
+        self.__rate_limiter = RateLimiter(max_batches_per_second, sleep=sleep or self.__stopped.wait)
+        self.__read_limiter = RateLimiter(max_reads_per_second, sleep=sleep or self.__stopped.wait)
+        self.__worker = None
+
+    def policy_for(self, source_id, data_name):
+        for policy in self.policies:
+            if policy.matches(source_id, data_name):
+                return policy
+        return None
+
+    # Returns [(source_id, data_name, first seen hour or None, policy)]
+    def series(self):
+        series = dict()
+        for policy in self.policies:
+            if policy.source_id is not None and policy.data_name is not None:
+                series.setdefault((policy.source_id, policy.data_name), None)
+        if [policy for policy in self.policies if policy.source_id is None or policy.data_name is None]:
+            for source_id in self.dao.list_sources():
+                self.__read_limiter.acquire()
+                for info in self.dao.list_series(source_id):
+                    series[(source_id, info.data_name)] = info.first_seen
+        result = list()
+        for ((source_id, data_name), first_seen) in sorted(series.items()):
+            policy = self.policy_for(source_id, data_name)
+            if policy is not None:
+                result.append((source_id, data_name, first_seen, policy))
+        return result
+
+    # The hours of a series to remove, oldest first
+    def expired_hours(self, first_hour, max_age, now=None):
+        last_hour = self.dao.floor_timestamp_to_hour((now or self.clock()) - max_age) - timedelta(hours=1)
+        hours = list()
+        hour = self.dao.floor_timestamp_to_hour(first_hour)
+        while hour <= last_hour:
+            hours.append(hour)
+            hour += timedelta(hours=1)
+        return hours
+
+    # Removes (or on a dry run, only counts) what has expired since the previous round, returns a RetentionReport
+    def run(self, dry_run=False):
+        now = self.clock()
+        checkpoints = self.dao.load_job_checkpoints(self.name)
+        report = RetentionReport()
+        for (source_id, data_name, first_seen, policy) in self.series():
+            if self.__stopped.is_set():
+                break
+            checkpoint = checkpoints.get((source_id, data_name), None)
+            if checkpoint is not None:
+                first_hour = checkpoint + timedelta(hours=1)
+            else:
+                first_hour = first_seen or policy.since
+            if first_hour is None:
+                continue
+            try:
+                self.__expire_series(source_id, data_name, policy, first_hour, now, dry_run, report)
+            except Exception as e:
+                self.errors += 1
+                self.last_error = e
+        self.last_report = report
+        return report
+
+    def __expire_series(self, source_id, data_name, policy, first_hour, now, dry_run, report):
+        hours = self.expired_hours(first_hour, policy.max_age, now)
+        present_hourly_row_keys = None
+        if hours and self.dao.hour_presence_index:
+            self.__read_limiter.acquire()
+            present_hourly_row_keys = self.dao.get_present_hourly_row_keys(source_id, data_name, hours[0], hours[-1])
+        removals = list()
+        for hour in hours:
+            if present_hourly_row_keys is not None and TimestampedDataDTO(source_id, hour, data_name, None).get_row_key_for_hourly() not in present_hourly_row_keys:
+                continue
+            hour_removals = self.__hour_removals(source_id, data_name, hour, policy, report)
+            if hour_removals:
+                removals.extend(hour_removals)
+                report.hours += 1
+            if len(removals) >= self.batch_size:
+                self.__send(removals, dry_run)
+                removals = list()
+                if not dry_run:
+                    self.dao.save_job_checkpoint(self.name, source_id, data_name, hour)
+        removals.extend(self.__latest_data_removals(source_id, data_name, now - policy.max_age, report))
+        self.__send(removals, dry_run)
+        if hours and not dry_run:
+            self.dao.save_job_checkpoint(self.name, source_id, data_name, hours[-1])
+        report.series += 1
+
+    def __hour_removals(self, source_id, data_name, hour, policy, report):
+        removals = list()
+        self.__read_limiter.acquire()
+        if not policy.indexable_text:
+            column_count = self.dao.count_hourly_shard_columns(source_id, data_name, hour)
+            if column_count == 0:
+                return removals
+            report.add(self.dao.HOURLY_DATA_COLUMN_FAMILY_NAME, 1, column_count, column_count * ESTIMATED_HOURLY_COLUMN_SIZE)
+        else:
+            shard = self.dao.get_whole_hourly_shard(source_id, data_name, hour)
+            if not shard:
+                return removals
+            blob_row_keys = set()
+            index_columns = dict()
+            hit_count_columns = dict()
+            for (column_name, value) in shard.items():
+                dto = TimestampedDataDTO(source_id, self.dao.highres_to_utc_datetime(hour, column_name), data_name, value, self.__index_text(value, policy))
+                blob_data_row_key = dto.get_row_key_for_blob_data()
+                if blob_data_row_key not in blob_row_keys:
+                    blob_row_keys.add(blob_data_row_key)
+                    report.add(self.dao.BLOB_DATA_COLUMN_FAMILY_NAME, 1, 1, len(value) + COLUMN_OVERHEAD)
+                if dto.str_for_index is None:
+                    continue
+                for index_dto in self.dao.blob_indexer.build_indexes_from_timstamped_dto(dto, blob_data_row_key):
+                    for index_row_key in self.dao.get_index_entry_row_keys(index_dto.get_row_key(), index_dto.timestamp_as_utc()):
+                        index_columns.setdefault(index_row_key, set()).add(index_dto.timestamp_as_utc())
+                    if self.dao.index_hit_counts:
+                        (count_row_key, count_column_name) = self.dao.get_index_hit_count_key(index_dto.get_row_key(), index_dto.timestamp_as_utc())
+                        if count_column_name not in hit_count_columns.setdefault(count_row_key, set()):
+                            hit_count_columns[count_row_key].add(count_column_name)
+                            report.add(self.dao.INDEX_HIT_COUNTS_COLUMN_FAMILY_NAME, 0, 1, len(count_column_name) + HIT_COUNT_SIZE + COLUMN_OVERHEAD)
+                    report.add(self.dao.BLOB_DATA_INDEX_COLUMN_FAMILY_NAME, 0, 1, INDEX_COLUMN_NAME_SIZE + len(blob_data_row_key) + COLUMN_OVERHEAD)
+            report.add(self.dao.BLOB_DATA_INDEX_COLUMN_FAMILY_NAME, len(index_columns), 0, 0)
+            report.add(self.dao.HOURLY_DATA_COLUMN_FAMILY_NAME, 1, len(shard), sum([HOURLY_COLUMN_NAME_SIZE + len(value) + COLUMN_OVERHEAD for value in shard.values()]))
+            removals.extend([(self.dao.BLOB_DATA_COLUMN_FAMILY_NAME, row_key, None) for row_key in sorted(blob_row_keys)])
+            removals.extend([(self.dao.BLOB_DATA_INDEX_COLUMN_FAMILY_NAME, row_key, sorted(columns)) for (row_key, columns) in sorted(index_columns.items())])
+            # The hours are over, their counters are not written again
+            removals.extend([(self.dao.INDEX_HIT_COUNTS_COLUMN_FAMILY_NAME, row_key, sorted(columns)) for (row_key, columns) in sorted(hit_count_columns.items())])
+        removals.append((self.dao.HOURLY_DATA_COLUMN_FAMILY_NAME, TimestampedDataDTO(source_id, hour, data_name, None).get_row_key_for_hourly(), None))
+        if self.dao.hour_presence_index:
+            # After the hourly row, an interrupted round finds the hour marked and redoes it
+            (presence_row_key, presence_column_name) = self.dao.get_hour_presence_key(source_id, data_name, hour)
+            removals.append((self.dao.HOUR_PRESENCE_COLUMN_FAMILY_NAME, presence_row_key, [presence_column_name]))
+            report.add(self.dao.HOUR_PRESENCE_COLUMN_FAMILY_NAME, 0, 1, len(presence_column_name) + COLUMN_OVERHEAD)
+        return removals
+
+    # The text a stored value was indexed by, None if it can't be told. Values come back from Cassandra as utf-8
+    def __index_text(self, value, policy):
+        try:
+            if policy.index_text is not None:
+                return policy.index_text(value)
+            if isinstance(value, unicode):
+                return value
+            return value.decode('utf-8')
+        except Exception:
+            return None
+
+    def __latest_data_removals(self, source_id, data_name, cutoff, report):
+        self.__read_limiter.acquire()
+        latest_data = self.dao.load_latest_data(source_id, data_name)
+        try:
+            latest_millis = int(latest_data[data_name + '-ts'])
+        except (KeyError, ValueError):
+            return []
+        if latest_millis >= TimestampedDataDTO(source_id, cutoff, data_name, None).timestamp_as_unix_time_millis():
+            return []
+        columns = [column_name for column_name in (data_name, data_name + '-ts') if column_name in latest_data]
+        report.add(self.dao.LATEST_DATA_COLUMN_FAMILY_NAME, 0, len(columns), sum([len(column_name) + len(latest_data[column_name]) + COLUMN_OVERHEAD for column_name in columns]))
+        return [(self.dao.LATEST_DATA_COLUMN_FAMILY_NAME, source_id, columns)]
+
+    def __send(self, removals, dry_run):
+        if dry_run:
+            return
+        for i in range(0, len(removals), self.batch_size):
+            self.__rate_limiter.acquire()
+            self.dao.batch_remove(removals[i:i+self.batch_size])
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            self.run()
+            self.__stopped.wait(self.interval)
+
+    def start(self):
+        self.__stopped.clear()
+        self.__worker = threading.Thread(target=self.__run, name='pycats-retention-manager')
+        self.__worker.daemon = True
+        self.__worker.start()
+
+    def stop(self, timeout=None):
+        self.__stopped.set()
+        if self.__worker is not None:
+            self.__worker.join(timeout)
+            self.__worker = None
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+import heapq
+
+DEFAULT_PREFETCH_WINDOW = 20
+DEFAULT_PAGE_SIZE = 20
+
+# Result of a free text search where only the index has been read.
+#
+# The hits (timestamp and blob row key, see BlobIndexHitDTO) are available right away. Blob bodies
+# are loaded from BlobData when the result is iterated, prefetch_window blobs per multiget, or when
+# a single page is requested. Counting the hits never touches BlobData.
+#
+# Note that nothing is kept after it has been yielded, iterating twice will load the blobs twice.
+class LazyBlobSearchResult():
+
+    def __init__(self, blob_loader, hits, prefetch_window=DEFAULT_PREFETCH_WINDOW, to_list_of_tuples=True):
+        # blob_loader takes a list of hits and returns the loaded blobs, typically TimeSeriesCassandraDao.load_blobs_for_hits
+        self.__blob_loader = blob_loader
+        self.hits = hits
+        self.prefetch_window = max(1, prefetch_window)
+        self.to_list_of_tuples = to_list_of_tuples
+
+    def __len__(self):
+        return len(self.hits)
+
+    def count(self):
+        return len(self.hits)
+
+    def timestamps(self):
+        return [hit.timestamp for hit in self.hits]
+
+    def page_count(self, page_size=DEFAULT_PAGE_SIZE):
+        return (len(self.hits) + page_size - 1) / page_size
+
+    # Loads the blobs of one page only, pages are numbered from 0
+    def page(self, page_number, page_size=DEFAULT_PAGE_SIZE):
+        start = page_number * page_size
+        page_hits = self.hits[start:start+page_size]
+        if len(page_hits) == 0:
+            return []
+        return self.__blob_loader(page_hits, self.to_list_of_tuples)
+
+    def __iter__(self):
+        for start in range(0, len(self.hits), self.prefetch_window):
+            for blob in self.__blob_loader(self.hits[start:start+self.prefetch_window], self.to_list_of_tuples):
+                yield blob
+
+
+# Wraps a sort key to reverse its order in the heap, used when merging newest first
+class _Descending(object):
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+# Heap based k-way merge of index rows, ie. lists of (timestamp, blob_data_row_key) that are each sorted
+# on timestamp (newest first if newest_first=True). Stops as soon as count hits are merged, so only the
+# top count hits ever get their blobs fetched.
+def merge_index_rows(blob_index_rows, count=None, newest_first=False):
+    if newest_first:
+        sort_key = lambda blob_index: _Descending(blob_index[0])
+    else:
+        sort_key = lambda blob_index: blob_index[0]
+
+    heap = list()
+    for i, blob_index_row in enumerate(blob_index_rows):
+        iterator = iter(blob_index_row)
+        for blob_index in iterator:
+            # The row number breaks ties, iterators can't be compared
+            heap.append((sort_key(blob_index), i, blob_index, iterator))
+            break
+    heapq.heapify(heap)
+
+    merged = list()
+    while heap and (count is None or len(merged) < count):
+        (key, i, blob_index, iterator) = heap[0]
+        merged.append(blob_index)
+        for next_blob_index in iterator:
+            heapq.heapreplace(heap, (sort_key(next_blob_index), i, next_blob_index, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+    return merged
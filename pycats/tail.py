@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+from collections import deque
+from datetime import datetime, timedelta
+import itertools
+import threading
+import time
+
+# Followers of the same series share one read per interval (seconds)
+DEFAULT_MIN_INTERVAL = 1.0
+# Data written up to this many seconds late (clock skew, buffered writers) is still picked up
+DEFAULT_GRACE = 2.0
+DEFAULT_BATCH_SIZE = 1000
+# Entries kept for followers that have not polled yet, slower followers miss the oldest entries
+DEFAULT_BUFFER_SIZE = 10000
+
+PICOS_PER_SECOND = 10**12
+
+
+# Reads a time series forward from start_datetime (naive UTC, defaults to now), one hourly shard at a time.
+#
+# Keeps a high-water mark, the last column name read in the current shard, so each read() only fetches the
+# columns written since the last one. Columns up to grace seconds below the mark are read again to catch
+# late writes, the ones already returned are skipped. Moves on to the next shard once the current hour
+# plus the grace period has passed.
+#
+# Note that late writes are returned in the order they are found, not in timestamp order.
+class ShardCursor():
+
+    def __init__(self, pycats_dao, source_id, metric_name, start_datetime=None, grace=DEFAULT_GRACE, batch_size=DEFAULT_BATCH_SIZE, clock=datetime.utcnow):
+        self.dao = pycats_dao
+        self.source_id = source_id
+        self.metric_name = metric_name
+        self.grace = grace
+        self.batch_size = batch_size
+        self.clock = clock
+        self.reads = 0
+        if start_datetime is None:
+            start_datetime = clock()
+        self.__begin_shard(start_datetime)
+
+    def __begin_shard(self, shard_start):
+        self.shard_start = shard_start
+        self.high_water_mark = None
+        self.__caught_up = False
+        self.__seen = set()
+
+    def __next_column_start(self):
+        if self.high_water_mark is None:
+            return None
+        if self.__caught_up:
+            return max(0, self.high_water_mark - int(self.grace * PICOS_PER_SECOND))
+        return self.high_water_mark + 1
+
+    # Returns the (datetime, value) tuples written since the last read, at most about batch_size of them
+    def read(self):
+        result = list()
+        while True:
+            columns = self.dao.get_hourly_shard_columns(self.source_id, self.metric_name, self.shard_start, self.__next_column_start(), self.batch_size)
+            self.reads += 1
+            for (column_name, the_datetime, value) in columns:
+                if column_name in self.__seen or the_datetime < self.shard_start:
+                    continue
+                self.__seen.add(column_name)
+                result.append((the_datetime, value))
+                if self.high_water_mark is None or column_name > self.high_water_mark:
+                    self.high_water_mark = column_name
+            self.__caught_up = len(columns) < self.batch_size
+
+            # Only the columns within the grace period can be read again
+            if self.high_water_mark is not None:
+                oldest = self.high_water_mark - int(self.grace * PICOS_PER_SECOND)
+                self.__seen = set([column_name for column_name in self.__seen if column_name >= oldest])
+
+            if len(result) >= self.batch_size:
+                break
+            if not self.__caught_up:
+                continue
+            next_shard_start = self.dao.floor_timestamp_to_hour(self.shard_start) + timedelta(hours=1)
+            if next_shard_start + timedelta(seconds=self.grace) <= self.clock():
+                self.__begin_shard(next_shard_start)
+                continue
+            break
+        return result
+
+
+# Buffers what a ShardCursor reads for any number of followers.
+#
+# The cursor is read at most once per min_interval whatever the number of followers, followers polling in
+# between get what is already buffered. Each follower keeps its own position in the buffer.
+class SharedTail():
+
+    def __init__(self, cursor, min_interval=DEFAULT_MIN_INTERVAL, buffer_size=DEFAULT_BUFFER_SIZE, clock=time.time):
+        self.cursor = cursor
+        self.min_interval = min_interval
+        self.clock = clock
+        self.followers = 0
+        self.__buffer = deque(maxlen=buffer_size)
+        self.__next_position = 0
+        self.__last_read = None
+        self.__lock = threading.Lock()
+
+    # The position of a follower that only wants what is read from now on
+    def position(self):
+        with self.__lock:
+            return self.__next_position
+
+    # Returns (entries after position, the new position, number of entries missed since they left the buffer)
+    def read_after(self, position):
+        with self.__lock:
+            now = self.clock()
+            if self.__last_read is None or now - self.__last_read >= self.min_interval:
+                self.__last_read = now
+                for entry in self.cursor.read():
+                    self.__buffer.append(entry)
+                    self.__next_position += 1
+            first_buffered = self.__next_position - len(self.__buffer)
+            missed = max(0, first_buffered - position)
+            entries = list(itertools.islice(self.__buffer, max(0, position - first_buffered), None))
+            return (entries, self.__next_position, missed)
+
+
+# A follower of a SharedTail, poll() returns what has been written since the previous poll
+class TailFollower():
+
+    def __init__(self, shared_tail, transform=None, on_close=None):
+        self.__shared_tail = shared_tail
+        self.__transform = transform
+        self.__on_close = on_close
+        self.position = shared_tail.position()
+        self.missed = 0
+        self.closed = False
+
+    def poll(self):
+        (entries, self.position, missed) = self.__shared_tail.read_after(self.position)
+        self.missed += missed
+        if self.__transform:
+            return self.__transform(entries)
+        return entries
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.__on_close:
+                self.__on_close(self)
+
+
+# Hands out TailFollowers, followers of the same series from now on share one SharedTail.
+#
+# A follower starting at an earlier start_datetime gets a SharedTail of its own, it has to catch up first.
+class TailHub():
+
+    def __init__(self, pycats_dao, min_interval=DEFAULT_MIN_INTERVAL, grace=DEFAULT_GRACE, batch_size=DEFAULT_BATCH_SIZE, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.dao = pycats_dao
+        self.min_interval = min_interval
+        self.grace = grace
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.__shared_tails = dict()
+        self.__lock = threading.Lock()
+
+    def __new_shared_tail(self, source_id, metric_name, start_datetime):
+        cursor = ShardCursor(self.dao, source_id, metric_name, start_datetime, self.grace, self.batch_size)
+        return SharedTail(cursor, self.min_interval, self.buffer_size)
+
+    def follow(self, source_id, metric_name, start_datetime=None, transform=None):
+        if start_datetime is not None:
+            return TailFollower(self.__new_shared_tail(source_id, metric_name, start_datetime), transform)
+
+        key = (source_id, metric_name)
+        with self.__lock:
+            shared_tail = self.__shared_tails.get(key, None)
+            if shared_tail is None:
+                shared_tail = self.__new_shared_tail(source_id, metric_name, None)
+                self.__shared_tails[key] = shared_tail
+            shared_tail.followers += 1
+        return TailFollower(shared_tail, transform, lambda follower: self.__unfollow(key))
+
+    def __unfollow(self, key):
+        with self.__lock:
+            shared_tail = self.__shared_tails[key]
+            shared_tail.followers -= 1
+            if shared_tail.followers == 0:
+                del self.__shared_tails[key]
+
+    def followed_series(self):
+        with self.__lock:
+            return self.__shared_tails.keys()
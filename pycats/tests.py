@@ -1,9 +1,32 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime, timedelta
+from collections import OrderedDict
 from pycats import TimeSeriesCassandraDao, TimestampedDataDTO, BlobIndexDTO
 from indexers import StringIndexer
-from facades import CassandraLogger
+from facades import CassandraLogger, BufferedCassandraLogger, CassandraLogHandler, LoggerClosedException, DROP
+from blobs import BlobSerializer, ZlibBlobCodec
+from search import LazyBlobSearchResult, merge_index_rows
+from parallel import ParallelReader
+from pools import PoolStats, ManagedConnectionPool
+from asyncdao import AsyncTimeSeriesDao, AsyncCall, AsyncRangeIterator, AsyncCancelledException, AsyncTimeoutException
+from models import BlobIndexHitDTO, TimestampedBatch, SeriesInfoDTO
+from columnnames import ColumnNameGenerator, micros_since_start_of_hour
+from tail import ShardCursor, SharedTail, TailFollower, TailHub
+from aggregation import BucketAggregates, SeriesAggregator, UnknownAggregateException, COUNT, SUM, MEAN, MIN, MAX, decode_shard_page
+from processes import ShardDecoderPool, ShardDecodeException
+from valuecodecs import Int64ValueCodec, Float64ValueCodec, UnknownValueCodecException, get_value_codec, decode_value, decode_values, decode_floats, decode_value_block, encode_delta_block, decode_delta_block, encode_packed_columns, decode_packed_columns, is_packed_columns
+from compaction import BlockCompactor, CompactionJob, RateLimiter
+from retention import RetentionManager, RetentionPolicy, log_record_index_text
+from latest import LatestDataCache
+from logrecords import encode_log_record, decode_log_record, peek_level, UnknownLogRecordVersionException
+import pycassa
+import struct
 import unittest
+import threading
+import logging
+import weakref
+import gc
+import time
 import yaml
 import pytz
 from profilehooks import profile
@@ -28,10 +51,15 @@ import cProfile
 #    Use HELP for help.
 #    cqlsh> CREATE KEYSPACE pycats_test_space WITH strategy_class = 'SimpleStrategy' AND strategy_options:replication_factor = '1';
 #    cqlsh> use pycats_test_space;
-#    cqlsh:pycats_test_space> CREATE COLUMNFAMILY HourlyTimestampedData (KEY ascii PRIMARY KEY) WITH comparator=bigint;
+#    cqlsh:pycats_test_space> CREATE COLUMNFAMILY HourlyTimestampedData (KEY ascii PRIMARY KEY) WITH comparator=bigint AND default_validation=blob;
 #    cqlsh:pycats_test_space> CREATE COLUMNFAMILY LatestData (KEY ascii PRIMARY KEY) WITH comparator=ascii;
 #    cqlsh:pycats_test_space> CREATE COLUMNFAMILY BlobData (KEY ascii PRIMARY KEY) WITH comparator=timestamp;
 #    cqlsh:pycats_test_space> CREATE COLUMNFAMILY BlobDataIndex (KEY text PRIMARY KEY) WITH comparator=timestamp AND default_validation=text;
+#    cqlsh:pycats_test_space> CREATE COLUMNFAMILY HourPresence (KEY ascii PRIMARY KEY) WITH comparator=ascii;
+#    cqlsh:pycats_test_space> CREATE COLUMNFAMILY SeriesCatalog (KEY ascii PRIMARY KEY) WITH comparator=text;
+#    cqlsh:pycats_test_space> CREATE COLUMNFAMILY SeriesPointCount (KEY ascii PRIMARY KEY) WITH comparator=text AND default_validation=counter;
+#    cqlsh:pycats_test_space> CREATE COLUMNFAMILY JobCheckpoints (KEY ascii PRIMARY KEY) WITH comparator=text;
+#    cqlsh:pycats_test_space> CREATE COLUMNFAMILY IndexHitCounts (KEY text PRIMARY KEY) WITH comparator=ascii AND default_validation=counter;
 #    cqlsh:pycats_test_space>
 #
 # 4) Enter the URLs to your cassandra instances in the file test_settings.yaml. (rememeber not to commit this
@@ -106,6 +134,28 @@ class TimestampedDataDTOTest(unittest.TestCase):
 
         print unix_time_millis
 
+    def test_should_build_new_row_keys_when_timestamp_or_source_changes(self):
+        dto = TimestampedDataDTO('test', datetime.strptime('1979-06-20T06:59:59.999999', '%Y-%m-%dT%H:%M:%S.%f'), 'd', '0')
+        self.assertEqual(dto.get_row_key_for_hourly(), 'test-d-1979062006')
+        self.assertEqual(dto.get_row_key_for_blob_data(), 'test-d-298709999999')
+
+        dto.timestamp = datetime.strptime('1979-06-20T07:00:00', '%Y-%m-%dT%H:%M:%S')
+        dto.source_id = 'other'
+        self.assertEqual(dto.get_row_key_for_hourly(), 'other-d-1979062007')
+        self.assertEqual(dto.timestamp_as_unix_time_millis(), 298710000000)
+
+    def test_should_build_same_row_keys_from_batch_as_from_dtos(self):
+        local_now = datetime.now(tz=pytz.timezone('US/Eastern'))
+        dtos = [TimestampedDataDTO('test', local_now, 'd', '0'), TimestampedDataDTO('test', datetime.utcnow(), 'e', '1', 'one')]
+
+        batch = TimestampedBatch(dtos + [None])
+
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch.row_keys_for_hourly(), [dto.get_row_key_for_hourly() for dto in dtos])
+        self.assertEqual(batch.row_keys_for_blob_data(), [dto.get_row_key_for_blob_data() for dto in dtos])
+        self.assertEqual(batch[1].str_for_index, 'one')
+        self.assertFalse(hasattr(batch[0], '__dict__'))
+
 class TimeSeriesCassandraDaoIntegrationTest(PyCatsIntegrationTestBase):
 
     def __insert_range_of_metrics(self, source_id, value_name, start_datetime, end_datetime, batch_insert=False, set_latest=False):
@@ -287,6 +337,360 @@ class TimeSeriesCassandraDaoIntegrationTest(PyCatsIntegrationTestBase):
             self.assertEqual(result[i][0], values_inserted[i+1].timestamp)
             self.assertEqual(result[i][1], values_inserted[i+1].data_value)
 
+    def test_should_insert_and_load_range_through_async_dao(self):
+        source_id = 'unittest_async1'
+        test_metric = 'ramp_height'
+        start_datetime = datetime.strptime('1979-12-31T22:00:00', '%Y-%m-%dT%H:%M:%S')
+        end_datetime = datetime.strptime('1980-01-01T03:00:00', '%Y-%m-%dT%H:%M:%S')
+        async_dao = AsyncTimeSeriesDao(self.dao)
+
+        dtos = list()
+        curr_datetime = start_datetime
+        while curr_datetime <= end_datetime:
+            dtos.append(TimestampedDataDTO(source_id, curr_datetime, test_metric, str(len(dtos))))
+            curr_datetime = curr_datetime + timedelta(minutes=20)
+        async_dao.wait(async_dao.batch_insert_timestamped_data(dtos))
+
+        call = async_dao.get_timetamped_data_range(source_id, test_metric, start_datetime, end_datetime)
+        result = async_dao.wait(call)
+        self.assertEqual(len(result), len(dtos))
+
+        streamed = list(async_dao.get_timetamped_data_range_generator(source_id, test_metric, start_datetime, end_datetime))
+        self.assertEqual(streamed, result)
+
+        async_dao.dispose(dispose_dao=False)
+
+    def test_should_write_through_separate_write_pool_and_expose_pool_stats(self):
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True, pool_size=2, write_pool_size=2)
+        timestamp = datetime.strptime('1979-12-31T22:00:00', '%Y-%m-%dT%H:%M:%S')
+
+        dao.insert_timestamped_data(TimestampedDataDTO('unittest_pools1', timestamp, 'ramp_height', '1'))
+        dao.get_timetamped_data_range('unittest_pools1', 'ramp_height', timestamp, timestamp + timedelta(minutes=1))
+
+        stats = dao.get_pool_stats()
+        self.assertGreater(stats['write']['checkouts'], 0)
+        self.assertGreater(stats['read']['checkouts'], 0)
+        self.assertEqual(len(stats['read']['host_latencies']), 1)
+        dao.dispose()
+
+    def test_should_only_read_hours_marked_present_for_sparse_series(self):
+        # Given
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True, hour_presence_index=True)
+        source_id = 'SparseSeriesTest'
+        metric_name = 'events'
+        start = self.ts('1979-06-20T00:00:00')
+        dtos = [TimestampedDataDTO(source_id, start + timedelta(days=days, minutes=5), metric_name, str(days)) for days in (1, 12, 15)]
+
+        # When
+        dao.insert_timestamped_data(dtos[0])
+        dao.batch_insert_timestamped_data(dtos[1:])
+
+        # Then, 30 days over a month boundary are three present hours
+        present_row_keys = dao.get_present_hourly_row_keys(source_id, metric_name, start, start + timedelta(days=30))
+        self.assertEqual(present_row_keys, set([dto.get_row_key_for_hourly() for dto in dtos]))
+        result = dao.get_timetamped_data_range(source_id, metric_name, start, start + timedelta(days=30))
+        self.assertEqual([value for (timestamp, value) in result], ['1', '12', '15'])
+        self.assertEqual(dao.backfill_hour_presence(source_id, metric_name, start, start + timedelta(days=2)), 1)
+
+        # And, an hour written again after its mark was removed is marked again
+        (presence_row_key, presence_column_name) = dao.get_hour_presence_key(source_id, metric_name, dtos[0].timestamp)
+        dao.batch_remove([(TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME, dtos[0].get_row_key_for_hourly(), None),
+                          (TimeSeriesCassandraDao.HOUR_PRESENCE_COLUMN_FAMILY_NAME, presence_row_key, [presence_column_name])])
+        self.assertEqual(dao.get_present_hourly_row_keys(source_id, metric_name, start, start + timedelta(days=2)), set())
+        dao.insert_timestamped_data(dtos[0])
+        self.assertEqual(dao.get_present_hourly_row_keys(source_id, metric_name, start, start + timedelta(days=2)), set([dtos[0].get_row_key_for_hourly()]))
+        dao.dispose()
+
+    def test_should_aggregate_series_across_sources(self):
+        # Given
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True)
+        start = self.ts('1979-06-20T06:58:00')
+        for (source_id, offset) in (('AggregateTest1', 0), ('AggregateTest2', 10)):
+            dao.batch_insert_timestamped_data([TimestampedDataDTO(source_id, start + timedelta(minutes=i), 'load', str(offset + i)) for i in range(0, 4)])
+
+        # When, the points span two hourly shards
+        result = dao.aggregate_series([('AggregateTest1', 'load'), ('AggregateTest2', 'load')], start, start + timedelta(minutes=3), timedelta(minutes=2), (MEAN, COUNT), page_size=1)
+
+        # Then
+        self.assertEqual(result, [(start, {MEAN: 5.5, COUNT: 4}), (start + timedelta(minutes=2), {MEAN: 7.5, COUNT: 4})])
+        dao.dispose()
+
+    def test_should_read_a_range_into_arrays_on_a_decoder_pool(self):
+        # Given
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True)
+        start = self.ts('1979-06-20T06:58:00')
+        dao.batch_insert_timestamped_data([TimestampedDataDTO('RangeArraysTest', start + timedelta(minutes=i), 'load', str(i)) for i in range(0, 4)])
+        pool = ShardDecoderPool(processes=2, slot_capacity=2)
+
+        # When
+        (seconds, values) = dao.get_timetamped_data_range_arrays('RangeArraysTest', 'load', start, start + timedelta(minutes=3), decoder_pool=pool)
+
+        # Then
+        self.assertEqual(list(values), [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(seconds[1] - seconds[0], 60.0)
+        # The pages went through the shared slots, not pickled
+        self.assertEqual(pool.inline_pages, 0)
+        pool.close()
+        dao.dispose()
+
+    def test_should_store_values_typed_by_the_codec_of_the_metric(self):
+        # Given
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True, value_codecs={'requests': 'int64', 'load': 'float64'})
+        start = self.ts('1979-06-20T06:00:00')
+
+        # When
+        dao.insert_timestamped_data(TimestampedDataDTO('ValueCodecTest', start, 'requests', '17'))
+        dao.batch_insert_timestamped_data([TimestampedDataDTO('ValueCodecTest', start + timedelta(seconds=i), 'load', i / 2.0) for i in range(0, 3)])
+        dao.insert_timestamped_data(TimestampedDataDTO('ValueCodecTest', start, 'text', 'as is'))
+
+        # Then
+        self.assertEqual(dao.get_timetamped_data_range('ValueCodecTest', 'requests', start, start + timedelta(minutes=1)), [(start, 17)])
+        self.assertEqual([value for (timestamp, value) in dao.get_timetamped_data_range('ValueCodecTest', 'load', start, start + timedelta(minutes=1))], [0.0, 0.5, 1.0])
+        self.assertEqual(list(dao.get_timetamped_data_range_arrays('ValueCodecTest', 'load', start, start + timedelta(minutes=1))[1]), [0.0, 0.5, 1.0])
+        self.assertEqual(dao.get_timetamped_data_range('ValueCodecTest', 'text', start, start + timedelta(minutes=1)), [(start, 'as is')])
+        dao.dispose()
+
+    def test_should_read_packed_windows_like_the_columns_they_replace(self):
+        # Given
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True, value_codecs={'cpu': 'float64'}, packed_blocks={'cpu': timedelta(minutes=1)})
+        source_id = 'PackedBlocksTest-%s' % time.time()
+        start = self.ts('1979-06-20T06:00:00')
+        dao.batch_insert_timestamped_data([TimestampedDataDTO(source_id, start + timedelta(seconds=i * 10), 'cpu', str(i)) for i in range(0, 30)])
+        expected = dao.get_timetamped_data_range(source_id, 'cpu', start, start + timedelta(minutes=10))
+
+        # When, 5 one minute windows and the 30 seconds of the one that is not closed yet
+        packed_count = dao.pack_hourly_shard(source_id, 'cpu', start, closed_before=start + timedelta(minutes=5, seconds=30))
+        dao.insert_timestamped_data(TimestampedDataDTO(source_id, start + timedelta(seconds=15), 'cpu', '1.5'))
+
+        # Then
+        self.assertEqual(packed_count, 30)
+        self.assertEqual(len(dao.get_hourly_shard_slice(source_id, 'cpu', start)), 31)
+        self.assertEqual(dao.get_timetamped_data_range(source_id, 'cpu', start, start + timedelta(minutes=10)), sorted(expected + [(start + timedelta(seconds=15), 1.5)]))
+        self.assertEqual([value for (timestamp, value) in dao.get_timetamped_data_range(source_id, 'cpu', start + timedelta(seconds=25), start + timedelta(seconds=45))], [3.0, 4.0])
+        self.assertEqual(dao.get_timetamped_data_range(source_id, 'cpu', start, start + timedelta(minutes=10), max_count=5), sorted(expected + [(start + timedelta(seconds=15), 1.5)])[:5])
+        self.assertEqual(len(dao.get_hourly_shard_slice(source_id, 'cpu', start, max_count=3)), 3)
+        self.assertEqual(dao.aggregate_series([(source_id, 'cpu')], start, start + timedelta(minutes=5), timedelta(minutes=5), ('count',), page_size=2)[0][1], {'count': 31})
+        self.assertEqual(dao.pack_hourly_shard(source_id, 'cpu', start, closed_before=start + timedelta(minutes=5, seconds=30)), 1)
+        dao.dispose()
+
+    # Runs race() between reading the shard to pack and writing the packed columns
+    class RacingDao(TimeSeriesCassandraDao):
+        race = None
+
+        def get_whole_hourly_shard(self, source_id, metric_name, hour_datetime, include_timestamp_and_ttl=False):
+            columns = TimeSeriesCassandraDao.get_whole_hourly_shard(self, source_id, metric_name, hour_datetime, include_timestamp_and_ttl)
+            (race, self.race) = (self.race, None)
+            if race is not None:
+                race()
+            return columns
+
+    def test_should_keep_late_points_packed_by_a_concurrent_packer(self):
+        # Given
+        packed_blocks = {'cpu': timedelta(minutes=1)}
+        dao = TimeSeriesCassandraDaoIntegrationTest.RacingDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True, value_codecs={'cpu': 'float64'}, packed_blocks=packed_blocks)
+        other_dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True, value_codecs={'cpu': 'float64'}, packed_blocks=packed_blocks)
+        source_id = 'PackingRaceTest-%s' % time.time()
+        start = self.ts('1979-06-20T06:00:00')
+        closed_before = start + timedelta(minutes=2)
+        dao.batch_insert_timestamped_data([TimestampedDataDTO(source_id, start + timedelta(seconds=i * 10), 'cpu', i) for i in range(1, 6)])
+
+        # When, a late point is written and packed by the other packer while the first one packs from its read
+        def race():
+            other_dao.insert_timestamped_data(TimestampedDataDTO(source_id, start + timedelta(seconds=55), 'cpu', 5.5))
+            self.assertEqual(other_dao.pack_hourly_shard(source_id, 'cpu', start, closed_before), 6)
+        dao.race = race
+        self.assertEqual(dao.pack_hourly_shard(source_id, 'cpu', start, closed_before), 5)
+
+        # Then
+        self.assertEqual([value for (timestamp, value) in dao.get_timetamped_data_range(source_id, 'cpu', start, start + timedelta(minutes=1))], [1.0, 2.0, 3.0, 4.0, 5.0, 5.5])
+        self.assertEqual(len(dao.get_whole_hourly_shard(source_id, 'cpu', start)), 1)
+        dao.dispose()
+        other_dao.dispose()
+
+    def test_should_expire_packed_windows_with_the_columns_they_replace(self):
+        # Given
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True, value_codecs={'cpu': 'float64'}, packed_blocks={'cpu': timedelta(minutes=1)})
+        source_id = 'PackedTTLTest-%s' % time.time()
+        start = self.ts('1979-06-20T06:00:00')
+        dao.batch_insert_timestamped_data([TimestampedDataDTO(source_id, start + timedelta(seconds=i), 'cpu', i) for i in range(0, 3)], ttl=1800)
+        dao.batch_insert_timestamped_data([TimestampedDataDTO(source_id, start + timedelta(seconds=i), 'cpu', i) for i in range(3, 5)], ttl=3600)
+        dao.batch_insert_timestamped_data([TimestampedDataDTO(source_id, start + timedelta(minutes=1, seconds=i), 'cpu', i) for i in range(0, 3)], ttl=1800)
+        dao.batch_insert_timestamped_data([TimestampedDataDTO(source_id, start + timedelta(minutes=1, seconds=3), 'cpu', 3)])
+
+        # When
+        self.assertEqual(dao.pack_hourly_shard(source_id, 'cpu', start, start + timedelta(minutes=2)), 9)
+
+        # Then, the last to expire sets the TTL, a column without one makes the packed column permanent
+        shard = dao.get_whole_hourly_shard(source_id, 'cpu', start, include_timestamp_and_ttl=True)
+        self.assertEqual(len(shard), 2)
+        (value, timestamp, ttl) = shard[0]
+        self.assertTrue(3590 <= ttl <= 3600, ttl)
+        self.assertEqual(shard[60 * 10**12][2], None)
+        dao.dispose()
+
+    def test_should_only_compact_packed_blocks_metrics(self):
+        # Given, points of the same microseconds written twice
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space)
+        source_id = 'CompactionTest-%s' % time.time()
+        start = self.ts('1979-06-20T06:00:00')
+        dtos = [TimestampedDataDTO(source_id, start + timedelta(seconds=i), 'cpu', str(i)) for i in range(1, 6)]
+        dao.batch_insert_timestamped_data(dtos)
+        dao.batch_insert_timestamped_data(dtos)
+
+        # Then, they are distinct points and kept
+        self.assertRaises(ValueError, dao.compact_hourly_shard, source_id, 'cpu', start)
+        self.assertEqual(len(dao.get_hourly_shard_slice(source_id, 'cpu', start)), 10)
+        self.assertRaises(ValueError, dao.compact_hourly_shard, source_id, 'cpu', datetime.utcnow())
+        dao.save_job_checkpoint('test-job', source_id, 'cpu', start)
+        self.assertEqual(dao.load_job_checkpoints('test-job')[(source_id, 'cpu')], start)
+        dao.dispose()
+
+    def test_should_remove_expired_text_with_its_blobs_and_indexes(self):
+        # Given, indexable text of an old and of a recent hour
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True)
+        source_id = 'RetentionTest-%s' % time.time()
+        now = datetime.utcnow()
+        old = dao.floor_timestamp_to_hour(now - timedelta(days=3)) + timedelta(seconds=1)
+        recent = dao.floor_timestamp_to_hour(now) + timedelta(seconds=1)
+        dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes([TimestampedDataDTO(source_id, old, 'log', 'disk full'), TimestampedDataDTO(source_id, recent, 'log', 'disk ok')])
+        manager = RetentionManager(dao, [RetentionPolicy(timedelta(days=1), source_id, 'log', indexable_text=True, since=old)], name='retention-%s' % source_id)
+
+        # When
+        report = manager.run()
+
+        # Then
+        self.assertEqual(report.rows[TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME], 1)
+        self.assertEqual([value for (timestamp, value) in dao.get_timetamped_data_range(source_id, 'log', old, now + timedelta(hours=1))], ['disk ok'])
+        self.assertEqual([blob for (timestamp, blob) in dao.get_blobs_by_free_text_index(source_id, 'log', 'disk')], ['disk ok'])
+        self.assertEqual(dao.count_by_free_text_index(source_id, 'log', 'full'), 0)
+        self.assertEqual(manager.run().hours, 0)
+        dao.dispose()
+
+    def test_should_split_the_index_rows_into_day_buckets_and_only_search_those_in_range(self):
+        # Given, a hit a day over five days
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, index_bucket=timedelta(days=1))
+        source_id = 'IndexBucketTest-%s' % time.time()
+        start = self.ts('1979-06-20T12:00:00')
+        dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes([TimestampedDataDTO(source_id, start + timedelta(days=i), 'log', 'disk full %s' % i) for i in range(0, 5)])
+
+        # When
+        index_row_keys = dao.get_index_bucket_row_keys(BlobIndexDTO(source_id, 'log', 'full', None, None).get_row_key(), start + timedelta(days=1), start + timedelta(days=3))
+
+        # Then
+        self.assertEqual(index_row_keys, [BlobIndexDTO(source_id, 'log', 'full', None, None).get_row_key() + '-' + day for day in ('1979062100', '1979062200', '1979062300')])
+        self.assertEqual([blob for (timestamp, blob) in dao.get_blobs_by_free_text_index(source_id, 'log', 'full', start + timedelta(days=1), start + timedelta(days=3))], ['disk full 1', 'disk full 2', 'disk full 3'])
+        self.assertEqual([blob for (timestamp, blob) in dao.get_blobs_by_free_text_index(source_id, 'log', 'full', start, start + timedelta(days=5), column_count=2)], ['disk full 0', 'disk full 1'])
+        self.assertEqual(dao.count_by_free_text_index(source_id, 'log', 'disk', start, start + timedelta(days=5)), 5)
+        self.assertEqual(dao.count_by_free_text_index(source_id, 'log', 'disk', start + timedelta(days=4, hours=1), start + timedelta(days=5)), 0)
+        dao.dispose()
+
+    def test_should_read_the_rows_without_bucket_written_before_the_index_buckets(self):
+        # Given, hits indexed without buckets, then with day buckets from a hundred days later on
+        source_id = 'IndexBucketSinceTest-%s' % time.time()
+        start = self.ts('1979-06-20T12:00:00')
+        since = start + timedelta(days=100)
+        legacy_dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space)
+        legacy_dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes([TimestampedDataDTO(source_id, start + timedelta(days=i), 'log', 'disk full %s' % i) for i in range(0, 3)])
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, index_bucket=timedelta(days=1), index_bucket_since=since)
+        dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes([TimestampedDataDTO(source_id, since + timedelta(days=i), 'log', 'disk full %s' % (i + 100)) for i in range(0, 3)])
+
+        # Then, searches without a start date read every bucket since and the row without a bucket
+        self.assertEqual([blob for (timestamp, blob) in dao.get_blobs_by_free_text_index(source_id, 'log', 'full')], ['disk full %s' % i for i in (0, 1, 2, 100, 101, 102)])
+        self.assertEqual([blob for (timestamp, blob) in dao.get_blobs_by_free_text_index(source_id, 'log', 'full', column_count=4, newest_first=True)], ['disk full %s' % i for i in (102, 101, 100, 2)])
+        self.assertEqual([blob for (timestamp, blob) in dao.get_blobs_by_free_text_index(source_id, 'log', 'full', start + timedelta(days=1), since, column_count=2)], ['disk full 1', 'disk full 2'])
+        self.assertEqual(dao.count_by_free_text_index(source_id, 'log', 'disk'), 6)
+        self.assertEqual(dao.count_by_free_text_index(source_id, 'log', 'disk', since), 3)
+        self.assertEqual(sum([count for (hour, count) in dao.histogram_by_free_text_index(source_id, 'log', 'disk', start, since + timedelta(days=3), timedelta(days=1))]), 6)
+        index_row_key = BlobIndexDTO(source_id, 'log', 'full', None, None).get_row_key()
+        self.assertEqual(dao.get_index_entry_row_keys(index_row_key, start), [index_row_key + '-1979062000', index_row_key])
+        self.assertEqual(dao.get_index_entry_row_keys(index_row_key, since), [dao.get_index_bucket_row_key(index_row_key, since)])
+        legacy_dao.dispose()
+        dao.dispose()
+
+    def test_should_return_the_newest_hits_first_and_only_load_their_blobs(self):
+        # Given, ten hits over ten days, with and without index buckets
+        for dao in (TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space), TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, index_bucket=timedelta(days=1))):
+            source_id = 'NewestFirstTest-%s' % time.time()
+            start = self.ts('1979-06-20T12:00:00')
+            dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes([TimestampedDataDTO(source_id, start + timedelta(days=i), 'log', 'timeout %s' % i) for i in range(0, 10)])
+
+            # When
+            newest = dao.get_blobs_by_free_text_index(source_id, 'log', 'timeout', start, start + timedelta(days=10), column_count=3, newest_first=True)
+            before_day_5 = dao.get_blob_hits_by_free_text_index(source_id, 'log', 'timeout', start, start + timedelta(days=5), column_count=2, newest_first=True)
+
+            # Then
+            self.assertEqual([blob for (timestamp, blob) in newest], ['timeout 9', 'timeout 8', 'timeout 7'])
+            self.assertEqual([hit.timestamp for hit in before_day_5], [start + timedelta(days=5), start + timedelta(days=4)])
+            self.assertEqual([blob for (timestamp, blob) in dao.get_blobs_multi_data_by_free_text_index(source_id, ['log', 'other'], 'timeout', start, start + timedelta(days=10), column_count=2, newest_first=True)], ['timeout 9', 'timeout 8'])
+            dao.dispose()
+
+    def test_should_count_the_hits_per_hour_from_the_index_or_the_hit_counters(self):
+        # Given, hits every 20 minutes over four hours across a month boundary
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True, index_hit_counts=True)
+        source_id = 'HistogramTest-%s' % time.time()
+        start = self.ts('1979-06-30T22:00:00')
+        dtos = [TimestampedDataDTO(source_id, start + timedelta(minutes=20 * i, seconds=1), 'log', 'timeout %s' % i) for i in range(0, 12)]
+        dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes(dtos[:6])
+        for dto in dtos[6:]:
+            dao.insert_indexable_text_as_blob_data_and_insert_index(dto)
+
+        # When
+        from_counters = dao.histogram_by_free_text_index(source_id, 'log', 'timeout', start, start + timedelta(hours=4, minutes=30))
+        from_index = dao.histogram_by_free_text_index(source_id, 'log', 'timeout', start, start + timedelta(hours=4, minutes=30), use_hit_counts=False)
+
+        # Then
+        expected = [(start + timedelta(hours=i), 3) for i in range(0, 4)] + [(start + timedelta(hours=4), 0)]
+        self.assertEqual(from_counters, expected)
+        self.assertEqual(from_index, expected)
+        self.assertEqual(dao.histogram_by_free_text_index(source_id, 'log', 'timeout', start + timedelta(minutes=30), start + timedelta(hours=4), bucket_size=timedelta(minutes=90)), [(start + timedelta(minutes=30), 4), (start + timedelta(hours=2), 5), (start + timedelta(hours=3, minutes=30), 1)])
+        dao.dispose()
+
+    def test_should_load_a_projected_latest_data_snapshot_of_many_sources_through_the_cache(self):
+        # Given, two data names of 450 sources in one batch, more than two multigets
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, latest_data_cache_ttl=60)
+        prefix = 'LatestSnapshotTest-%s-' % time.time()
+        source_ids = [prefix + str(i) for i in range(0, 450)]
+        start = self.ts('1979-06-20T12:00:00')
+        dtos = [TimestampedDataDTO(source_id, start + timedelta(seconds=i), data_name, '%s' % i) for source_id in source_ids for data_name in ('temp', 'hum') for i in range(0, 2)]
+        dao.batch_insert_timestamped_data(dtos, set_latest=True)
+        dao.latest_data_cache.invalidate()
+
+        # When
+        snapshot = dao.load_latest_data_snapshot([prefix + 'unknown'] + list(reversed(source_ids)), ['temp'])
+        cached = dao.load_latest_data_snapshot(source_ids[:2], ['temp'])
+        dao.insert_latest_data_by_dict(source_ids[0], {'temp': '42'})
+
+        # Then
+        self.assertEqual(snapshot.keys(), list(reversed(source_ids)))
+        self.assertEqual(snapshot[source_ids[0]], {'temp': '1', 'temp-ts': str(TimestampedDataDTO(source_ids[0], start + timedelta(seconds=1), 'temp', '1').timestamp_as_unix_time_millis())})
+        self.assertEqual(cached.keys(), source_ids[:2])
+        self.assertEqual(dao.latest_data_cache.hits, 2)
+        self.assertEqual(dao.load_latest_data_snapshot(source_ids[:1], ['temp'])[source_ids[0]]['temp'], '42')
+        self.assertEqual(sorted(dao.load_latest_data_snapshot(source_ids[:1], use_cache=False)[source_ids[0]].keys()), ['hum', 'hum-ts', 'temp', 'temp-ts'])
+        self.assertEqual(dao.load_latest_data(source_ids[1], 'hum').keys(), ['hum', 'hum-ts'])
+        dao.dispose()
+
+    def test_should_catalog_series_with_first_and_last_seen_hour_and_point_count(self):
+        # Given
+        dao = TimeSeriesCassandraDao(self.cassandra_hosts, self.key_space, disable_high_res_column_name_randomization=True, series_catalog=True)
+        source_id = 'CatalogTest-%s' % time.time()
+        start = self.ts('1979-06-20T00:00:00')
+
+        # When, the later hour is written first
+        dao.batch_insert_timestamped_data([TimestampedDataDTO(source_id, start + timedelta(hours=5, seconds=i), 'cpu.user', str(i)) for i in range(0, 3)])
+        dao.batch_insert_timestamped_data([TimestampedDataDTO(source_id, start + timedelta(seconds=i), 'cpu.user', str(i)) for i in range(0, 2)])
+        dao.insert_timestamped_data(TimestampedDataDTO(source_id, start, 'mem', '1'))
+
+        # Then
+        self.assertTrue(source_id in dao.list_sources('CatalogTest-'))
+        series = dao.list_series(source_id)
+        self.assertEqual([info.data_name for info in series], ['cpu.user', 'mem'])
+        self.assertEqual(series[0].first_seen, start)
+        self.assertEqual(series[0].last_seen, start + timedelta(hours=5))
+        self.assertEqual(series[0].point_count, 5)
+        self.assertEqual([info.data_name for info in dao.list_series(source_id, 'cpu')], ['cpu.user'])
+        dao.dispose()
+
     def test_should_insert_latest_data_with_different_timestamps_and_only_newest_should_be_loaded(self):
         source_id = 'latest_test_1C'
 
@@ -566,6 +970,117 @@ class IndexedBlobsIntegrationTests(PyCatsIntegrationTestBase):
         # Should only find middle instance for given range
         self.assertEqual(len(result), 0)
 
+    def test_should_store_a_large_indexable_text_compressed_and_load_it_by_index(self):
+        source_id = 'indexed_test_8'
+        data_name = 'large_text'
+        data_value_unicode = u'Traceback (most recent call last): File "örth.py", line 666, in sea ' * 50000
+        beastly_timestamp = datetime.strptime('1982-03-01T06:06:06', '%Y-%m-%dT%H:%M:%S')
+
+        dto = TimestampedDataDTO(source_id, beastly_timestamp, data_name, data_value_unicode, u'large stack trace')
+        self.dao.insert_indexable_text_as_blob_data_and_insert_index(dto)
+
+        result = self.dao.get_blobs_by_free_text_index(source_id, data_name, 'stack trace')
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0][0], beastly_timestamp)
+        self.assertEqual(result[0][1], data_value_unicode)
+
+    def test_should_merge_multi_data_search_on_time_and_only_return_column_count_blobs(self):
+        source_id = 'indexed_test_10'
+        data_names = ['merge_error', 'merge_warn', 'merge_info']
+        start = datetime.strptime('1982-03-01T06:00:00', '%Y-%m-%dT%H:%M:%S')
+
+        # Interleave the data_names in time
+        dtos = list()
+        for i in range(0, 30):
+            dtos.append(TimestampedDataDTO(source_id, start + timedelta(seconds=i), data_names[i % 3], u'Merged message %s' % i))
+        self.dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes(dtos)
+
+        result = self.dao.get_blobs_multi_data_by_free_text_index(source_id, data_names, 'merged message', column_count=7)
+
+        self.assertEqual(len(result), 7)
+        for i in range(0, 7):
+            self.assertEqual(result[i][0], start + timedelta(seconds=i))
+            self.assertEqual(result[i][1], u'Merged message %s' % i)
+
+    def test_should_batch_insert_a_timestamped_batch_and_load_it_by_index(self):
+        # Given
+        source_id = 'BatchTest'
+        data_name = 'text'
+        start = datetime.strptime('1979-06-20T10:10:10', '%Y-%m-%dT%H:%M:%S')
+        batch = TimestampedBatch()
+        for i in range(0, 10):
+            batch.append(source_id, start + timedelta(seconds=i), data_name, u'Column wise message %s' % i)
+
+        # When
+        self.dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes(batch)
+
+        # Then
+        self.assertEqual(len(self.dao.get_timetamped_data_range(source_id, data_name, start, start + timedelta(seconds=10))), 10)
+        result = self.dao.get_blobs_by_free_text_index(source_id, data_name, 'column wise')
+        self.assertEqual(len(result), 10)
+        self.assertEqual(result[3], (start + timedelta(seconds=3), u'Column wise message 3'))
+
+    def test_should_count_and_lazily_load_free_text_hits(self):
+        source_id = 'indexed_test_9'
+        data_name = 'paged_text'
+        start = datetime.strptime('1982-03-01T06:00:00', '%Y-%m-%dT%H:%M:%S')
+
+        dtos = list()
+        for i in range(0, 25):
+            dtos.append(TimestampedDataDTO(source_id, start + timedelta(seconds=i), data_name, u'Page me number %s' % i))
+        self.dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes(dtos)
+
+        self.assertEqual(self.dao.count_by_free_text_index(source_id, data_name, 'page me'), 25)
+        self.assertEqual(self.dao.count_by_free_text_index(source_id, data_name, 'page me', start, start + timedelta(seconds=9)), 10)
+
+        result = self.dao.search_blobs_by_free_text_index(source_id, data_name, 'page me', prefetch_window=10)
+        self.assertEqual(len(result), 25)
+        self.assertEqual(result.timestamps()[24], start + timedelta(seconds=24))
+
+        second_page = result.page(1, 20)
+        self.assertEqual(len(second_page), 5)
+        self.assertEqual(second_page[0][1], u'Page me number 20')
+
+        self.assertEqual(len(list(result)), 25)
+
+class ColumnNameGeneratorTest(unittest.TestCase):
+
+    def test_should_generate_unique_names_that_floor_to_the_microsecond(self):
+        generator = ColumnNameGenerator(node_id=7)
+        timestamp = datetime.strptime('1979-06-20T06:06:06.123456', '%Y-%m-%dT%H:%M:%S.%f')
+
+        names = [generator.column_name(timestamp) for i in range(0, 1000)] + generator.column_names([timestamp] * 200)
+
+        self.assertEqual(len(set(names[:1000])), 1000)
+        self.assertEqual(len(set(names[1000:])), 200)
+        for name in names:
+            self.assertEqual(name / 10**6, micros_since_start_of_hour(timestamp))
+            self.assertTrue(7000 < name % 10**6 <= 8000)
+
+    def test_should_keep_node_ids_apart_and_refuse_bad_ones(self):
+        timestamp = datetime.strptime('1979-06-20T06:06:06', '%Y-%m-%dT%H:%M:%S')
+        first = set(ColumnNameGenerator(node_id=0).column_names([timestamp] * 1000))
+        second = set(ColumnNameGenerator(node_id=998).column_names([timestamp] * 1000))
+
+        self.assertEqual(len(first | second), 2000)
+        self.assertTrue(max(second) % 10**6 < 10**6)
+        self.assertRaises(ValueError, ColumnNameGenerator, 999)
+
+    def test_should_use_the_whole_suffix_range_from_a_random_start_without_a_node_id(self):
+        timestamp = datetime.strptime('1979-06-20T06:06:06', '%Y-%m-%dT%H:%M:%S')
+        generators = [ColumnNameGenerator() for i in range(0, 5)]
+
+        names = generators[0].column_names([timestamp] * 5000)
+        starts = set([generator.next_suffix() for generator in generators[1:]])
+
+        self.assertEqual(len(set(names)), 5000)
+        for name in names:
+            self.assertTrue(0 < name % 10**6 < 10**6)
+        # Four random starts out of 999999 are all but certainly apart
+        self.assertEqual(len(starts), 4)
+
+
 class StringIndexerTest(unittest.TestCase):
     test_strings = ['<1921___.bg three cats!Left__home(early)-In.Two.CARS', 'One man left Home early!!', 'two Woman left homE Late?', 'one Car_turned Left at Our HOME']
     string_indxer = None
@@ -672,6 +1187,1121 @@ class StringIndexerTest(unittest.TestCase):
         for index_dto in result:
             print u'Index: %s' % index_dto
 
+    def test_should_build_same_indexes_from_batch_as_from_dtos(self):
+        timestamp = datetime.utcnow()
+        dtos = [TimestampedDataDTO('the_kids', timestamp, 'log_text', 'hello indexed words of yore'), TimestampedDataDTO('the_kids', timestamp + timedelta(seconds=1), 'log_text', 'ignored', 'Other words')]
+
+        index_batch = self.string_indexer.build_indexes_from_timstamped_dto(TimestampedBatch(dtos), None)
+
+        expected = set()
+        for dto in dtos:
+            for index_dto in self.string_indexer.build_indexes_from_timstamped_dto(dto, dto.get_row_key_for_blob_data()):
+                expected.add((index_dto.get_row_key(), index_dto.timestamp, index_dto.blob_data_row_key))
+        self.assertEqual(set(zip(index_batch.row_keys(), index_batch.timestamps, index_batch.blob_data_row_keys)), expected)
+        self.assertEqual(len(list(index_batch)), len(expected))
+
+
+class BlobSerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.serializer = BlobSerializer(ZlibBlobCodec(), compression_threshold=64, chunk_size=128)
+        self.timestamp = datetime.strptime('1982-03-01T06:06:06', '%Y-%m-%dT%H:%M:%S')
+
+    def test_should_store_small_blob_as_is(self):
+        data_value = u'Woe to you o örth ánd sea'
+
+        columns = self.serializer.to_columns(self.timestamp, data_value)
+
+        self.assertEqual(columns, {self.timestamp : data_value})
+
+    def test_should_compress_large_unicode_blob_and_restore_it(self):
+        data_value = u'Woe to you o örth ánd sea. For the devil sends the beast with wrath. ' * 10
+
+        columns = self.serializer.to_columns(self.timestamp, data_value)
+
+        stored_size = sum([len(value) for value in columns.values()])
+        self.assertLess(stored_size, len(data_value.encode('utf-8')))
+        self.assertEqual(self.serializer.from_columns(self.__as_loaded_row(columns)), (self.timestamp, data_value))
+
+    def test_should_chunk_blob_over_several_columns_and_reassemble_it(self):
+        serializer = BlobSerializer(None, chunk_size=128)
+        data_value = ''.join([chr(i % 256) for i in range(0, 1000)])
+
+        columns = serializer.to_columns(self.timestamp, data_value)
+
+        # Header and base64 of the 1000 bytes
+        self.assertEqual(len(columns), 11)
+        self.assertEqual(min(columns.keys()), self.timestamp)
+        self.assertEqual(serializer.from_columns(self.__as_loaded_row(columns)), (self.timestamp, data_value))
+
+    def test_should_return_legacy_blob_untouched(self):
+        row = self.__as_loaded_row({self.timestamp : 'Tue Mar  5 14:41:33 Hans-Eklunds-MacBook-Pro'})
+
+        self.assertEqual(self.serializer.from_columns(row), (self.timestamp, 'Tue Mar  5 14:41:33 Hans-Eklunds-MacBook-Pro'))
+
+    def test_should_return_legacy_blobs_starting_with_a_control_character_untouched(self):
+        for legacy in (u'\x1b[31mERROR\x1b[0m disk full', '\x10abc', '\x11eJzLSM3JyVcozy/KSQEAGgQEXQ==\n', u'\x19\u20ac'):
+            self.assertEqual(self.serializer.decode(legacy), legacy)
+        row = self.__as_loaded_row({self.timestamp : '\x1b[1;32mINFO\x1b[0m started'})
+        self.assertEqual(self.serializer.from_columns(row), (self.timestamp, u'\x1b[1;32mINFO\x1b[0m started'))
+
+    def test_should_wrap_small_blob_that_looks_like_an_encoded_blob(self):
+        data_value = chr(0x11) + 'not really compressed'
+
+        columns = self.serializer.to_columns(self.timestamp, data_value)
+
+        self.assertNotEqual(columns[self.timestamp], data_value)
+        self.assertEqual(self.serializer.from_columns(self.__as_loaded_row(columns)), (self.timestamp, data_value))
+
+    # BlobData values are utf-8 validated, pycassa returns them as unicode
+    def __as_loaded_row(self, columns):
+        return OrderedDict(sorted([(column_name, value.decode('utf-8') if isinstance(value, str) else value) for (column_name, value) in columns.items()]))
+
+
+class LazyBlobSearchResultTest(unittest.TestCase):
+
+    def setUp(self):
+        start = datetime.strptime('1982-03-01T06:06:06', '%Y-%m-%dT%H:%M:%S')
+        self.hits = [BlobIndexHitDTO(start + timedelta(seconds=i), 'key-%s' % i) for i in range(0, 45)]
+        self.loaded_batches = list()
+
+    def __blob_loader(self, hits, to_list_of_tuples):
+        self.loaded_batches.append(len(hits))
+        return [(hit.timestamp, 'blob for %s' % hit.blob_data_row_key) for hit in hits]
+
+    def test_should_count_hits_without_loading_any_blobs(self):
+        result = LazyBlobSearchResult(self.__blob_loader, self.hits)
+
+        self.assertEqual(len(result), 45)
+        self.assertEqual(result.page_count(20), 3)
+        self.assertEqual(self.loaded_batches, [])
+
+    def test_should_load_only_the_requested_page(self):
+        result = LazyBlobSearchResult(self.__blob_loader, self.hits)
+
+        page = result.page(2, 20)
+
+        self.assertEqual(len(page), 5)
+        self.assertEqual(page[0][1], 'blob for key-40')
+        self.assertEqual(self.loaded_batches, [5])
+
+    def test_should_load_blobs_in_prefetch_windows_while_iterating(self):
+        result = LazyBlobSearchResult(self.__blob_loader, self.hits, prefetch_window=10)
+
+        iterator = iter(result)
+        first = iterator.next()
+        self.assertEqual(first[1], 'blob for key-0')
+        self.assertEqual(self.loaded_batches, [10])
+
+        rest = list(iterator)
+        self.assertEqual(len(rest), 44)
+        self.assertEqual(self.loaded_batches, [10, 10, 10, 10, 5])
+
+
+class MergeIndexRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.start = datetime.strptime('1982-03-01T06:00:00', '%Y-%m-%dT%H:%M:%S')
+
+    def __row(self, name, seconds):
+        return [(self.start + timedelta(seconds=s), '%s-%s' % (name, s)) for s in seconds]
+
+    def test_should_merge_index_rows_on_timestamp_and_stop_at_count(self):
+        rows = [self.__row('error', [1, 5, 9]), self.__row('warn', [2, 3, 10]), self.__row('info', []), self.__row('debug', [4])]
+
+        merged = merge_index_rows(rows, 5)
+
+        self.assertEqual([key for (timestamp, key) in merged], ['error-1', 'warn-2', 'warn-3', 'debug-4', 'error-5'])
+
+    def test_should_merge_newest_first_rows(self):
+        rows = [self.__row('error', [9, 5, 1]), self.__row('warn', [10, 3, 2])]
+
+        merged = merge_index_rows(rows, 3, newest_first=True)
+
+        self.assertEqual([key for (timestamp, key) in merged], ['warn-10', 'error-9', 'error-5'])
+
+    def test_should_map_in_parallel_and_keep_order(self):
+        reader = ParallelReader(4)
+        try:
+            self.assertEqual(reader.map(lambda x: x * 2, range(0, 20)), range(0, 40, 2))
+        finally:
+            reader.close()
+
+
+class AsyncCallTest(unittest.TestCase):
+
+    def test_should_run_call_and_notify_callbacks(self):
+        call = AsyncCall(lambda a, b=0: a + b, (1,), {'b': 2})
+        done = list()
+        call.add_done_callback(lambda c: done.append(c.result(0)))
+
+        threading.Thread(target=call._run).start()
+
+        self.assertEqual(call.result(5), 3)
+        self.assertEqual(done, [3])
+
+    def test_should_raise_exception_of_failed_call(self):
+        call = AsyncCall(lambda: 1 / 0, (), {})
+        call._run()
+
+        self.assertRaises(ZeroDivisionError, call.result, 0)
+
+    def test_should_cancel_pending_call_but_not_run_it(self):
+        ran = list()
+        call = AsyncCall(lambda: ran.append(1), (), {})
+
+        self.assertTrue(call.cancel())
+        call._run()
+
+        self.assertEqual(ran, [])
+        self.assertRaises(AsyncCancelledException, call.result, 0)
+
+    def test_should_time_out_waiting_for_pending_call(self):
+        call = AsyncCall(lambda: 1, (), {})
+
+        self.assertRaises(AsyncTimeoutException, call.result, 0.01)
+
+    def test_should_iterate_range_loaded_by_producer(self):
+        iterator = AsyncRangeIterator(prefetch_size=2, timeout=5)
+        iterator.producer = AsyncCall(iterator._produce, (iter(range(0, 10)),), {})
+        threading.Thread(target=iterator.producer._run).start()
+
+        self.assertEqual(list(iterator), range(0, 10))
+
+    def test_should_stop_producing_when_the_iterator_is_dropped(self):
+        iterator = AsyncRangeIterator(prefetch_size=1, timeout=30)
+        producer = threading.Thread(target=AsyncCall(iterator._produce, (self.__endless(),), {})._run)
+        producer.start()
+        self.assertEqual(iterator.next(), 0)
+
+        # Like breaking out of a for loop
+        del iterator
+        producer.join(5)
+
+        self.assertFalse(producer.is_alive())
+
+    def test_should_stop_producing_when_nothing_is_consumed_within_the_timeout(self):
+        iterator = AsyncRangeIterator(prefetch_size=1, timeout=0.2)
+        producer = threading.Thread(target=AsyncCall(iterator._produce, (self.__endless(),), {})._run)
+        producer.start()
+
+        producer.join(5)
+
+        self.assertFalse(producer.is_alive())
+        self.assertRaises(AsyncTimeoutException, list, iterator)
+
+    def __endless(self):
+        i = 0
+        while True:
+            yield i
+            i += 1
+
+
+class PoolStatsTest(unittest.TestCase):
+
+    class FakePool():
+        def overflow(self):
+            return 0
+
+    class FakeConnection():
+        def __init__(self, pool, server):
+            self._pool = pool
+            self.server = server
+
+    def test_should_count_checkouts_and_prefer_the_fastest_host(self):
+        stats = PoolStats()
+        pool = self.FakePool()
+        slow = self.FakeConnection(pool, 'slow:9160')
+        fast = self.FakeConnection(pool, 'fast:9160')
+
+        stats.connection_checked_out({'connection': fast})
+        stats.connection_checked_in({'connection': fast})
+        stats.connection_checked_out({'connection': slow})
+        stats.connection_failed({'server': 'slow:9160'})
+        stats.connection_disposed({'connection': slow})
+
+        self.assertEqual(stats.fastest_server(['slow:9160', 'fast:9160']), 'fast:9160')
+        # A host that has not been measured yet is tried first
+        self.assertEqual(stats.fastest_server(['slow:9160', 'fast:9160', 'new:9160']), 'new:9160')
+        result = stats.as_dict()
+        self.assertEqual(result['checkouts'], 2)
+        self.assertEqual(result['checkins'], 1)
+        self.assertEqual(result['failures'], 1)
+        self.assertEqual(result['host_failures'], {'slow:9160': 1})
+
+    class FakeConnectionWrapper(pycassa.pool.ConnectionWrapper):
+        def __init__(self, pool, server):
+            self._pool = pool
+            self.server = server
+            self.info = {}
+            self.operation_count = 0
+            self._state = pycassa.pool.ConnectionWrapper._CHECKED_OUT
+
+        def close(self):
+            pass
+
+    class FakeConnectionPool(ManagedConnectionPool):
+        def _get_new_wrapper(self, server):
+            return PoolStatsTest.FakeConnectionWrapper(self, server)
+
+    def test_should_count_a_pool_at_max_and_raise_no_connection_available(self):
+        pool = self.FakeConnectionPool('ks', ['localhost:9160'], pool_size=1, max_overflow=1, prefill=False, pool_timeout=0.01, use_threadlocal=False)
+        pool.get()
+        pool.get()
+
+        self.assertRaises(pycassa.pool.NoConnectionAvailable, pool.get)
+        self.assertRaises(pycassa.pool.NoConnectionAvailable, pool.get)
+
+        stats = pool.get_stats()
+        self.assertEqual(stats['pool_at_max_count'], 2)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['peak_overflow'], 1)
+
+
+class RecordingDao():
+    # Stands in for the TimeSeriesCassandraDao when only the calls made by a facade are of interest
+    def __init__(self, gate=None):
+        self.calls = list()
+        self.round_trips = 0
+        self.gate = gate
+
+    def batch_insert_indexable_text_as_blob_data_and_insert_indexes_by_ttl(self, dtos_by_ttl):
+        if self.gate:
+            self.gate.wait()
+        self.round_trips += 1
+        for (ttl, dtos) in dtos_by_ttl.items():
+            self.calls.append(([dto for dto in dtos if dto is not None], ttl))
+
+
+class LogRecordTest(unittest.TestCase):
+
+    def test_should_encode_and_decode_fields_containing_pipes(self):
+        record = encode_log_record('billing', u'invoices', 'warn', u'Sum | VAT | total is 100 \u20ac')
+
+        self.assertTrue(isinstance(record, str))
+        self.assertEqual(peek_level(record), 'warn')
+        self.assertEqual(decode_log_record(record), [u'billing', u'invoices', 'warn', u'Sum | VAT | total is 100 \u20ac'])
+
+    def test_should_encode_records_as_valid_utf8_and_decode_them_as_loaded_by_pycassa(self):
+        for length in (127, 128, 200, 70000):
+            record = encode_log_record(u'billing \u20ac', 'invoices', 'error', 'x' * length)
+
+            loaded = record.decode('utf-8')
+
+            self.assertEqual(peek_level(loaded), 'error')
+            self.assertEqual(decode_log_record(loaded), [u'billing \u20ac', u'invoices', 'error', u'x' * length])
+
+    def test_should_decode_version_1_records(self):
+        record = struct.pack('>cBBHHI', '\x00', 1, 3, 7, 8, 9) + 'billinginvoicesSum | VAT'
+
+        self.assertEqual(decode_log_record(record.decode('utf-8')), [u'billing', u'invoices', 'error', u'Sum | VAT'])
+
+    def test_should_decode_legacy_pipe_delimited_records(self):
+        self.assertEqual(decode_log_record('billing|invoices|error|Sum | VAT'), ['billing', 'invoices', 'error', 'Sum | VAT'])
+        self.assertEqual(peek_level('billing|invoices|error|Sum | VAT'), 'error')
+
+    def test_should_refuse_unknown_versions(self):
+        record = encode_log_record('billing', 'invoices', 'info', 'From the future')
+        self.assertRaises(UnknownLogRecordVersionException, decode_log_record, record[0] + '\x7f' + record[2:])
+
+
+class CassandraLoggerStoreTest(unittest.TestCase):
+
+    def test_should_store_all_copies_in_one_call_whatever_the_ttls(self):
+        dao = RecordingDao()
+        logger = CassandraLogger(dao, ttl_days_for_exact=1, ttl_days_for_source_context=2, ttl_days_for_global_context=3)
+
+        logger.log('StoreTest', 'unittest', datetime.strptime('1979-06-20T06:06:06', '%Y-%m-%dT%H:%M:%S'), 'error', u'One call only')
+
+        self.assertEqual(dao.round_trips, 1)
+        self.assertEqual(sorted([ttl for (dtos, ttl) in dao.calls]), [1*24*60*60, 2*24*60*60, 3*24*60*60])
+        self.assertEqual(sum([len(dtos) for (dtos, ttl) in dao.calls]), 6)
+
+
+class BufferedCassandraLoggerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timestamp = datetime.strptime('1979-06-20T06:06:06', '%Y-%m-%dT%H:%M:%S')
+
+    def test_should_write_all_records_grouped_by_ttl_on_flush(self):
+        dao = RecordingDao()
+        logger = BufferedCassandraLogger(dao, ttl_days_for_exact=7, flush_on_exit=False)
+
+        for i in range(0, 100):
+            logger.log('BufferedTest', 'unittest', self.timestamp, 'error', u'Buffered message %s' % i)
+        logger.flush()
+
+        # Two copies with 7 days TTL and four with 14 days per message
+        self.assertEqual(logger.written_records, 100)
+        self.assertEqual(sum([len(dtos) for (dtos, ttl) in dao.calls if ttl == 7*24*60*60]), 200)
+        self.assertEqual(sum([len(dtos) for (dtos, ttl) in dao.calls if ttl == 14*24*60*60]), 400)
+        self.assertLessEqual(len(dao.calls), 200)
+        logger.close()
+
+    def test_should_drop_records_when_queue_is_full_and_write_the_rest_on_close(self):
+        gate = threading.Event()
+        dao = RecordingDao(gate)
+        logger = BufferedCassandraLogger(dao, max_queue_size=5, overflow_policy=DROP, flush_on_exit=False)
+
+        for i in range(0, 20):
+            logger.log('BufferedTest', 'unittest', self.timestamp, 'info', u'Buffered message %s' % i)
+        gate.set()
+        logger.close()
+
+        self.assertGreater(logger.dropped_records, 0)
+        self.assertEqual(logger.written_records + logger.dropped_records, 20)
+
+    def test_should_refuse_records_while_closing_and_never_hang_flush(self):
+        logger = BufferedCassandraLogger(RecordingDao(), max_queue_size=10, linger=0, flush_on_exit=False)
+        refused = list()
+
+        def log_until_closed():
+            try:
+                while True:
+                    logger.log('BufferedTest', 'unittest', self.timestamp, 'info', u'Racing the close')
+            except LoggerClosedException:
+                refused.append(True)
+        writers = [threading.Thread(target=log_until_closed) for i in range(0, 4)]
+        for writer in writers:
+            writer.start()
+        time.sleep(0.05)
+        logger.close()
+        for writer in writers:
+            writer.join(5)
+
+        flusher = threading.Thread(target=logger.flush)
+        flusher.daemon = True
+        flusher.start()
+        flusher.join(5)
+        self.assertFalse(flusher.is_alive())
+        self.assertEqual(len(refused), 4)
+        self.assertEqual(logger.queued_records(), 0)
+
+    def test_should_let_go_of_closed_loggers(self):
+        logger = BufferedCassandraLogger(RecordingDao())
+        logger.close()
+        reference = weakref.ref(logger)
+
+        del logger
+        gc.collect()
+
+        self.assertEqual(reference(), None)
+
+
+class CassandraLogHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dao = RecordingDao()
+        self.cassandra_logger = BufferedCassandraLogger(self.dao, overflow_policy=DROP, max_queue_size=100000, flush_on_exit=False)
+        self.handler = CassandraLogHandler(self.cassandra_logger)
+        self.logger = logging.getLogger('handlertest.unittest')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.cassandra_logger.close()
+
+    def test_should_map_logger_name_and_level_onto_cassandra_logger(self):
+        self.logger.critical('Disk %s is full', 'sda1')
+        self.handler.flush()
+
+        exact_dtos = [dto for (dtos, ttl) in self.dao.calls for dto in dtos if dto.source_id == 'handlertest.unittest']
+        self.assertEqual(len(exact_dtos), 2)
+        self.assertEqual(exact_dtos[0].str_for_index, 'Disk sda1 is full')
+        self.assertEqual(exact_dtos[0].data_name, self.cassandra_logger.ext_level_to_internal['error'])
+
+        self.assertEqual(self.handler.map_name('single'), ('single', 'single'))
+        self.assertEqual(self.handler.map_level(logging.WARNING), 'warn')
+        self.assertEqual(self.handler.map_level(logging.DEBUG), 'debug')
+
+    def test_should_keep_the_overhead_per_record_low(self):
+        count = 10000
+        records = [self.logger.makeRecord(self.logger.name, logging.INFO, 'tests.py', 1, 'Request %s served', (i,), None) for i in range(0, count)]
+
+        # Only the time spent in the handler, the logging module adds its own overhead for creating the records
+        start = time.time()
+        for record in records:
+            self.handler.handle(record)
+        micros_per_record = (time.time() - start) * 10**6 / count
+        self.handler.flush()
+
+        # Some 15 micro seconds on a laptop, the bound leaves room for slow build machines but not for
+        # writing in the calling thread
+        self.assertLess(micros_per_record, 500)
+        self.assertEqual(self.cassandra_logger.written_records + self.cassandra_logger.dropped_records, count)
+
+
+class ShardStore():
+    # Stands in for the hourly shards of the TimeSeriesCassandraDao, column names are exact picoseconds
+    def __init__(self):
+        self.shards = dict()
+
+    def floor_timestamp_to_hour(self, timestamp):
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    def __picos(self, timestamp):
+        return ((timestamp.minute * 60 + timestamp.second) * 10**6 + timestamp.microsecond) * 10**6
+
+    def write(self, timestamp, value):
+        self.shards.setdefault(self.floor_timestamp_to_hour(timestamp), dict())[self.__picos(timestamp)] = (timestamp, value)
+
+    def get_hourly_shard_columns(self, source_id, metric_name, start_datetime, column_start=None, max_count=1000):
+        shard = self.shards.get(self.floor_timestamp_to_hour(start_datetime), dict())
+        if column_start is None:
+            column_start = self.__picos(start_datetime)
+        column_names = sorted([column_name for column_name in shard.keys() if column_name >= column_start])[:max_count]
+        return [(column_name, shard[column_name][0], shard[column_name][1]) for column_name in column_names]
+
+
+class ShardCursorTest(unittest.TestCase):
+
+    def test_should_only_return_new_and_late_columns_and_move_to_next_shard(self):
+        store = ShardStore()
+        now = [datetime.strptime('1979-06-20T06:59:56', '%Y-%m-%dT%H:%M:%S')]
+        cursor = ShardCursor(store, 'tail', 'text', datetime.strptime('1979-06-20T06:59:50', '%Y-%m-%dT%H:%M:%S'), grace=2, clock=lambda: now[0])
+
+        store.write(datetime.strptime('1979-06-20T06:59:40', '%Y-%m-%dT%H:%M:%S'), 'before start')
+        store.write(datetime.strptime('1979-06-20T06:59:55', '%Y-%m-%dT%H:%M:%S'), 'a')
+        self.assertEqual([value for (timestamp, value) in cursor.read()], ['a'])
+        self.assertEqual(cursor.read(), [])
+
+        # Written late, but within the grace period
+        store.write(datetime.strptime('1979-06-20T06:59:54', '%Y-%m-%dT%H:%M:%S'), 'late')
+        self.assertEqual([value for (timestamp, value) in cursor.read()], ['late'])
+
+        # The next shard is read once the grace period of the current hour has passed
+        store.write(datetime.strptime('1979-06-20T07:00:01', '%Y-%m-%dT%H:%M:%S'), 'b')
+        now[0] = datetime.strptime('1979-06-20T07:00:01', '%Y-%m-%dT%H:%M:%S')
+        self.assertEqual(cursor.read(), [])
+        now[0] = datetime.strptime('1979-06-20T07:00:03', '%Y-%m-%dT%H:%M:%S')
+        self.assertEqual([value for (timestamp, value) in cursor.read()], ['b'])
+        self.assertEqual(cursor.shard_start, datetime.strptime('1979-06-20T07:00:00', '%Y-%m-%dT%H:%M:%S'))
+
+    def test_should_read_in_batches(self):
+        store = ShardStore()
+        start = datetime.strptime('1979-06-20T06:00:00', '%Y-%m-%dT%H:%M:%S')
+        for i in range(0, 5):
+            store.write(start + timedelta(seconds=i), i)
+        cursor = ShardCursor(store, 'tail', 'text', start, batch_size=2, clock=lambda: start + timedelta(minutes=1))
+
+        self.assertEqual([value for (timestamp, value) in cursor.read()], [0, 1])
+        self.assertEqual([value for (timestamp, value) in cursor.read()], [2, 3])
+        self.assertEqual([value for (timestamp, value) in cursor.read()], [4])
+
+
+class ListCursor():
+    # Returns the next list of entries on every read
+    def __init__(self, batches):
+        self.batches = batches
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        if self.batches:
+            return self.batches.pop(0)
+        return []
+
+
+class SharedTailTest(unittest.TestCase):
+
+    def test_should_share_reads_between_followers(self):
+        cursor = ListCursor([[1, 2], [3], [4, 5, 6]])
+        now = [0]
+        shared_tail = SharedTail(cursor, min_interval=1, buffer_size=2, clock=lambda: now[0])
+        first = TailFollower(shared_tail)
+        second = TailFollower(shared_tail)
+
+        self.assertEqual(first.poll(), [1, 2])
+        self.assertEqual(second.poll(), [1, 2])
+        self.assertEqual(cursor.reads, 1)
+
+        now[0] = 1
+        self.assertEqual(second.poll(), [3])
+        self.assertEqual(first.poll(), [3])
+        self.assertEqual(cursor.reads, 2)
+
+        # 4 has left the buffer before the first follower got it
+        now[0] = 2
+        self.assertEqual(second.poll(), [5, 6])
+        self.assertEqual(first.poll(), [5, 6])
+        self.assertEqual(first.missed, 1)
+
+    def test_should_share_tails_of_the_same_series_until_closed(self):
+        hub = TailHub(ShardStore())
+        first = hub.follow('tail', 'text')
+        second = hub.follow('tail', 'text')
+        other = hub.follow('tail', 'other')
+        self.assertEqual(sorted(hub.followed_series()), [('tail', 'other'), ('tail', 'text')])
+
+        first.close()
+        other.close()
+        self.assertEqual(hub.followed_series(), [('tail', 'text')])
+        second.close()
+        self.assertEqual(hub.followed_series(), [])
+
+
+class BucketAggregatesTest(unittest.TestCase):
+
+    def test_should_aggregate_values_per_bucket_and_skip_non_numbers(self):
+        aggregates = BucketAggregates(3)
+        aggregates.add([0, 0, 2, 2], [1, '3', 5, 'n/a'])
+        self.assertEqual(aggregates.results((COUNT, SUM, MEAN, MIN, MAX)),
+                         [{COUNT: 2, SUM: 4.0, MEAN: 2.0, MIN: 1.0, MAX: 3.0},
+                          {COUNT: 0, SUM: None, MEAN: None, MIN: None, MAX: None},
+                          {COUNT: 1, SUM: 5.0, MEAN: 5.0, MIN: 5.0, MAX: 5.0}])
+
+    def test_should_merge_partial_aggregates(self):
+        first = BucketAggregates(2, keep_samples=True)
+        first.add([0, 1], [1, 10])
+        second = BucketAggregates(2, keep_samples=True)
+        second.add([0, 0], [-1, 4])
+        first.merge(second)
+        self.assertEqual(first.results((MEAN, MIN, MAX), [50]), [{MEAN: 4 / 3.0, MIN: -1.0, MAX: 4.0, 'p50': 1.0}, {MEAN: 10.0, MIN: 10.0, MAX: 10.0, 'p50': 10.0}])
+
+    def test_should_keep_a_bounded_sample_for_percentiles(self):
+        aggregates = BucketAggregates(1, keep_samples=True, reservoir_size=100)
+        for i in range(0, 10):
+            aggregates.add([0] * 100, range(i * 100, (i + 1) * 100))
+        self.assertEqual(len(aggregates.samples[0]), 100)
+        self.assertEqual(aggregates.results((COUNT,))[0][COUNT], 1000)
+        self.assertTrue(700 < aggregates.percentile(0, 90) < 1000)
+
+
+class SeriesStore():
+    # Stands in for the hourly shards of several series, column names are exact picoseconds
+    def __init__(self):
+        self.shards = dict()
+        self.hour_presence_index = False
+        self.parallel_reader = ParallelReader(2)
+        self.reads = 0
+
+    def floor_timestamp_to_hour(self, timestamp):
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    def write(self, source_id, metric_name, timestamp, value):
+        picos = micros_since_start_of_hour(timestamp) * 10**6
+        self.shards.setdefault((source_id, metric_name, self.floor_timestamp_to_hour(timestamp)), dict())[picos] = value
+
+    def get_hourly_shard_slice(self, source_id, metric_name, hour_datetime, column_start=None, column_finish=None, max_count=1000):
+        self.reads += 1
+        shard = self.shards.get((source_id, metric_name, hour_datetime), dict())
+        column_names = sorted([column_name for column_name in shard.keys() if (column_start is None or column_name >= column_start) and (column_finish is None or column_name <= column_finish)])[:max_count]
+        return OrderedDict([(column_name, shard[column_name]) for column_name in column_names])
+
+
+class SeriesAggregatorTest(unittest.TestCase):
+
+    def test_should_aggregate_series_into_buckets_across_shards(self):
+        store = SeriesStore()
+        start = datetime.strptime('1979-06-20T06:55:00', '%Y-%m-%dT%H:%M:%S')
+        for i in range(0, 10):
+            store.write('host1', 'cpu', start + timedelta(minutes=i), str(i))
+            store.write('host2', 'cpu', start + timedelta(minutes=i), str(i * 10))
+        store.write('host1', 'cpu', start - timedelta(minutes=1), '1000')
+
+        result = SeriesAggregator(store, page_size=3).aggregate([('host1', 'cpu'), ('host2', 'cpu')], start, start + timedelta(minutes=9), timedelta(minutes=5), (SUM, COUNT))
+
+        self.assertEqual(result, [(start, {SUM: 110.0, COUNT: 10}), (start + timedelta(minutes=5), {SUM: 385.0, COUNT: 10})])
+        # Two shards of two series, in pages of 3 columns, the point before start is not read
+        self.assertEqual(store.reads, 8)
+        store.parallel_reader.close()
+
+    def test_should_aggregate_the_same_on_a_decoder_pool(self):
+        store = SeriesStore()
+        start = datetime.strptime('1979-06-20T06:55:00', '%Y-%m-%dT%H:%M:%S')
+        for i in range(0, 100):
+            store.write('host%s' % (i % 3), 'cpu', start + timedelta(seconds=i * 7), str(i))
+        series = [('host0', 'cpu'), ('host1', 'cpu'), ('host2', 'cpu')]
+        expected = SeriesAggregator(store).aggregate(series, start, start + timedelta(minutes=12), timedelta(minutes=1), (COUNT, SUM, MIN, MAX), [50])
+
+        pool = ShardDecoderPool(processes=2, slot_capacity=8)
+        result = SeriesAggregator(store, decoder_pool=pool).aggregate(series, start, start + timedelta(minutes=12), timedelta(minutes=1), (COUNT, SUM, MIN, MAX), [50])
+        pool.close()
+        store.parallel_reader.close()
+
+        self.assertEqual([(bucket, dict([(k, v) for (k, v) in values.items() if k != 'p50'])) for (bucket, values) in result],
+                         [(bucket, dict([(k, v) for (k, v) in values.items() if k != 'p50'])) for (bucket, values) in expected])
+        self.assertEqual(sum([values[COUNT] for (bucket, values) in result]), 100)
+
+    def test_should_refuse_unknown_aggregates(self):
+        store = SeriesStore()
+        self.assertRaises(UnknownAggregateException, SeriesAggregator(store).aggregate, [('host1', 'cpu')], datetime.utcnow(), datetime.utcnow(), timedelta(minutes=1), ('median',))
+        store.parallel_reader.close()
+
+
+# Runs on a ShardDecoderPool worker, module level to be picklable
+def _values_of_page(offsets, values):
+    return values
+
+
+class ShardDecoderPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ShardDecoderPool(processes=2, slots=2, slot_capacity=4, slot_bytes=24)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_should_decode_pages_through_shared_slots(self):
+        hour_epoch = 298706400
+        pending = [self.pool.submit(decode_shard_page, [0, 1500000 * 10**6], ['1.5', 'x'], (hour_epoch,)) for i in range(0, 5)]
+        for page in pending:
+            (seconds, values) = page.get(10)
+            self.assertEqual(list(seconds), [hour_epoch, hour_epoch + 1.5])
+            self.assertEqual(values[0], 1.5)
+            self.assertTrue(values[1] != values[1])
+        self.assertEqual(self.pool.inline_pages, 0)
+
+    def test_should_pass_typed_values_through_the_slots(self):
+        page = self.pool.submit(decode_shard_page, [0], [Float64ValueCodec().encode(0.0)], (0,))
+        self.assertEqual(list(page.get(10)[1]), [0.0])
+        self.assertEqual(self.pool.inline_pages, 0)
+
+    def test_should_pass_unicode_values_as_loaded_by_pycassa_through_the_slots(self):
+        page = self.pool.submit(_values_of_page, [0, 1, 2], [u'2.5', u'\u20ac', u''])
+
+        self.assertEqual(page.get(10), [u'2.5', u'\u20ac', u''])
+        self.assertEqual(self.pool.inline_pages, 0)
+        self.assertEqual(self.pool.submit(_values_of_page, [0, 1], [u'1', '\xe2\x82\xac']).get(10), [u'1', '\xe2\x82\xac'])
+        self.assertEqual(self.pool.inline_pages, 1)
+
+    def test_should_pickle_pages_that_do_not_fit_a_slot(self):
+        page = self.pool.submit(decode_shard_page, [0, 1], ['1', 'a value longer than the slot'], (0,))
+        self.assertEqual(page.get(10)[1][0], 1.0)
+        self.assertEqual(self.pool.inline_pages, 1)
+        self.assertRaises(ValueError, self.pool.submit, decode_shard_page, range(0, 5), ['1'] * 5, (0,))
+
+    def test_should_raise_worker_errors_on_get(self):
+        page = self.pool.submit(decode_shard_page, [0], ['1'], ('not an epoch',))
+        self.assertRaises(ShardDecodeException, page.get, 10)
+
+
+class ValueCodecsTest(unittest.TestCase):
+
+    def test_should_encode_typed_values_and_leave_strings_alone(self):
+        self.assertEqual(decode_value(get_value_codec('int64').encode('-42')), -42)
+        self.assertEqual(decode_value(get_value_codec('float64').encode(0.1)), 0.1)
+        self.assertEqual(len(Float64ValueCodec().encode(0.1)), 9)
+        self.assertEqual(decode_value('123456789'), '123456789')
+        self.assertEqual(decode_value('\x00legacy'), '\x00legacy')
+        self.assertEqual(decode_value('\xe2\x82\xac'), u'\u20ac')
+        self.assertEqual(decode_value('\xff'), '\xff')
+        self.assertRaises(UnknownValueCodecException, get_value_codec, 'int128')
+
+    def test_should_decode_floats_from_typed_values_and_strings(self):
+        codec = Float64ValueCodec()
+        self.assertEqual(list(decode_floats([codec.encode(i / 4.0) for i in range(0, 5)])), [0.0, 0.25, 0.5, 0.75, 1.0])
+        mixed = decode_floats([codec.encode(1.5), Int64ValueCodec().encode(2), '3.5', 'n/a'])
+        self.assertEqual(list(mixed[:3]), [1.5, 2.0, 3.5])
+        self.assertTrue(mixed[3] != mixed[3])
+
+    def test_should_decode_pages_of_typed_values_in_one_go(self):
+        floats = [0.1, 1.5, -3.25, 1e10, float('inf')] + [i / 3.0 for i in range(0, 100)]
+        self.assertEqual(decode_values([Float64ValueCodec().encode(value) for value in floats]), floats)
+        self.assertEqual(list(decode_floats([Float64ValueCodec().encode(value) for value in floats])), floats)
+        ints = [17, -1, 2**63 - 1, -2**63]
+        self.assertEqual(decode_values([Int64ValueCodec().encode(value) for value in ints]), ints)
+        self.assertEqual(list(decode_floats([Int64ValueCodec().encode(value) for value in ints[:2]])), [17.0, -1.0])
+        self.assertEqual(decode_values([Int64ValueCodec().encode(1), Float64ValueCodec().encode(0.5), '2', 3]), [1, 0.5, '2', 3])
+        self.assertEqual(decode_values([u'\x01' + u'z' * 8, u'1']), [u'\x01' + u'z' * 8, u'1'])
+        self.assertEqual(decode_values([]), [])
+
+    def test_should_pack_integers_as_delta_of_deltas(self):
+        offsets = [i * 10**12 + 7 for i in range(0, 3600)] + [-5, 0]
+        data = encode_delta_block(offsets)
+        self.assertEqual(decode_delta_block(data), (offsets, len(data)))
+        self.assertTrue(len(data) < 3700)
+
+    def test_should_pack_floats_as_xor_block(self):
+        values = [20.0, 20.0, 20.5, -3.25, 1e300, 0.0, 0.1, 0.1, 0.30000000000000004] + [i * 0.5 for i in range(0, 100)]
+        data = Float64ValueCodec().encode_block(values)
+        (decoded, position) = decode_value_block(data)
+        self.assertEqual(list(decoded), values)
+        self.assertEqual(position, len(data))
+        self.assertTrue(len(data) < 8 * len(values))
+        self.assertEqual(list(decode_value_block(Int64ValueCodec().encode_block([5, 6, 8]))[0]), [5, 6, 8])
+        self.assertEqual(list(decode_value_block(Float64ValueCodec().encode_block([]))[0]), [])
+
+    def test_should_pack_column_names_and_values_into_one_column(self):
+        column_names = [i * 10**12 + i % 7 for i in range(0, 60)]
+        values = [20 + i % 3 for i in range(0, 60)]
+        data = encode_packed_columns(column_names, values, Int64ValueCodec())
+        self.assertTrue(is_packed_columns(data))
+        self.assertFalse(is_packed_columns(Int64ValueCodec().encode(1)))
+        (decoded_names, decoded_values) = decode_packed_columns(data)
+        self.assertEqual((decoded_names, list(decoded_values)), (column_names, values))
+        self.assertRaises(ValueError, encode_packed_columns, [0], ['n/a'], Float64ValueCodec())
+
+    def test_should_pack_columns_as_valid_utf8_and_decode_them_as_loaded_by_pycassa(self):
+        values = [20.0, 0.1, -3.25, 1e10] * 50
+        loaded = encode_packed_columns(range(0, 200), values, Float64ValueCodec()).decode('utf-8')
+
+        self.assertTrue(is_packed_columns(loaded))
+        (decoded_names, decoded_values) = decode_packed_columns(loaded)
+        self.assertEqual((decoded_names, list(decoded_values)), (range(0, 200), values))
+
+
+class BlockCompactorTest(unittest.TestCase):
+
+    class PackingDao():
+        def __init__(self):
+            self.packed = list()
+            self.failing_hours = set()
+
+        def floor_timestamp_to_hour(self, timestamp):
+            return timestamp.replace(minute=0, second=0, microsecond=0)
+
+        def pack_hourly_shard(self, source_id, metric_name, hour_datetime, closed_before=None):
+            if hour_datetime in self.failing_hours:
+                raise Exception('Unavailable')
+            self.packed.append((source_id, hour_datetime.hour, closed_before.minute))
+            return 1
+
+    def test_should_pack_the_hours_since_the_previous_round(self):
+        dao = BlockCompactorTest.PackingDao()
+        now = [datetime.strptime('1979-06-20T06:20:00', '%Y-%m-%dT%H:%M:%S')]
+        compactor = BlockCompactor(dao, [('a', 'cpu'), ('b', 'cpu')], lag=timedelta(minutes=5), clock=lambda: now[0])
+
+        self.assertEqual(compactor.run_once(), 4)
+        self.assertEqual(dao.packed, [('a', 5, 15), ('a', 6, 15), ('b', 5, 15), ('b', 6, 15)])
+
+        # The current hour again, and the next one, b fails and is tried again
+        dao.packed = list()
+        dao.failing_hours.add(datetime.strptime('1979-06-20T06:00:00', '%Y-%m-%dT%H:%M:%S'))
+        now[0] = datetime.strptime('1979-06-20T07:10:00', '%Y-%m-%dT%H:%M:%S')
+        compactor.series = lambda: [('b', 'cpu')]
+        self.assertEqual(compactor.run_once(), 0)
+        self.assertEqual(compactor.errors, 1)
+        dao.failing_hours = set()
+        self.assertEqual(compactor.run_once(), 2)
+        self.assertEqual(dao.packed, [('b', 6, 5), ('b', 7, 5)])
+        self.assertEqual(compactor.packed_columns, 6)
+
+
+class CompactionJobTest(unittest.TestCase):
+
+    class CompactingDao():
+        def __init__(self, now):
+            self.now = now
+            self.packed_blocks = {'cpu': 60 * 10**12}
+            self.checkpoints = dict()
+            self.compacted = list()
+            self.failing_hours = set()
+
+        def floor_timestamp_to_hour(self, timestamp):
+            return timestamp.replace(minute=0, second=0, microsecond=0)
+
+        def is_closed_hour(self, hour_datetime):
+            return hour_datetime < self.floor_timestamp_to_hour(self.now)
+
+        def compact_hourly_shard(self, source_id, metric_name, hour_datetime):
+            if hour_datetime in self.failing_hours:
+                raise Exception('Unavailable')
+            self.compacted.append((source_id, hour_datetime.hour))
+            return 10
+
+        def load_job_checkpoints(self, job_name):
+            return dict(self.checkpoints.get(job_name, dict()))
+
+        def save_job_checkpoint(self, job_name, source_id, metric_name, hour_datetime):
+            self.checkpoints.setdefault(job_name, dict())[(source_id, metric_name)] = hour_datetime
+
+    def setUp(self):
+        self.now = datetime.strptime('1979-06-20T04:30:00', '%Y-%m-%dT%H:%M:%S')
+        self.dao = CompactionJobTest.CompactingDao(self.now)
+        self.start = datetime.strptime('1979-06-20T01:15:00', '%Y-%m-%dT%H:%M:%S')
+        self.sleeps = list()
+
+    def __job(self, **kwargs):
+        return CompactionJob(self.dao, [('a', 'cpu'), ('b', 'cpu')], self.start, clock=lambda: self.now, sleep=self.sleeps.append, **kwargs)
+
+    def test_should_carry_on_from_the_checkpoints(self):
+        self.assertEqual(self.__job().run(max_shards=4), 4)
+        self.assertEqual(self.dao.compacted, [('a', 1), ('a', 2), ('a', 3), ('b', 1)])
+
+        # Started again, b fails at 2 and is tried again the next run
+        self.dao.compacted = list()
+        self.dao.failing_hours.add(datetime.strptime('1979-06-20T02:00:00', '%Y-%m-%dT%H:%M:%S'))
+        job = self.__job()
+        self.assertEqual(job.run(), 0)
+        self.assertEqual(job.errors, 1)
+        self.dao.failing_hours = set()
+        self.assertEqual(job.run(), 2)
+        self.assertEqual(self.dao.compacted, [('b', 2), ('b', 3)])
+        self.assertEqual(job.columns, 20)
+        self.assertEqual(job.run(), 0)
+
+    def test_should_skip_series_of_metrics_that_are_not_packed(self):
+        job = CompactionJob(self.dao, [('a', 'text'), ('b', 'cpu')], self.start, clock=lambda: self.now, sleep=self.sleeps.append)
+
+        self.assertEqual(job.run(), 3)
+        self.assertEqual(self.dao.compacted, [('b', 1), ('b', 2), ('b', 3)])
+
+    def test_should_stop_at_the_end_hour(self):
+        job = self.__job(end_datetime=datetime.strptime('1979-06-20T03:10:00', '%Y-%m-%dT%H:%M:%S'))
+
+        self.assertEqual(job.run(), 4)
+        self.assertEqual(self.dao.compacted, [('a', 1), ('a', 2), ('b', 1), ('b', 2)])
+
+    def test_should_only_run_within_the_allowed_hours(self):
+        self.assertEqual(self.__job(allowed_hours=[1, 2, 3]).run(), 0)
+        self.assertEqual(self.__job(allowed_hours=[4]).run(), 6)
+
+    def test_should_space_out_the_shards(self):
+        now = [0.0]
+        limiter = RateLimiter(4, clock=lambda: now[0], sleep=self.sleeps.append)
+        limiter.acquire()
+        now[0] = 0.1
+        limiter.acquire()
+        now[0] = 1.0
+        limiter.acquire()
+        self.assertEqual(self.sleeps, [0.15])
+
+
+class RetentionManagerTest(unittest.TestCase):
+
+    class ExpiringDao():
+        HOURLY_DATA_COLUMN_FAMILY_NAME = TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME
+        LATEST_DATA_COLUMN_FAMILY_NAME = TimeSeriesCassandraDao.LATEST_DATA_COLUMN_FAMILY_NAME
+        BLOB_DATA_COLUMN_FAMILY_NAME = TimeSeriesCassandraDao.BLOB_DATA_COLUMN_FAMILY_NAME
+        BLOB_DATA_INDEX_COLUMN_FAMILY_NAME = TimeSeriesCassandraDao.BLOB_DATA_INDEX_COLUMN_FAMILY_NAME
+        HOUR_PRESENCE_COLUMN_FAMILY_NAME = TimeSeriesCassandraDao.HOUR_PRESENCE_COLUMN_FAMILY_NAME
+
+        def __init__(self):
+            self.blob_indexer = StringIndexer(2)
+            self.index_hit_counts = False
+            self.hour_presence_index = False
+            self.reads = 0
+            self.checkpoints = dict()
+            self.shards = dict()
+            self.latest_data = dict()
+            self.catalog = dict()
+            self.batches = list()
+
+        def floor_timestamp_to_hour(self, timestamp):
+            return timestamp.replace(minute=0, second=0, microsecond=0)
+
+        def highres_to_utc_datetime(self, timestamp_for_start_of_hour, picos_since_start_of_hour):
+            return timestamp_for_start_of_hour + timedelta(microseconds=picos_since_start_of_hour / 10**6)
+
+        def list_sources(self):
+            return sorted(self.catalog.keys())
+
+        def list_series(self, source_id):
+            return [SeriesInfoDTO(source_id, data_name, first_seen, None, 0) for (data_name, first_seen) in sorted(self.catalog[source_id].items())]
+
+        def get_present_hourly_row_keys(self, source_id, metric_name, start_datetime, end_datetime):
+            self.reads += 1
+            return set([TimestampedDataDTO(source_id, hour, metric_name, None).get_row_key_for_hourly() for (shard_source_id, shard_metric_name, hour) in self.shards.keys()
+                        if (shard_source_id, shard_metric_name) == (source_id, metric_name) and start_datetime <= hour <= end_datetime])
+
+        def get_hour_presence_key(self, source_id, metric_name, hour_datetime):
+            hourly_row_key = TimestampedDataDTO(source_id, hour_datetime, metric_name, None).get_row_key_for_hourly()
+            return (hourly_row_key[:-4], hourly_row_key[-10:])
+
+        def count_hourly_shard_columns(self, source_id, metric_name, hour_datetime):
+            self.reads += 1
+            return len(self.shards.get((source_id, metric_name, hour_datetime), dict()))
+
+        def get_whole_hourly_shard(self, source_id, metric_name, hour_datetime):
+            return OrderedDict(sorted(self.shards.get((source_id, metric_name, hour_datetime), dict()).items()))
+
+        def get_index_entry_row_keys(self, index_row_key, timestamp):
+            return [index_row_key]
+
+        def load_latest_data(self, source_id, data_name=None):
+            return dict([(column_name, value) for (column_name, value) in self.latest_data.get(source_id, dict()).items() if column_name in (data_name, data_name + '-ts')])
+
+        def batch_remove(self, removals):
+            self.batches.append(removals)
+
+        def load_job_checkpoints(self, job_name):
+            return dict(self.checkpoints.get(job_name, dict()))
+
+        def save_job_checkpoint(self, job_name, source_id, metric_name, hour_datetime):
+            self.checkpoints.setdefault(job_name, dict())[(source_id, metric_name)] = hour_datetime
+
+    def setUp(self):
+        self.now = datetime.strptime('1979-06-20T04:30:00', '%Y-%m-%dT%H:%M:%S')
+        self.dao = RetentionManagerTest.ExpiringDao()
+        self.sleeps = list()
+
+    def ts(self, timestamp):
+        return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
+
+    def __manager(self, policies, **kwargs):
+        return RetentionManager(self.dao, policies, clock=lambda: self.now, sleep=self.sleeps.append, **kwargs)
+
+    def __removals(self):
+        return [removal for batch in self.dao.batches for removal in batch]
+
+    def test_should_remove_the_hours_that_ended_max_age_ago_and_carry_on_from_the_checkpoint(self):
+        # Given, a day of hourly shards of which the hours before 02:00 are expired
+        for hour in range(0, 5):
+            self.dao.shards[('a', 'cpu', self.ts('1979-06-20T0%s:00:00' % hour))] = {0: '1', 10**12: '2'}
+        manager = self.__manager([RetentionPolicy(timedelta(hours=2, minutes=30), 'a', 'cpu', since=self.ts('1979-06-19T23:00:00'))])
+
+        # When
+        report = manager.run()
+
+        # Then
+        self.assertEqual(self.__removals(), [(TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME, 'a-cpu-19790620%02d' % hour, None) for hour in (0, 1)])
+        self.assertEqual(report.hours, 2)
+        self.assertEqual(report.columns, {TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME: 4})
+        self.assertTrue(report.total_bytes() > 0)
+        self.assertEqual(self.dao.checkpoints['retention'][('a', 'cpu')], self.ts('1979-06-20T01:00:00'))
+
+        # An hour later the next hour has expired
+        self.dao.batches = list()
+        self.now += timedelta(hours=1)
+        self.assertEqual(manager.run().hours, 1)
+        self.assertEqual(self.__removals(), [(TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME, 'a-cpu-1979062002', None)])
+
+    def test_should_remove_the_blobs_index_entries_and_latest_data_of_indexable_text(self):
+        # Given, log records indexed by their message, and cataloged series under a catch-all policy
+        hour = self.ts('1979-06-20T01:00:00')
+        self.dao.catalog = {'a': {'error': hour, 'cpu': hour}}
+        self.dao.shards[('a', 'error', hour)] = {10**12: encode_log_record('ctx', 'a', 'error', u'Disk full')}
+        self.dao.shards[('a', 'cpu', hour)] = {10**12: '1'}
+        self.dao.latest_data['a'] = {'cpu': '1', 'cpu-ts': '298688401000', 'error': 'x', 'error-ts': '298771200000'}
+        manager = self.__manager([RetentionPolicy(timedelta(hours=2), data_name='error', indexable_text=True, index_text=log_record_index_text), RetentionPolicy(timedelta(hours=2))], batch_size=2)
+
+        # When
+        report = manager.run()
+
+        # Then, blobs and index entries before the hourly row, the latest cpu value but not the latest error
+        blob_row_key = TimestampedDataDTO('a', hour + timedelta(seconds=1), 'error', None).get_row_key_for_blob_data()
+        self.assertEqual(self.__removals(), [(TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME, 'a-cpu-1979062001', None),
+                                             (TimeSeriesCassandraDao.LATEST_DATA_COLUMN_FAMILY_NAME, 'a', ['cpu', 'cpu-ts']),
+                                             (TimeSeriesCassandraDao.BLOB_DATA_COLUMN_FAMILY_NAME, blob_row_key, None),
+                                             (TimeSeriesCassandraDao.BLOB_DATA_INDEX_COLUMN_FAMILY_NAME, 'a-error-disk', [hour + timedelta(seconds=1)]),
+                                             (TimeSeriesCassandraDao.BLOB_DATA_INDEX_COLUMN_FAMILY_NAME, 'a-error-disk full', [hour + timedelta(seconds=1)]),
+                                             (TimeSeriesCassandraDao.BLOB_DATA_INDEX_COLUMN_FAMILY_NAME, 'a-error-full', [hour + timedelta(seconds=1)]),
+                                             (TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME, 'a-error-1979062001', None),
+                                             ])
+        self.assertEqual([len(batch) for batch in self.dao.batches], [2, 2, 2, 1])
+        # Waits between the 4 batches and between the 5 reads: the series of 'a', both hours and both latest data
+        self.assertEqual(len(self.sleeps), 3 + 4)
+        self.assertEqual(report.series, 2)
+        self.assertEqual(report.rows[TimeSeriesCassandraDao.BLOB_DATA_INDEX_COLUMN_FAMILY_NAME], 3)
+
+    def test_should_only_read_the_marked_hours_and_remove_their_marks(self):
+        # Given, two hours with data in a week of expired hours, marked in HourPresence
+        self.dao.hour_presence_index = True
+        for hour in (self.ts('1979-06-14T05:00:00'), self.ts('1979-06-19T22:00:00')):
+            self.dao.shards[('a', 'cpu', hour)] = {0: '1'}
+        manager = self.__manager([RetentionPolicy(timedelta(hours=2), 'a', 'cpu', since=self.ts('1979-06-13T00:00:00'))], max_reads_per_second=1.0)
+
+        # When
+        report = manager.run()
+
+        # Then, one presence read and one count per marked hour instead of a count per hour, then the latest data
+        self.assertEqual(self.dao.reads, 3)
+        self.assertEqual(len(self.sleeps), 3)
+        self.assertTrue(all([sleep > 0.5 for sleep in self.sleeps]))
+        self.assertEqual(report.hours, 2)
+        self.assertEqual(self.__removals(), [(TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME, 'a-cpu-1979061405', None),
+                                             (TimeSeriesCassandraDao.HOUR_PRESENCE_COLUMN_FAMILY_NAME, 'a-cpu-197906', ['1979061405']),
+                                             (TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME, 'a-cpu-1979061922', None),
+                                             (TimeSeriesCassandraDao.HOUR_PRESENCE_COLUMN_FAMILY_NAME, 'a-cpu-197906', ['1979061922']),
+                                             ])
+        self.assertEqual(self.dao.checkpoints['retention'][('a', 'cpu')], self.ts('1979-06-20T01:00:00'))
+
+    def test_should_only_count_on_a_dry_run(self):
+        self.dao.shards[('a', 'cpu', self.ts('1979-06-20T01:00:00'))] = {0: '1'}
+        report = self.__manager([RetentionPolicy(timedelta(hours=1), 'a', 'cpu', since=self.ts('1979-06-20T00:00:00'))]).run(dry_run=True)
+        self.assertEqual(report.rows, {TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME: 1})
+        self.assertEqual(self.dao.batches, [])
+        self.assertEqual(self.dao.checkpoints, dict())
+
+    def test_should_apply_the_most_specific_policy(self):
+        policies = [RetentionPolicy(timedelta(days=1)), RetentionPolicy(timedelta(days=2), data_name='cpu'), RetentionPolicy(timedelta(days=3), 'a'), RetentionPolicy(timedelta(days=4), 'a', 'cpu')]
+        manager = self.__manager(policies)
+        self.assertEqual(manager.policy_for('a', 'cpu').max_age, timedelta(days=4))
+        self.assertEqual(manager.policy_for('a', 'mem').max_age, timedelta(days=3))
+        self.assertEqual(manager.policy_for('b', 'cpu').max_age, timedelta(days=2))
+        self.assertEqual(manager.policy_for('b', 'mem').max_age, timedelta(days=1))
+
+
+class LatestDataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.cache = LatestDataCache(ttl=5, max_sources=3, clock=lambda: self.now)
+
+    def test_should_serve_the_cached_data_names_until_they_expire(self):
+        # Given
+        self.cache.put('s1', {'temp': '20', 'temp-ts': '1000', 'hum': '40', 'hum-ts': '1000'})
+        self.cache.put('s2', {'temp': '21', 'temp-ts': '1000'}, ['temp', 'hum'])
+
+        # Then
+        self.assertEqual(self.cache.get('s1'), {'temp': '20', 'temp-ts': '1000', 'hum': '40', 'hum-ts': '1000'})
+        self.assertEqual(self.cache.get('s1', ['temp']), {'temp': '20', 'temp-ts': '1000'})
+        self.assertEqual(self.cache.get('s2', ['hum']), {})
+        self.assertEqual(self.cache.get('s2'), None)
+        self.assertEqual(self.cache.get('s2', ['pressure']), None)
+        self.assertEqual(self.cache.get('s3'), None)
+        self.now += 5
+        self.assertEqual(self.cache.get('s1'), None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 4))
+
+    def test_should_write_through_without_extending_the_ttl(self):
+        # Given
+        self.cache.put('s1', {'temp': '20', 'temp-ts': '1000'}, ['temp'])
+        self.now += 3
+
+        # When
+        self.cache.update('s1', {'temp': '22', 'temp-ts': '2000'})
+        self.cache.update('s2', {'hum': '40', 'hum-ts': '2000'})
+
+        # Then
+        self.assertEqual(self.cache.get('s1', ['temp']), {'temp': '22', 'temp-ts': '2000'})
+        self.assertEqual(self.cache.get('s2', ['hum']), {'hum': '40', 'hum-ts': '2000'})
+        self.assertEqual(self.cache.get('s2'), None)
+        self.now += 2
+        self.assertEqual(self.cache.get('s1', ['temp']), None)
+        self.assertEqual(self.cache.get('s2', ['hum']), {'hum': '40', 'hum-ts': '2000'})
+
+    def test_should_invalidate_and_drop_expired_sources_when_full(self):
+        # Given
+        for source_id in ('s1', 's2', 's3'):
+            self.cache.put(source_id, {})
+        self.cache.invalidate('s1')
+        self.assertEqual(self.cache.get('s1'), None)
+        self.cache.put('s1', {})
+        self.now += 5
+
+        # When
+        self.cache.put('s4', {})
+
+        # Then
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get('s4'), {})
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_should_not_cache_rows_read_before_a_write(self):
+        # Given, a snapshot read started before a write-through of s1
+        version = self.cache.version()
+        self.cache.update('s1', {'temp': '22', 'temp-ts': '2000'})
+        self.cache.invalidate('s2')
+
+        # When, its reads finish after the write
+        cached = [self.cache.put(source_id, {'temp': '20', 'temp-ts': '1000'}, ['temp'], version) for source_id in ('s1', 's2', 's3')]
+
+        # Then, only the source not written since is cached
+        self.assertEqual(cached, [False, False, True])
+        self.assertEqual(self.cache.get('s1', ['temp']), {'temp': '22', 'temp-ts': '2000'})
+        self.assertEqual(self.cache.get('s2', ['temp']), None)
+        self.assertTrue(self.cache.put('s2', {}, ['temp'], self.cache.version()))
+
+        # And, sources forgotten when the writes no longer fit are taken as written
+        for source_id in ('s4', 's5', 's6'):
+            self.cache.update(source_id, {})
+        self.assertFalse(self.cache.put('s7', {}, None, version))
+
 
 class CassandraLoggerTest(PyCatsIntegrationTestBase):
 
@@ -831,5 +2461,110 @@ class CassandraLoggerTest(PyCatsIntegrationTestBase):
 
         self.assertEqual(len(result), 0)
 
+    def test_should_count_free_text_hits_and_load_a_page_of_log_messages(self):
+        # Given
+        logger = CassandraLogger(self.dao)
+
+        source_context = 'CassandraLoggerTest4'
+        log_source = 'unittest4'
+        timestamp = datetime.strptime('1979-06-20T07:00:00', '%Y-%m-%dT%H:%M:%S')
+        level = 'error'
+        for i in range(0, 30):
+            logger.log(source_context, log_source, timestamp + timedelta(seconds=i), level, u'Paged failure number %s' % i)
+
+        # Then
+        self.assertEqual(logger.free_text_count('paged failure', source_context, log_source, level), 30)
+
+        result = logger.free_text_search_page('paged failure', 1, 20, source_context, log_source, level)
+        self.assertEqual(len(result), 10)
+        self.__assert_log_message(result[0], source_context, log_source, timestamp + timedelta(seconds=20), level, u'Paged failure number 20')
+
+    def test_should_keep_pipes_in_messages_and_load_levels_only(self):
+        # Given
+        logger = CassandraLogger(self.dao)
+        source_context = 'CassandraLoggerPipeTest'
+        log_source = 'unittestpipe'
+        timestamp = datetime.strptime('1979-06-20T09:09:09', '%Y-%m-%dT%H:%M:%S')
+
+        # When
+        logger.log(source_context, log_source, timestamp, 'warn', u'Piped | message')
+
+        # Then
+        result = logger.load_by_date_range(source_context, log_source, 'warn', timestamp, timestamp + timedelta(seconds=1))
+        self.assertEqual(len(result), 1)
+        self.__assert_log_message(result[0], source_context, log_source, timestamp, 'warn', u'Piped | message')
+        self.assertEqual(logger.load_levels_by_date_range(source_context, log_source, None, timestamp, timestamp + timedelta(seconds=1)), [(timestamp, 'warn')])
+
+    def test_should_follow_the_log(self):
+        # Given
+        logger = CassandraLogger(self.dao)
+        logger.tail_hub.min_interval = 0
+        source_context = 'CassandraLoggerFollowTest'
+        log_source = 'unittestfollow'
+        timestamp = datetime.utcnow()
+        follower = logger.follow(source_context, log_source, 'info', start_date=timestamp - timedelta(seconds=1))
+
+        # When
+        logger.log(source_context, log_source, timestamp, 'info', u'First line')
+        first_poll = follower.poll()
+        logger.log(source_context, log_source, timestamp + timedelta(milliseconds=1), 'info', u'Second line')
+        second_poll = follower.poll()
+        follower.close()
+
+        # Then
+        self.assertEqual([lm.message for lm in first_poll], [u'First line'])
+        self.assertEqual([lm.message for lm in second_poll], [u'Second line'])
+
+    def test_should_log_with_different_ttls_and_load_using_all_contexts(self):
+        # Given
+        logger = CassandraLogger(self.dao, ttl_days_for_exact=1, ttl_days_for_source_context=2, ttl_days_for_global_context=3)
+
+        source_context = 'CassandraLoggerTtlTest'
+        log_source = 'unittestttl'
+        timestamp = datetime.strptime('1979-06-20T07:07:07', '%Y-%m-%dT%H:%M:%S')
+        level = 'error'
+        message = u'Written with three different lifetimes'
+
+        # When
+        logger.log(source_context, log_source, timestamp, level, message)
+
+        # Then
+        self.assertEqual(len(logger.free_text_search('lifetimes', source_context, log_source, level)), 1)
+        self.assertEqual(len(logger.free_text_search('lifetimes', source_context, None, level)), 1)
+        self.assertEqual(len(logger.free_text_search('lifetimes', None, None, None)), 1)
+
+    def test_should_index_every_hit_of_a_batch_sharing_index_rows(self):
+        # Given
+        source_id = 'MutationTest'
+        data_name = 'text'
+        timestamp = datetime.strptime('1979-06-20T07:07:07', '%Y-%m-%dT%H:%M:%S')
+        dtos = [TimestampedDataDTO(source_id, timestamp + timedelta(seconds=i), data_name, u'Same words %s' % i) for i in range(0, 5)]
+
+        # When
+        self.dao.batch_insert_indexable_text_as_blob_data_and_insert_indexes_by_ttl({None: dtos[:3], 60*60: dtos[3:] + [None]})
+
+        # Then, every message shares the index row of 'same'
+        self.assertEqual(self.dao.count_by_free_text_index(source_id, data_name, 'same'), 5)
+
+    def test_should_log_through_buffered_logger_and_load_after_flush(self):
+        # Given
+        logger = BufferedCassandraLogger(self.dao, ttl_days_for_global_context=7, flush_on_exit=False)
+
+        source_context = 'CassandraLoggerTest5'
+        log_source = 'unittest5'
+        timestamp = datetime.strptime('1979-06-20T08:00:00', '%Y-%m-%dT%H:%M:%S')
+        level = 'warn'
+
+        # When
+        for i in range(0, 10):
+            logger.log(source_context, log_source, timestamp + timedelta(seconds=i), level, u'Buffered warning number %s' % i)
+        logger.close()
+
+        # Then
+        self.assertEqual(logger.failed_records, 0)
+        result = logger.load_by_date_range(source_context, log_source, level, timestamp, timestamp + timedelta(seconds=10))
+        self.assertEqual(len(result), 10)
+        self.__assert_log_message(result[9], source_context, log_source, timestamp + timedelta(seconds=9), level, u'Buffered warning number 9')
+
 if __name__ == '__main__':
     unittest.main()
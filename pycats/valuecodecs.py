@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+__author__ = 'hans'
+
+from array import array
+import base64
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Typed encoding of the values in the time-series CF, picked per metric, see TimeSeriesCassandraDao(value_codecs=...)
+#
+# A typed value is a one byte header followed by the big-endian value:
+#
+#   0x01 | int64      9 bytes
+#   0x02 | float64    9 bytes
+#
+# Typed values are raw binary, the time-series CF has to validate its values as blob to store them, see
+# TimeSeriesCassandraDao.HOURLY_DATA_COLUMN_FAMILY_NAME.
+#
+# Bytes 0x01-0x02 never start a sane string value, so values stored as strings (before a metric got a
+# codec, or by metrics without one) are returned as strings. The readers don't need to know the codec of
+# a metric, the header tells them.
+#
+# The codecs also pack a whole list of values into one block, delta-of-delta varints for int64 and
+# Gorilla-style XOR of consecutive values for float64. Blocks start with 0x03 and are binary, they are
+# only stored as part of a packed column.
+#
+# A packed column, 0x04 followed by the base64 of the column names (delta-of-delta) and the value block,
+# holds a whole time window of a shard, see TimeSeriesCassandraDao(packed_blocks=...).
+INT64_HEADER = '\x01'
+FLOAT64_HEADER = '\x02'
+BLOCK_HEADER = '\x03'
+PACKED_COLUMNS_HEADER = '\x04'
+TYPED_VALUE_SIZE = 9
+
+INT64 = struct.Struct('>q')
+FLOAT64 = struct.Struct('>d')
+# Unpackers of typed values by header
+TYPED_VALUES = {INT64_HEADER: struct.Struct('>xq').unpack,
+                FLOAT64_HEADER: struct.Struct('>xd').unpack,
+                }
+NAN = float('nan')
+
+
+class UnknownValueCodecException(Exception):
+    pass
+
+
+def _zigzag(value):
+    return (value << 1) if value >= 0 else ((-value) << 1) - 1
+
+
+def _unzigzag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return (result, position)
+        shift += 7
+
+
+def _int64_array(values):
+    if numpy is not None:
+        return numpy.array(values, dtype=numpy.int64)
+    if array('l').itemsize == 8:
+        return array('l', values)
+    return list(values)
+
+
+def _float64_array(values):
+    if numpy is not None:
+        return numpy.array(values, dtype=numpy.float64)
+    return array('d', values)
+
+
+# Delta-of-delta varint block of integers, ie. the column names of a shard: regularly spaced values take a
+# single byte each
+def encode_delta_block(values):
+    out = bytearray()
+    _write_varint(out, len(values))
+    previous = 0
+    previous_delta = 0
+    for value in values:
+        delta = value - previous
+        _write_varint(out, _zigzag(delta - previous_delta))
+        previous = value
+        previous_delta = delta
+    return str(out)
+
+
+# Returns (the values, the position after the block)
+def decode_delta_block(data, position=0):
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+    (count, position) = _read_varint(data, position)
+    values = list()
+    previous = 0
+    delta = 0
+    for i in xrange(0, count):
+        (delta_of_delta, position) = _read_varint(data, position)
+        delta += _unzigzag(delta_of_delta)
+        previous += delta
+        values.append(previous)
+    return (values, position)
+
+
+class _BitWriter():
+
+    def __init__(self):
+        self.out = bytearray()
+        self.__bits = 0
+        self.__bit_count = 0
+
+    def write(self, value, bit_count):
+        self.__bits = (self.__bits << bit_count) | value
+        self.__bit_count += bit_count
+        while self.__bit_count >= 8:
+            self.__bit_count -= 8
+            self.out.append((self.__bits >> self.__bit_count) & 0xFF)
+        self.__bits &= (1 << self.__bit_count) - 1
+
+    def flush(self):
+        if self.__bit_count:
+            self.out.append((self.__bits << (8 - self.__bit_count)) & 0xFF)
+            self.__bits = 0
+            self.__bit_count = 0
+        return self.out
+
+
+class _BitReader():
+
+    def __init__(self, data, position):
+        self.__data = data
+        self.position = position
+        self.__bits = 0
+        self.__bit_count = 0
+
+    def read(self, bit_count):
+        while self.__bit_count < bit_count:
+            self.__bits = (self.__bits << 8) | self.__data[self.position]
+            self.position += 1
+            self.__bit_count += 8
+        self.__bit_count -= bit_count
+        value = self.__bits >> self.__bit_count
+        self.__bits &= (1 << self.__bit_count) - 1
+        return value
+
+
+# Gorilla-style XOR block of floats: the first value as is, then per value a 0 bit if it equals the previous
+# one, or the meaningful bits of the XOR with the previous value, reusing the previous leading/trailing zero
+# window when the XOR fits in it
+def encode_xor_block(values):
+    out = bytearray()
+    _write_varint(out, len(values))
+    if not values:
+        return str(out)
+    bits = struct.unpack('>%dQ' % len(values), struct.pack('>%dd' % len(values), *values))
+    writer = _BitWriter()
+    writer.write(bits[0], 64)
+    previous = bits[0]
+    (window_leading, window_trailing) = (-1, -1)
+    for value in bits[1:]:
+        xor = value ^ previous
+        previous = value
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if window_leading >= 0 and leading >= window_leading and trailing >= window_trailing:
+            writer.write(0b10, 2)
+            writer.write(xor >> window_trailing, 64 - window_leading - window_trailing)
+        else:
+            meaningful = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            writer.write(meaningful & 0x3F, 6)
+            writer.write(xor >> trailing, meaningful)
+            (window_leading, window_trailing) = (leading, trailing)
+    return str(out + writer.flush())
+
+
+# Returns (the values as a list of floats, the position after the block)
+def decode_xor_block(data, position=0):
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+    (count, position) = _read_varint(data, position)
+    if count == 0:
+        return ([], position)
+    reader = _BitReader(data, position)
+    bits = [reader.read(64)]
+    (window_leading, window_trailing) = (0, 0)
+    for i in xrange(1, count):
+        if reader.read(1) == 0:
+            bits.append(bits[-1])
+            continue
+        if reader.read(1) == 1:
+            window_leading = reader.read(5)
+            meaningful = reader.read(6) or 64
+            window_trailing = 64 - window_leading - meaningful
+        bits.append(bits[-1] ^ (reader.read(64 - window_leading - window_trailing) << window_trailing))
+    values = list(struct.unpack('>%dd' % count, struct.pack('>%dQ' % count, *bits)))
+    return (values, reader.position)
+
+
+# Stores values as they are passed, the behaviour of metrics without a codec
+class StringValueCodec():
+    name = 'string'
+
+    def encode(self, value):
+        return value
+
+
+class Int64ValueCodec():
+    name = 'int64'
+    block_type = 1
+
+    def encode(self, value):
+        return INT64_HEADER + INT64.pack(int(value))
+
+    def encode_block(self, values):
+        return BLOCK_HEADER + chr(self.block_type) + encode_delta_block([int(value) for value in values])
+
+    # Returns (the values as an int64 array, the position after the block)
+    def decode_block(self, data, position=0):
+        (values, position) = decode_delta_block(data, position)
+        return (_int64_array(values), position)
+
+
+class Float64ValueCodec():
+    name = 'float64'
+    block_type = 2
+
+    def encode(self, value):
+        return FLOAT64_HEADER + FLOAT64.pack(float(value))
+
+    def encode_block(self, values):
+        return BLOCK_HEADER + chr(self.block_type) + encode_xor_block([float(value) for value in values])
+
+    # Returns (the values as a float64 array, the position after the block)
+    def decode_block(self, data, position=0):
+        (values, position) = decode_xor_block(data, position)
+        return (_float64_array(values), position)
+
+
+registered_value_codecs = {StringValueCodec.name: StringValueCodec(),
+                           Int64ValueCodec.name: Int64ValueCodec(),
+                           Float64ValueCodec.name: Float64ValueCodec(),
+                           }
+codecs_by_block_type = {Int64ValueCodec.block_type: registered_value_codecs[Int64ValueCodec.name],
+                        Float64ValueCodec.block_type: registered_value_codecs[Float64ValueCodec.name],
+                        }
+
+
+# Takes a codec or the name of a registered one
+def get_value_codec(codec_or_name):
+    if not isinstance(codec_or_name, basestring):
+        return codec_or_name
+    try:
+        return registered_value_codecs[codec_or_name]
+    except KeyError:
+        raise UnknownValueCodecException('Unknown value codec \'%s\'' % codec_or_name)
+
+
+def is_typed_value(data):
+    return isinstance(data, str) and len(data) == TYPED_VALUE_SIZE and data[0] in TYPED_VALUES
+
+
+def is_value_block(data):
+    return isinstance(data, str) and len(data) > 1 and data[0] == BLOCK_HEADER
+
+
+# Returns (the values as a typed array, the position after the block) of a block written by encode_block()
+def decode_value_block(data, position=0):
+    try:
+        codec = codecs_by_block_type[ord(data[position + 1])]
+    except KeyError:
+        raise UnknownValueCodecException('Unknown value block type %s' % ord(data[position + 1]))
+    return codec.decode_block(data, position + 2)
+
+
+def is_packed_columns(data):
+    return isinstance(data, basestring) and len(data) > 1 and data[0] == PACKED_COLUMNS_HEADER
+
+
+# Packs columns (column names and values, in column name order) into the value of a single column. Raises
+# ValueError if the values can't be converted by the codec
+def encode_packed_columns(column_names, values, codec):
+    return PACKED_COLUMNS_HEADER + base64.b64encode(encode_delta_block(column_names) + codec.encode_block(values))
+
+
+# Returns (the column names, the values as a typed array)
+def decode_packed_columns(data):
+    data = base64.b64decode(data[1:])
+    (column_names, position) = decode_delta_block(data)
+    (values, position) = decode_value_block(data, position)
+    return (column_names, values)
+
+
+# Returns an int or float for typed values and strings as unicode, as pycassa returns them from a utf-8
+# validated CF. Anything else as it is
+def decode_value(data):
+    if isinstance(data, str):
+        if len(data) == TYPED_VALUE_SIZE:
+            unpack = TYPED_VALUES.get(data[0], None)
+            if unpack is not None:
+                return unpack(data)[0]
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            return data
+    return data
+
+
+# Returns (the header, the big-endian values without their headers) if values are typed values that all
+# have the same header, None otherwise
+def _strip_typed_values(values):
+    if not is_typed_value(values[0]):
+        return None
+    try:
+        data = ''.join(values)
+    except TypeError:
+        return None
+    count = len(values)
+    if not isinstance(data, str) or len(data) != TYPED_VALUE_SIZE * count:
+        return None
+    header = data[0]
+    if data[::TYPED_VALUE_SIZE] != header * count:
+        return None
+    packed = bytearray(data)
+    del packed[::TYPED_VALUE_SIZE]
+    return (header, str(packed))
+
+
+# Same as decode_value for a list of values, pages of int64 or float64 columns are unpacked in one go
+def decode_values(values):
+    stripped = _strip_typed_values(values) if values else None
+    if stripped is None:
+        return [decode_value(value) for value in values]
+    (header, packed) = stripped
+    return list(struct.unpack('>%d%s' % (len(values), 'q' if header == INT64_HEADER else 'd'), packed))
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    if is_typed_value(value):
+        return float(decode_value(value))
+    return NAN
+
+
+# Returns the values as an array of floats, NaN for the ones that are not numbers. Pages of int64 or float64
+# columns are unpacked in one go
+def decode_floats(values):
+    stripped = _strip_typed_values(values) if values else None
+    if stripped is None:
+        return _float64_array([_to_float(value) for value in values])
+    (header, packed) = stripped
+    if header == INT64_HEADER:
+        return _float64_array(struct.unpack('>%dq' % len(values), packed))
+    if numpy is not None:
+        return numpy.frombuffer(packed, dtype='>f8').astype(numpy.float64)
+    result = array('d')
+    result.fromstring(packed)
+    if sys.byteorder == 'little':
+        result.byteswap()
+    return result